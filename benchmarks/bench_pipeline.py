@@ -0,0 +1,271 @@
+'''
+
+Benchmark of the Python feature engineering pipeline on synthetic xcms/CAMERA peak tables.
+
+Each stage (rounder -> feature_correspondance -> data_cleaning -> data_prep -> predict_proba) is
+timed and its peak memory is measured with tracemalloc. The output of every stage is reduced to a
+digest and compared against the frozen results in golden.json, so a faster implementation can be
+checked to give the same answers before it ships. The golden digests were computed with the original
+implementation of the stages (the functions of the first qc_app.py), not with the current one.
+
+Usage (from the repository root):
+
+    python benchmarks/bench_pipeline.py
+    python benchmarks/bench_pipeline.py --peaks 1000 10000 --samples 10
+    python benchmarks/bench_pipeline.py --update-golden
+
+'''
+
+import argparse
+import hashlib
+import json
+import os
+import pickle
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import feature_eng
+
+GOLDEN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'golden.json')
+
+PEAKS = [1000, 10000, 100000]
+SAMPLES = [10, 100, 1000]
+
+
+def synthetic_peaklist(ref_data, n_peaks, n_samples, seed=0, hit_fraction=0.3, nan_fraction=0.05):
+
+    '''
+
+    Builds a table with the same shape as the CAMERA getPeaklist output (after the sample class
+    columns are dropped): mz, mzmin, mzmax, rt, rtmin, rtmax (rt in seconds), npeaks, one intensity
+    column per sample and the isotopes, adduct and pcgroup annotation columns.
+
+    A fraction of the peaks is drawn inside the reference windows so that feature_correspondance
+    has something to match, the rest is spread over the whole mz and rt range.
+
+
+    Parameters
+    ----------
+    ref_data : pandas DataFrame, default None
+        Reference data (ref_data_*.csv) used to place the matching peaks.
+
+    n_peaks : int, default None
+        Number of rows of the table.
+
+    n_samples : int, default None
+        Number of sample intensity columns.
+
+    seed : int, default 0
+        Seed of the random generator, so the same table is built on every run.
+
+    hit_fraction : float, default 0.3
+        Fraction of the peaks placed inside a reference window.
+
+    nan_fraction : float, default 0.05
+        Fraction of the peaks with a missing intensity in one (random) sample.
+
+    '''
+
+    rng = np.random.default_rng(seed)
+
+    hits = rng.random(n_peaks) < hit_fraction
+    ref_rows = rng.integers(0, len(ref_data), n_peaks)
+
+    mz = rng.uniform(ref_data.mzmin.min() - 10, ref_data.mzmax.max() + 10, n_peaks)
+    mz[hits] = rng.uniform(ref_data.mzmin.to_numpy()[ref_rows[hits]], ref_data.mzmax.to_numpy()[ref_rows[hits]])
+
+    # reference rt is in minutes, the xcms output in seconds
+    rt = rng.uniform(ref_data.rtmin.min(), ref_data.rtmax.max(), n_peaks) * 60
+    rt[hits] = rng.uniform(ref_data.rtmin.to_numpy()[ref_rows[hits]], ref_data.rtmax.to_numpy()[ref_rows[hits]]) * 60
+
+    mz_width = rng.uniform(0, 0.5, n_peaks)
+    rt_width = rng.uniform(1, 30, n_peaks)
+
+    table = pd.DataFrame({
+        'mz': mz,
+        'mzmin': mz - mz_width,
+        'mzmax': mz + mz_width,
+        'rt': rt,
+        'rtmin': rt - rt_width,
+        'rtmax': rt + rt_width,
+        'npeaks': rng.integers(1, n_samples + 1, n_peaks),
+    })
+
+    # a few peaks have a missing intensity in one sample, so data_prep drops them and keeps the rest
+    # (a NaN rate per cell would leave no complete row once there are a hundred samples)
+    intensities = rng.lognormal(13, 2, (n_peaks, n_samples))
+    missing = np.flatnonzero(rng.random(n_peaks) < nan_fraction)
+    intensities[missing, rng.integers(0, n_samples, len(missing))] = np.nan
+    samples = pd.DataFrame(intensities, columns=['sample_%d' % i for i in range(n_samples)])
+
+    annotation = pd.DataFrame({
+        'isotopes': '',
+        'adduct': '',
+        'pcgroup': rng.integers(1, max(n_peaks // 10, 2), n_peaks),
+    })
+
+    return pd.concat([table, samples, annotation], axis=1)
+
+
+def digest(obj):
+
+    '''
+
+    Short, order sensitive digest of a stage output (DataFrame, tuple of DataFrames or array).
+
+    '''
+
+    h = hashlib.sha256()
+
+    if isinstance(obj, tuple):
+        for item in obj:
+            h.update(digest(item).encode())
+    elif isinstance(obj, pd.DataFrame):
+        h.update(json.dumps([str(c) for c in obj.columns]).encode())
+        h.update(pd.util.hash_pandas_object(obj, index=True).values.tobytes())
+    else:
+        # probabilities are compared with a tolerance that survives summation order changes
+        h.update(np.round(np.asarray(obj, dtype=float), 10).tobytes())
+
+    return h.hexdigest()[:16]
+
+
+def load_model(path):
+
+    try:
+        with open(path, 'rb') as handle:
+            return pickle.load(handle)
+    except Exception as error:
+        print('  model %s not loaded (%s), skipping predict_proba' % (os.path.basename(path), error))
+        return None
+
+
+def stages(ref_data, model):
+
+    '''
+
+    Returns the (name, function) pairs of the pipeline, in the order they are run by qc_app. Each
+    function takes the output of the previous stage.
+
+    '''
+
+    def prep(clean):
+        return feature_eng.data_prep(ref_data, clean[1]).set_index('index').T
+
+    pipeline = [
+        ('rounder', lambda table: feature_eng.rounder(table.drop(['isotopes', 'adduct', 'pcgroup'], axis=1))),
+        ('feature_correspondance', lambda rounded: feature_eng.feature_correspondance(ref_data, rounded)),
+        ('data_cleaning', lambda feat: feature_eng.data_cleaning(ref_data, feat)),
+        ('data_prep', prep),
+    ]
+
+    if model is not None:
+        # the model was fitted on an array: the DataFrame columns would only raise a feature names warning
+        pipeline.append(('predict_proba', lambda matrix: model.predict_proba(matrix.to_numpy())[:, 1]))
+
+    return pipeline
+
+
+def run_case(ref_data, model, n_peaks, n_samples):
+
+    '''
+
+    Runs every stage once for timing and once under tracemalloc for the peak memory, so the tracing
+    overhead does not show up in the wall times.
+
+    '''
+
+    table = synthetic_peaklist(ref_data, n_peaks, n_samples)
+    results = []
+
+    data = table
+    for name, stage in stages(ref_data, model):
+
+        # rounder works in place, so every stage gets its own copy of the input
+        stage_input = data.copy() if isinstance(data, pd.DataFrame) else data
+        start = time.perf_counter()
+        output = stage(stage_input)
+        wall = time.perf_counter() - start
+
+        stage_input = data.copy() if isinstance(data, pd.DataFrame) else data
+        tracemalloc.start()
+        stage(stage_input)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        results.append({'stage': name, 'seconds': wall, 'peak_mb': peak / 2**20, 'digest': digest(output)})
+        data = output
+
+    return results
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--peaks', type=int, nargs='+', default=PEAKS, help='number of peaks of the synthetic tables')
+    parser.add_argument('--samples', type=int, nargs='+', default=SAMPLES, help='number of sample columns')
+    parser.add_argument('--ref', default=os.path.join(ROOT, 'ref_data_mikania.csv'), help='reference data csv')
+    parser.add_argument('--model', default=os.path.join(ROOT, 'model_mikania.pkl'), help='pickled model')
+    parser.add_argument('--update-golden', action='store_true', help='store the digests of this run as the golden result')
+    parser.add_argument('--json', help='also write the measurements to this file')
+    args = parser.parse_args(argv)
+
+    ref_data = pd.read_csv(args.ref)
+    model = load_model(args.model)
+
+    golden = {}
+    if os.path.exists(GOLDEN_PATH):
+        with open(GOLDEN_PATH) as handle:
+            golden = json.load(handle)
+
+    report = {}
+    mismatches = 0
+
+    print('%8s %8s  %-24s %10s %10s  %s' % ('peaks', 'samples', 'stage', 'seconds', 'peak MB', 'golden'))
+    for n_peaks in args.peaks:
+        for n_samples in args.samples:
+            case = '%dx%d' % (n_peaks, n_samples)
+            results = run_case(ref_data, model, n_peaks, n_samples)
+            report[case] = results
+
+            for result in results:
+                expected = golden.get(case, {}).get(result['stage'])
+                if expected is None:
+                    status = '-'
+                elif expected == result['digest']:
+                    status = 'ok'
+                else:
+                    status = 'MISMATCH'
+                    mismatches += 1
+
+                print('%8d %8d  %-24s %10.4f %10.1f  %s' % (n_peaks, n_samples, result['stage'],
+                                                            result['seconds'], result['peak_mb'], status))
+
+            if args.update_golden:
+                golden[case] = {result['stage']: result['digest'] for result in results}
+
+    if args.update_golden:
+        with open(GOLDEN_PATH, 'w') as handle:
+            json.dump(golden, handle, indent=2, sort_keys=True)
+            handle.write('\n')
+
+    if args.json:
+        with open(args.json, 'w') as handle:
+            json.dump(report, handle, indent=2)
+
+    if mismatches:
+        print('%d stage output(s) differ from the golden result' % mismatches)
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,266 @@
+'''
+
+Per sample explanation of the predictions: the features that contributed most to the probability
+given by the model, and the reference features the sample is missing (zero filled by data_prep).
+
+The contributions are computed for all the samples at once, on the model input after the transforms
+of the Pipeline (Normalizer, ColumnSelector), and reported for the input columns (mz_rt features):
+
+    random forest   exact path contributions: for every tree, the change of the class probability at
+                    each split along the path of the sample is credited to the feature of the split.
+                    One decision_path call for the whole forest and one sparse product give them for
+                    every sample; the bias (the mean root probability) plus the contributions of a
+                    sample is its predicted probability.
+    k neighbours    occlusion: the drop of the probability when the feature is set to zero (as if it
+                    were missing), from the distances to the training samples updated feature by
+                    feature rather than a new neighbour search per feature.
+    other models    the same occlusion, with one predict_proba call on the stacked occluded samples.
+
+Usage:
+
+    contributions, bias = explain.contributions(model, input_data_model)
+    explain.explain(model, input_data_model, top=10)        # one row per sample
+
+'''
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from sklearn.ensemble import ExtraTreesClassifier, RandomForestClassifier
+from sklearn.neighbors import KNeighborsClassifier
+
+DEFAULT_TOP = 10
+# occluded samples per predict_proba call (occlusion of models without a dedicated method)
+OCCLUSION_CHUNK = 2**16
+
+
+def split_pipeline(model, n_features):
+    '''
+
+    Final estimator of a Pipeline (or the model itself) and the positions, among the n_features
+    input columns, of the columns it sees. The selections of ColumnSelector (cols) and of the
+    scikit-learn selectors (get_support) are followed; the other steps (e.g. Normalizer) keep the columns.
+
+    '''
+    columns = np.arange(n_features)
+    steps = getattr(model, 'steps', [(None, model)])
+
+    for _, step in steps[:-1]:
+        if hasattr(step, 'cols'):
+            columns = columns[list(step.cols)]
+        elif hasattr(step, 'get_support'):
+            columns = columns[step.get_support()]
+
+    return steps[-1][1], columns
+
+
+def transform(model, input_data_model):
+    '''
+    the model input through the transforms of the Pipeline (all its steps but the last), as a dense array or CSR matrix.
+    '''
+    X = input_data_model.to_numpy(dtype=float) if isinstance(input_data_model, pd.DataFrame) else input_data_model
+    for _, step in getattr(model, 'steps', [])[:-1]:
+        X = step.transform(X)
+
+    return X
+
+
+def positive_class(estimator):
+    '''
+    position of the class whose probability is reported (predict_proba(...)[:, 1]).
+    '''
+    return 1 if len(estimator.classes_) > 1 else 0
+
+
+def forest_contributions(forest, X):
+    '''
+
+    Path contributions of a random forest (see the module docstring) to the probability of the
+    positive class. Returns the samples x features contributions and the bias.
+
+    '''
+    target = positive_class(forest)
+    X = X.astype(np.float32) if not sp.issparse(X) else X.tocsr().astype(np.float32)
+
+    # all the trees at once: one node indicator matrix, their nodes one after the other
+    paths, node_ptr = forest.decision_path(X)
+
+    rows, columns, deltas = [], [], []
+    bias = 0.0
+    for tree, offset in zip(forest.estimators_, node_ptr[:-1]):
+        tree_ = tree.tree_
+        value = tree_.value[:, 0, :]
+        probability = value[:, target] / value.sum(axis=1)
+
+        parent = np.full(tree_.node_count, -1)
+        for children in (tree_.children_left, tree_.children_right):
+            split = np.flatnonzero(children >= 0)
+            parent[children[split]] = split
+
+        child = np.flatnonzero(parent >= 0)
+        rows.append(offset + child)
+        columns.append(tree_.feature[parent[child]])
+        deltas.append(probability[child] - probability[parent[child]])
+        bias += probability[0]
+
+    credit = sp.csr_matrix((np.concatenate(deltas), (np.concatenate(rows), np.concatenate(columns))),
+                           shape=(paths.shape[1], X.shape[1]))
+
+    n_trees = len(forest.estimators_)
+    return np.asarray((paths @ credit).todense()) / n_trees, bias / n_trees
+
+
+def knn_occlusion(knn, X):
+    '''
+
+    Occlusion contributions of a k neighbours classifier with euclidean distances and uniform
+    weights: the probability minus the probability with the feature set to zero. The squared
+    distances to the training samples are computed once and updated for each feature.
+
+    '''
+    X = X.toarray() if sp.issparse(X) else np.asarray(X, dtype=float)
+    train = np.asarray(knn._fit_X, dtype=float)
+    votes = (knn._y == positive_class(knn)).astype(float)
+    k = knn.n_neighbors
+
+    def probability(distances):
+        nearest = np.argpartition(distances, k - 1, axis=-1)[..., :k]
+        return votes[nearest].mean(axis=-1)
+
+    distances = (X**2).sum(axis=1)[:, None] - 2 * X @ train.T + (train**2).sum(axis=1)[None, :]
+    base = probability(distances)
+
+    contributions = np.empty(X.shape)
+    for feature in range(X.shape[1]):
+        # |x - t|^2 with x_f = 0: the (x_f - t_f)^2 term becomes t_f^2
+        occluded = distances - X[:, feature, None]**2 + 2 * X[:, feature, None] * train[None, :, feature]
+        contributions[:, feature] = base - probability(occluded)
+
+    return contributions, float(votes.mean())
+
+
+def occlusion(estimator, X):
+    '''
+
+    Occlusion contributions of any classifier with predict_proba: one call on all the samples with
+    each non zero feature set to zero in turn (in chunks of OCCLUSION_CHUNK rows).
+
+    '''
+    X = X.toarray() if sp.issparse(X) else np.asarray(X, dtype=float)
+    target = positive_class(estimator)
+    base = estimator.predict_proba(X)[:, target]
+
+    samples, features = np.nonzero(X)
+    contributions = np.zeros(X.shape)
+    for start in range(0, len(samples), OCCLUSION_CHUNK):
+        chunk = slice(start, start + OCCLUSION_CHUNK)
+        occluded = X[samples[chunk]]
+        occluded[np.arange(len(occluded)), features[chunk]] = 0
+        contributions[samples[chunk], features[chunk]] = base[samples[chunk]] - estimator.predict_proba(occluded)[:, target]
+
+    return contributions, float(base.mean())
+
+
+def contributions(model, input_data_model):
+    '''
+
+    Contributions of the input features to the probability of every sample, as a samples x features
+    DataFrame (zero for the columns the model does not use), and the bias: the mean root probability
+    of a forest, or the share of positive training samples (k neighbours) or the mean probability
+    (occlusion). See the module docstring for the methods.
+
+
+    Parameters
+    ----------
+    model : sklearn Pipeline, default None
+        Model of the species.
+
+    input_data_model : pandas DataFrame or scipy.sparse matrix, default None
+        Model input, as returned by qc_pipeline.model_input (samples x features), or the matrix of
+        model_input_sparse (whose columns are the features of the reference, in order).
+
+    '''
+    estimator, columns = split_pipeline(model, input_data_model.shape[1])
+    X = transform(model, input_data_model)
+
+    if isinstance(estimator, (RandomForestClassifier, ExtraTreesClassifier)):
+        selected, bias = forest_contributions(estimator, X)
+    elif (isinstance(estimator, KNeighborsClassifier) and estimator.weights == 'uniform'
+          and estimator.effective_metric_ == 'euclidean'):
+        selected, bias = knn_occlusion(estimator, X)
+    else:
+        selected, bias = occlusion(estimator, X)
+
+    values = np.zeros(input_data_model.shape)
+    values[:, columns] = selected
+
+    index = input_data_model.index if isinstance(input_data_model, pd.DataFrame) else None
+    names = input_data_model.columns if isinstance(input_data_model, pd.DataFrame) else None
+
+    return pd.DataFrame(values, index=index, columns=names), bias
+
+
+def feature_importance(model, n_features):
+    '''
+    importance of the input features for the model: feature_importances_ of the final estimator if it has one, else 1 for the columns it uses.
+    '''
+    estimator, columns = split_pipeline(model, n_features)
+    importance = np.zeros(n_features)
+    importance[columns] = getattr(estimator, 'feature_importances_', 1.0)
+
+    return importance
+
+
+def explain(model, input_data_model, top=DEFAULT_TOP, samples=None, feature_names=None):
+    '''
+
+    One row per sample with its top contributing features and the features used by the model it is
+    missing (zero in the model input, i.e. not found in the peak table and zero filled by data_prep),
+    most important first.
+
+
+    Parameters
+    ----------
+    model : sklearn Pipeline, default None
+        Model of the species.
+
+    input_data_model : pandas DataFrame or scipy.sparse matrix, default None
+        Model input, see contributions.
+
+    top : int, default 10
+        Number of contributing and missing features listed per sample.
+
+    samples : list, default None
+        Sample names, for a matrix (see qc_pipeline.model_input_sparse).
+
+    feature_names : list, default None
+        Feature names of the columns of a matrix (e.g. ref_index.feature_order).
+
+    '''
+    contribution, _ = contributions(model, input_data_model)
+    if isinstance(input_data_model, pd.DataFrame):
+        samples, feature_names = input_data_model.index, input_data_model.columns
+        X = input_data_model.to_numpy(dtype=float)
+    else:
+        X = input_data_model.toarray() if sp.issparse(input_data_model) else np.asarray(input_data_model)
+    feature_names = np.asarray(feature_names, dtype=object)
+
+    values = contribution.to_numpy()
+    n_top = min(top, values.shape[1])
+    order = np.argsort(-np.abs(values), axis=1, kind='stable')[:, :n_top]
+
+    importance = feature_importance(model, X.shape[1])
+    used = importance > 0
+    by_importance = np.argsort(-importance, kind='stable')
+
+    rows = []
+    for i, sample in enumerate(samples):
+        missing = by_importance[(X[i, by_importance] == 0) & used[by_importance]]
+        rows.append({
+            'sample': sample,
+            'top_features': ', '.join('%s (%+.3f)' % (feature_names[j], values[i, j]) for j in order[i] if values[i, j] != 0),
+            'missing': len(missing),
+            'missing_features': ', '.join(map(str, feature_names[missing[:n_top]])),
+        })
+
+    return pd.DataFrame(rows)
@@ -1,3 +1,9 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components, min_weight_full_bipartite_matching
+
+
 # creates the feature name with the mz and rt
 def feature_name_creation(xcms_file_path):
     table = pd.read_csv(xcms_file_path, index_col=[0]) 
@@ -18,6 +24,69 @@ def feature_name_creation(xcms_file_path):
     return table_clean
 
 
+# packed integer key of a feature: the nominal mz in the high bits, the rt in tenths of a minute in the low ones
+KEY_RT_SCALE = 10
+KEY_MZ_SHIFT = 2**32
+MISSING_KEY = -1
+
+# cost of a target left without a reference feature by feature_matching: above the largest score of a
+# pair (sqrt(2), both distances at their tolerance), so a single pair is always taken over no pair
+UNMATCHED_SCORE = 2.0
+
+
+def feature_key(mz, rt):
+    
+    '''
+    
+    Packed int64 key of the features with the given (rounded) mz and rt, the integer counterpart of 
+    the "mz_rt" feature name: two features have the same key if and only if they have the same name.
+    
+    '''
+    
+    mz = np.asarray(mz, dtype=np.int64)
+    rt = np.rint(np.asarray(rt, dtype=float) * KEY_RT_SCALE).astype(np.int64)
+    
+    return mz * KEY_MZ_SHIFT + rt
+
+
+def feature_keys(features):
+    
+    '''
+    
+    Packed keys (see feature_key) of a column of "mz_rt" feature names, MISSING_KEY for a row 
+    without a name. Each distinct name is parsed once.
+    
+    '''
+    
+    codes, names = pd.factorize(np.asarray(features, dtype=object))
+    
+    if len(names) == 0:
+        return np.full(len(codes), MISSING_KEY, dtype=np.int64)
+    
+    parts = pd.Series(names, dtype=str).str.split('_', n=1, expand=True)
+    unique_keys = feature_key(parts[0].astype(np.int64), parts[1].astype(float))
+    
+    return np.where(codes >= 0, unique_keys[codes], MISSING_KEY)
+
+
+def first_by_key(keys, npeaks):
+    
+    '''
+    
+    Positions of the rows kept when the rows with the same key are reduced to the one with the 
+    highest npeaks, in their original order. The ties are broken as sort_values('npeaks', 
+    ascending=False).drop_duplicates would, so the result is the same as the DataFrame version.
+    
+    '''
+    
+    order = pd.Series(np.asarray(npeaks)).sort_values(ascending=False).index.to_numpy()
+    
+    # np.unique gives the first position of each key in the npeaks order
+    _, first = np.unique(keys[order], return_index=True)
+    
+    return np.sort(order[first])
+
+
 # rounds the mz and rt columns along with its min and max
 
 def rounder(dataframe):
@@ -35,44 +104,427 @@ def rounder(dataframe):
     return table
 
 
+def first_interval_match(values, lower, upper):
+    
+    '''
+    
+    For each value, returns the position of the first interval [lower, upper] (in the order 
+    the intervals are given) that contains it, or -1 if no interval does.
+    
+    The interval bounds are sorted once and split into elementary segments (each breakpoint and 
+    the open gap between two breakpoints). Every segment is labeled with the first interval covering 
+    it, so each value is resolved with a single searchsorted instead of a scan over all intervals.
+    
+    
+    Parameters
+    ----------
+    values : array-like, default None
+        Values to be located, e.g. the mz column of the target data.
+    
+    lower : array-like, default None
+        Lower bounds of the intervals, e.g. the mzmin column of the reference data.
+    
+    upper : array-like, default None
+        Upper bounds of the intervals, e.g. the mzmax column of the reference data.
+    
+    '''
+    
+    values = np.asarray(values, dtype=float)
+    lower = np.asarray(lower, dtype=float)
+    upper = np.asarray(upper, dtype=float)
+    
+    # intervals with missing bounds never contain anything (comparisons with nan are False)
+    valid = ~(np.isnan(lower) | np.isnan(upper)) & (lower <= upper)
+    breaks = np.unique(np.concatenate([lower[valid], upper[valid]]))
+    
+    # segment 2k+1 is the breakpoint k itself, segment 2k is the gap just before it
+    owner = np.full(2 * len(breaks) + 1, -1, dtype=np.int64)
+    first = np.searchsorted(breaks, lower[valid]) * 2 + 1
+    last = np.searchsorted(breaks, upper[valid]) * 2 + 1
+    
+    # the intervals are written from the last to the first, so the first one wins the overlaps
+    for j, a, b in zip(np.flatnonzero(valid)[::-1], first[::-1], last[::-1]):
+        owner[a:b + 1] = j
+    
+    position = np.searchsorted(breaks, values)
+    on_break = position < len(breaks)
+    on_break[on_break] = breaks[position[on_break]] == values[on_break]
+    
+    # nan values are sorted past the last breakpoint and land on the (unowned) last segment
+    return owner[position * 2 + on_break]
+
+
 def feature_correspondance (ref_data, target_data):
     
+    '''
+    
+    Generates the feature names on the "mz_rt" pattern on the target_data based on the 
+    feature names on ref_data.
+    
+    For each row of target_data, the first row of ref_data (ordered by npeaks) whose mzmin and mzmax 
+    range contains the target mz is taken. If the rt, rtmin or rtmax of the target falls in the 
+    rtmin and rtmax range of that reference row, its feature name is given to the target row. 
+    Otherwise, the target row is left without a name.
+    
+    The mz lookup is done for all rows at once (see first_interval_match) and the three rt rules are 
+    tested as array operations, so the cost grows with N + M instead of N * M.
+    
+    
+    Parameters
+    ----------
+    ref_data : pandas DataFrame, default None
+        DataFrame object with mz, mzmin, mzmax, rt, rtmin and rtmax columns to use as reference
+        and a feature columns with the feature names in the pattern mz_rt.
+    
+    target_data : pandas DataFrame, default None
+        DataFrame object with mz, mzmin, mzmax, rt, rtmin and rtmax columns to round.
+    
+    '''
+    
     # column to be populated
     target_data['features'] = np.nan
 
     # sorts the values in order to use the feature name of  features with higher npeaks.
     # sometimes, the preprocessing generated 'duplicates' of almost the same feature. We ignore those later on
     target_data = target_data.sort_values('npeaks', ascending=False,ignore_index=True)
-    ref_data = ref_data.sort_values('npeaks', ascending=False,ignore_index=True)
 
-    for i in range(len(target_data)):
-        for j in range(len(ref_data)):
+    # a reference index (see ref_index) is stored already in this order
+    if not ref_data['npeaks'].is_monotonic_decreasing:
+        ref_data = ref_data.sort_values('npeaks', ascending=False,ignore_index=True)
+
+    # the windows of a reference index are float32, the target values are compared at the same precision
+    precision = np.float32 if ref_data['rtmin'].dtype == np.float32 else float
+
+    # FIRST reference row (higher npeaks) with the target mz in its mzmin - mzmax range
+    match = first_interval_match(target_data['mz'].to_numpy(precision), ref_data['mzmin'], ref_data['mzmax'])
+    found = match >= 0
+    ref_rows = match[found]
+    
+    # any rt value from the target data must be in the range of rtmax and rtmin of the reference data.
+    # only the first mz match is tested, there could be multiple matches on rt
+    ref_rtmin = ref_data['rtmin'].to_numpy()[ref_rows]
+    ref_rtmax = ref_data['rtmax'].to_numpy()[ref_rows]
+    
+    in_rt = np.zeros(len(ref_rows), dtype=bool)
+    for column in ['rt', 'rtmin', 'rtmax']:
+        value = target_data[column].to_numpy(precision)[found]
+        in_rt |= (value <= ref_rtmax) & (value >= ref_rtmin)
+    
+    features = np.full(len(target_data), np.nan, dtype=object)
+    features[np.flatnonzero(found)[in_rt]] = ref_data['features'].to_numpy()[ref_rows[in_rt]]
+    target_data['features'] = features
+    
+    return target_data
+
+
+def candidate_pairs(target_mz, ref_mz, mz_window):
+    
+    '''
+    
+    All (target, reference) pairs whose mz differ by at most the mz window of the target, found with 
+    the reference mz sorted once and two searchsorted calls (a one dimensional spatial index). Only 
+    the pairs are built, never the dense target x reference matrix. Returns the target and reference 
+    positions of the pairs.
+    
+    '''
+    
+    order = np.argsort(ref_mz, kind='stable')
+    sorted_mz = ref_mz[order]
+    
+    first = np.searchsorted(sorted_mz, target_mz - mz_window, side='left')
+    last = np.searchsorted(sorted_mz, target_mz + mz_window, side='right')
+    counts = np.maximum(last - first, 0)
+    
+    targets = np.repeat(np.arange(len(target_mz)), counts)
+    # position of each pair in the sorted reference: the run first .. last - 1 of its target
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    
+    return targets, order[np.repeat(first, counts) + offsets]
 
-            # check if mz is in right range.
-            if ((target_data.loc[i,'mz'] <= ref_data.loc[j,'mzmax']) 
-                  & (target_data.loc[i,'mz'] >= ref_data.loc[j,'mzmin'])):
 
-                # if it is, then proceed. Any rt value from the target data must be in the range of 
-                # rtmax and rtmin of the reference data:
+def matching_assignment(targets, refs, score, unmatched):
+    
+    '''
+    
+    best_assignment of one group of candidate pairs, as a minimum weight full bipartite matching 
+    (scipy.sparse.csgraph) of the sparse matrix of their targets x (their references + one 
+    "unmatched" column per target). Returns the positions of the accepted pairs.
+    
+    '''
+    
+    # rows are the targets, columns their references, then the unmatched columns
+    _, pair_rows = np.unique(targets, return_inverse=True)
+    _, pair_columns = np.unique(refs, return_inverse=True)
+    n_rows, n_columns = pair_rows.max() + 1, pair_columns.max() + 1
+    
+    # every row is matched exactly once, so shifting all the weights by one keeps the optimum and no 
+    # weight is zero (a stored zero is not an edge)
+    graph = sparse.csr_matrix((np.concatenate([score + 1.0, np.full(n_rows, unmatched + 1.0)]),
+                               (np.concatenate([pair_rows, np.arange(n_rows)]),
+                                np.concatenate([pair_columns, n_columns + np.arange(n_rows)]))),
+                              shape=(n_rows, n_columns + n_rows))
+    
+    rows, columns = min_weight_full_bipartite_matching(graph)
+    matched = columns < n_columns
+    
+    # position of each matched (row, column) among the pairs
+    pair_keys = pair_rows.astype(np.int64) * n_columns + pair_columns
+    order = np.argsort(pair_keys, kind='stable')
+    
+    return order[np.searchsorted(pair_keys[order], rows[matched].astype(np.int64) * n_columns + columns[matched])]
 
-                if (
-                    ((target_data.loc[i,'rt'] <= ref_data.loc[j,'rtmax']) 
-                      & (target_data.loc[i,'rt'] >= ref_data.loc[j,'rtmin'])) or
 
-                   ((target_data.loc[i,'rtmin'] <= ref_data.loc[j,'rtmax']) 
-                      & (target_data.loc[i,'rtmin'] >= ref_data.loc[j,'rtmin'])) or
+def best_assignment(targets, refs, score, unmatched=UNMATCHED_SCORE):
+    
+    '''
+    
+    One to one assignment of the candidate pairs of lowest total score, each target and reference 
+    used at most once and each target left unmatched at the cost unmatched (an optimal assignment, 
+    not a greedy one from the lowest score). The pairs are split in the connected components of the 
+    target - reference graph, which are assigned independently: a component with a single target or 
+    reference takes its lowest score pair, the others are solved by matching_assignment. Only the candidate pairs are 
+    stored, never the dense target x reference matrix.
+    
+    Returns the positions (in the arguments) of the accepted pairs, sorted.
+    
+    '''
+    
+    if len(score) == 0:
+        return np.array([], dtype=np.int64)
+    
+    _, pair_targets = np.unique(targets, return_inverse=True)
+    _, pair_refs = np.unique(refs, return_inverse=True)
+    n_targets = pair_targets.max() + 1
+    n_nodes = n_targets + pair_refs.max() + 1
+    
+    graph = sparse.coo_matrix((np.ones(len(score)), (pair_targets, n_targets + pair_refs)), shape=(n_nodes, n_nodes))
+    _, labels = connected_components(graph, directed=False)
+    component = labels[pair_targets]
+    
+    size = np.bincount(component)
+    n_components = len(size)
+    
+    # a component with one target (or one reference) takes its lowest score pair, the first one in 
+    # (component, score, position) order; the others need the matching
+    order = np.lexsort((np.arange(len(score)), score, component))
+    first = np.searchsorted(component[order], np.arange(n_components), side='left')
+    star = ((np.bincount(labels[:n_targets], minlength=n_components) == 1)
+            | (np.bincount(labels[n_targets:], minlength=n_components) == 1))
+    accepted = [order[first[star]]]
+    
+    for start in first[~star]:
+        pairs = order[start:start + size[component[order[start]]]]
+        accepted.append(pairs[matching_assignment(targets[pairs], refs[pairs], score[pairs], unmatched)])
+    
+    return np.sort(np.concatenate(accepted))
 
-                   ((target_data.loc[i,'rtmax'] <= ref_data.loc[j,'rtmax']) 
-                    & (target_data.loc[i,'rtmax'] >= ref_data.loc[j,'rtmin']))
-                ):
 
-                    # if the condition is met, then the FIRST feature name is extracted and given to the target data.
-                    # The one with higher npeak will be used, due to sorting at the beggining
-                    target_data.loc[i,'features'] = ref_data.loc[j,'features']
-                    
-                # this brakes the second if statement. There could be multiple matches on rt 
-                break
+def feature_matching(ref_data, target_data, mz_tol=0.5, rt_tol=0.5, ppm=None):
+    
+    '''
+    
+    Tolerance based alternative to feature_correspondance. The target rows get the names of the 
+    reference features within the given tolerances in mz and rt, and each reference feature is given 
+    to one target row at most: a target peak is not left out because another reference window came 
+    first, and two target peaks never claim the same name (the duplicates data_cleaning would drop).
+    
+    The candidate pairs are found with a sorted mz index (see candidate_pairs), scored by their 
+    distance in units of the tolerances, sqrt((dmz / mz window)^2 + (drt / rt_tol)^2), and assigned 
+    one to one with the lowest total distance over all the pairs (see best_assignment), rather than 
+    greedily from the closest pair, which can leave a worse total. The memory grows with the number 
+    of candidate pairs, not with N x M. The result has the same layout as the one of 
+    feature_correspondance.
+    
+    
+    Parameters
+    ----------
+    ref_data : pandas DataFrame, default None
+        DataFrame object with mz and rt columns to use as reference and a features column with the 
+        feature names in the pattern mz_rt.
+    
+    target_data : pandas DataFrame, default None
+        DataFrame object with mz and rt columns (after rounder: rt in minutes) and npeaks.
+    
+    mz_tol : float, default 0.5
+        m/z tolerance in Da.
+    
+    rt_tol : float, default 0.5
+        rt tolerance, in the unit of the rt columns (minutes).
+    
+    ppm : float, default None
+        m/z tolerance in ppm of the reference mz. If both are given, the larger window is used.
+    
+    '''
+    
+    # same order as feature_correspondance, so the next steps see the rows as they would
+    target_data = target_data.sort_values('npeaks', ascending=False,ignore_index=True)
+    
+    target_mz = target_data['mz'].to_numpy(dtype=float)
+    target_rt = target_data['rt'].to_numpy(dtype=float)
+    ref_mz = ref_data['mz'].to_numpy(dtype=float)
+    ref_rt = ref_data['rt'].to_numpy(dtype=float)
+    
+    # the ppm window is the one of the reference mz; twice the window of the target mz covers it for the search
+    if ppm is None:
+        search_window = np.full(len(target_mz), mz_tol, dtype=float)
+    else:
+        search_window = np.maximum(mz_tol or 0.0, target_mz * ppm * 2e-6)
+    
+    targets, refs = candidate_pairs(target_mz, ref_mz, search_window)
+    
+    mz_window = np.full(len(refs), mz_tol, dtype=float) if ppm is None else np.maximum(mz_tol or 0.0, ref_mz[refs] * ppm * 1e-6)
+    d_mz = np.abs(target_mz[targets] - ref_mz[refs])
+    d_rt = np.abs(target_rt[targets] - ref_rt[refs])
+    
+    keep = (d_mz <= mz_window) & (d_rt <= rt_tol)
+    targets, refs = targets[keep], refs[keep]
+    score = np.hypot(d_mz[keep] / np.where(mz_window[keep] > 0, mz_window[keep], 1.0), 
+                     d_rt[keep] / (rt_tol if rt_tol > 0 else 1.0))
+    
+    accepted = best_assignment(targets, refs, score)
+    
+    features = np.full(len(target_data), np.nan, dtype=object)
+    features[targets[accepted]] = ref_data['features'].to_numpy()[refs[accepted]]
+    target_data['features'] = features
+    
     return target_data
 
 
+def data_cleaning(ref_data, target_data):
+        
+    '''
+    
+    The process that creates the feature can generate duplicate names. The filtering is done by sorting the
+    dataframes based on the npeaks columns and  dropping the duplicates, keeping the one with the higher npeaks
+    
+    The function also drops unnecessary columns such as 'mz', 'mzmin', 'mzmax', 'rt','rtmin', 'rtmax', 
+    'npeaks','NEG_GROUP' and 'POS_GROUP' at the end of the process.
+    
+    
+    Parameters
+    ----------
+    ref_data : pandas DataFrame, default None
+        DataFrame object used as reference on the feature_correspondance function.
+    
+    target_data : pandas DataFrame, default None
+        DataFrame object that passed trough the feature_correspondance function.
+    
+    '''   
+        
+    # the removal is based on the npeaks column. The feature with more npeaks, is kept.
+    # the names are compared as packed integer keys (see feature_keys) instead of strings
+    target_data = target_data.iloc[first_by_key(feature_keys(target_data['features']), target_data['npeaks'])]
+    ref_data = ref_data.iloc[first_by_key(feature_keys(ref_data['features']), ref_data['npeaks'])]
+    
+    if not target_data.index.is_monotonic_increasing:
+        target_data = target_data.sort_index()
+    if not ref_data.index.is_monotonic_increasing:
+        ref_data = ref_data.sort_index()
+
+    # dropping unnecessary columns
+    target_data = target_data.drop(['mz', 'mzmin', 'mzmax', 'rt', 
+                                  'rtmin', 'rtmax', 'npeaks'], axis=1)
+
+    # NEG_GROUP and POS_GROUP are not in a reference index
+    ref_data = ref_data.drop(['mz', 'mzmin', 'mzmax', 'rt', 
+                                      'rtmin', 'rtmax', 'npeaks','NEG_GROUP', 'POS_GROUP'], axis=1, errors='ignore')
+    
+    return ref_data, target_data
+
+def data_prep(ref_data,target_data):
+        
+    '''
+    
+    During the process that creates the feature (using feature_correspondance function), 
+    the ref_data is used to create the feature names on target_data. However, the target_data
+    might not have, for a given feature on ref_data, a good correspondance. In such cases, the 
+    feature name is set to NAN. These features need to be dropped. 
+    
+    For the ref_data, then, some feature_names won't appear in target_data and since both need to
+    contain the same feautures, these also need to be dropped.
+    
+    The purpose of the function is to make both datasets equal in terms of features. The same number 
+    and types of features need to appear in both datasets as the ref_data was used for the training 
+    and the target_data will go trough the prediction steps.
+    
+        
+    Parameters
+    ----------
+    ref_data : pandas DataFrame, default None
+        DataFrame object used as reference on the feature_correspondance function.
+    
+    target_data : pandas DataFrame, default None
+        DataFrame object that passed trough the feature_correspondance function.
+    
+    '''   
+    
+    
+    # val set might have some feature that don't fit in any range - their feature names will be nan, so need to remove
+    # train might have some features that wont appear in the val. So, create them in val and set them to zero. 
+    # the features are matched as packed integer keys (see feature_keys), the names are only taken for the result
+    
+    target_data = target_data.dropna() # dropping na
+    samples = target_data.columns.drop('features').sort_values()
+    
+    ref_keys = feature_keys(ref_data['features'])
+    target_keys = feature_keys(target_data['features'])
+    
+    # reference features with no row in target_data are added with zero intensities
+    missing = np.flatnonzero(~np.isin(ref_keys, target_keys) & (ref_keys != MISSING_KEY))
+    _, first = np.unique(ref_keys[missing], return_index=True)
+    missing = missing[first]
+    
+    names = np.concatenate([target_data['features'].to_numpy(dtype=object), ref_data['features'].to_numpy(dtype=object)[missing]])
+    values = np.vstack([target_data[samples].to_numpy(dtype=float), np.zeros((len(missing), len(samples)))])
+    
+    # order both val and train features equally
+    # sort the features - the model needs them at the same sequence
+    order = np.argsort(names.astype(str), kind='stable')
+    
+    target_data = pd.DataFrame(values[order], index=order, columns=samples)
+    target_data.insert(0, 'index', names[order])
+    
+    return target_data
 
+
+def data_prep_sparse(ref_data, target_data):
+        
+    '''
+    
+    Same result as data_prep followed by the transposition into samples x features, built directly as 
+    a SciPy CSR matrix of float32 instead of a dense DataFrame. The features are the ones of ref_data, 
+    sorted (the order the model expects), and only the intensities of the features found in target_data 
+    are stored: the features without correspondance are the implicit zeros of the sparse matrix, so 
+    nothing is concatenated, filled or transposed.
+    
+    Returns the sample names, the feature names and the matrix.
+    
+        
+    Parameters
+    ----------
+    ref_data : pandas DataFrame, default None
+        DataFrame object used as reference on the feature_correspondance function.
+    
+    target_data : pandas DataFrame, default None
+        DataFrame object that passed trough the data_cleaning function.
+    
+    '''   
+    
+    features, first = np.unique(ref_data['features'].astype(str), return_index=True)
+    feature_column_keys = feature_keys(ref_data['features'])[first]
+    
+    # as in data_prep, rows without a feature name (or with a missing intensity) are dropped
+    target_data = target_data.dropna()
+    # the concatenation of data_prep (sort=True) also sorts the sample columns
+    samples = target_data.columns.drop('features').sort_values()
+    
+    # column of each target row in the model input, found by key; the rows are samples, so the peak table is read transposed
+    sorter = np.argsort(feature_column_keys)
+    columns = sorter[np.searchsorted(feature_column_keys, feature_keys(target_data['features']), sorter=sorter)]
+    values = target_data[samples].to_numpy(dtype=np.float32).T
+    
+    rows, position = np.nonzero(values)
+    matrix = sparse.csr_matrix((values[rows, position], (rows, columns[position])), 
+                               shape=(len(samples), len(features)), dtype=np.float32)
+    
+    return samples, features, matrix
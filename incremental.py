@@ -0,0 +1,217 @@
+'''
+
+Incremental classification: new batches of mzXML files are added to a store without reprocessing
+the files already in it.
+
+Instead of aligning and grouping all the files together (retcor/group/fillPeaks over the whole
+history), the peaks of each new file (xcmsSet, cached per file by xcms_parallel) are matched directly
+against the reference feature windows (the mz/rt ranges of ref_data_*.csv) with feature_correspondance.
+The intensity of each reference feature in the file becomes one column of the feature matrix, so the
+cost of a batch depends only on the number of files in it.
+
+The values are not exactly the ones of the grouped run (no fillPeaks: a feature that is not detected
+in a file is 0, and there is no retcor: the retention time windows of the reference absorb the drift,
+or each new file is aligned on its own to the reference profile of the species with rt_align).
+
+'''
+
+import datetime
+import os
+
+import pandas as pd
+
+import feature_eng
+import rt_align
+import xcms_parallel
+
+SAMPLE_COLUMNS = ['hash', 'name', 'class', 'batch', 'file', 'added']
+
+
+def reference_features(ref_data):
+    '''
+    feature names of the reference in the order of the model input (as data_prep sorts them).
+    '''
+    return sorted(ref_data['features'].unique())
+
+
+def feature_intensities(ref_data, peaks, value='into'):
+    '''
+
+    Builds the samples x features matrix from per file peak lists, in the order of the model input.
+    All files are matched in one feature_correspondance call and reduced with one pivot. A reference
+    feature not found in a file is 0 (as data_prep fills it).
+
+
+    Parameters
+    ----------
+    ref_data : pandas DataFrame, default None
+        Data used for training, as returned by qc_pipeline.load_reference.
+
+    peaks : pandas DataFrame, default None
+        Peaks of xcmsSet (mz, mzmin, mzmax, rt, rtmin, rtmax in seconds, and the intensity column)
+        of every file, with the file identifier (one row of the result per value) in a sample column.
+
+    value : str, default 'into'
+        Intensity column of the peaks used as the feature value.
+
+    '''
+    table = peaks[['mz', 'mzmin', 'mzmax', 'rt', 'rtmin', 'rtmax', value, 'sample']].copy()
+
+    # a single file has no npeaks (number of files with the peak), so all peaks have the same priority
+    table['npeaks'] = 1
+
+    table = feature_eng.feature_correspondance(ref_data, feature_eng.rounder(table))
+    table = table.dropna(subset=['features'])
+
+    # more than one peak of a file can fall in a reference window, the most intense is kept
+    matrix = table.pivot_table(index='sample', columns='features', values=value, aggfunc='max')
+
+    return matrix.reindex(columns=reference_features(ref_data)).fillna(0)
+
+
+class IncrementalStore:
+    '''
+
+    Folder holding the feature matrix of every file processed so far, one parquet file per batch,
+    and a samples.csv index (file hash, sample name and class, batch). Adding a batch only writes
+    its own matrix and appends its rows to the index.
+
+
+    Parameters
+    ----------
+    root : str, default None
+        Folder of the store. Created if it does not exist.
+
+    ref_data : pandas DataFrame, default None
+        Data used for training. The store is tied to its features: opening it with a reference
+        that has other features raises a ValueError.
+
+    rt_reference : dict, default None
+        Reference profile of the species (see rt_align.load_reference). If given, the retention
+        times of the peaks of each new file are aligned to it before the matching. The store is
+        tied to its alignment as to its features.
+
+    '''
+
+    def __init__(self, root, ref_data, rt_reference=None):
+        self.root = root
+        self.ref_data = ref_data
+        self.rt_reference = rt_reference
+        self.features = reference_features(ref_data)
+
+        os.makedirs(os.path.join(root, 'batches'), exist_ok=True)
+
+        features_file = os.path.join(root, 'features.txt')
+        if os.path.exists(features_file):
+            with open(features_file) as stored:
+                if stored.read().split('\n')[:-1] != self.features:
+                    raise ValueError('The store %s was built with another reference data.' % root)
+        else:
+            with open(features_file, 'w') as stored:
+                stored.write(''.join(feature + '\n' for feature in self.features))
+
+        # the files of a store built before the alignment was recorded were not aligned
+        alignment = 'reference %s' % rt_reference['hash'] if rt_reference is not None else 'none'
+        alignment_file = os.path.join(root, 'alignment.txt')
+        if os.path.exists(alignment_file) or os.path.exists(self.samples_file):
+            stored = 'none'
+            if os.path.exists(alignment_file):
+                with open(alignment_file) as stored_file:
+                    stored = stored_file.read().strip()
+            if stored != alignment:
+                raise ValueError('The store %s was built with another retention time alignment (%s).' % (root, stored))
+        else:
+            with open(alignment_file, 'w') as stored_file:
+                stored_file.write(alignment + '\n')
+
+    @property
+    def samples_file(self):
+        return os.path.join(self.root, 'samples.csv')
+
+    def batch_file(self, batch):
+        return os.path.join(self.root, 'batches', batch + '.parquet')
+
+    def samples(self):
+        '''
+        index of the files already in the store.
+        '''
+        if not os.path.exists(self.samples_file):
+            return pd.DataFrame(columns=SAMPLE_COLUMNS)
+        return pd.read_csv(self.samples_file, dtype={'batch': str})
+
+    def add_batch(self, folder, params, batch=None, n_jobs=None, cache_dir=xcms_parallel.DEFAULT_CACHE_DIR):
+        '''
+
+        Runs the peak detection on the mzXML files under folder that are not in the store yet (by
+        content) and stores their feature matrix. Returns the matrix of the new files only
+        (samples x features, ready for predict_proba), empty if every file was already known.
+
+
+        Parameters
+        ----------
+        folder : str, default None
+            Folder with the mzXML files of the batch (one subfolder per sample).
+
+        params : dict, default None
+            xcms parameters of the species, e.g. xcms_params.PARAMS['mikania'].
+
+        batch : str, default None
+            Name of the batch. The current date and time if None, and added to the name if a
+            batch with the same name is already in the store.
+
+        n_jobs : int, default None
+            Number of parallel R processes of the peak detection.
+
+        cache_dir : str, default cache/peaks
+            Cache of the per file peak detection.
+
+        '''
+        # files already processed are cache hits of the peak detection, only their hash is computed
+        samples = xcms_parallel.detect_peaks(xcms_parallel.find_mzxml(folder), params,
+                                             n_jobs=n_jobs, cache_dir=cache_dir)
+        samples = samples[~samples['hash'].isin(self.samples()['hash'])].drop_duplicates('hash')
+
+        if len(samples) == 0:
+            return pd.DataFrame(columns=self.features, dtype=float)
+
+        now = datetime.datetime.now()
+        batch = batch or now.strftime('%Y%m%d_%H%M%S')
+        if os.path.exists(self.batch_file(batch)):
+            batch = '%s_%s' % (batch, now.strftime('%Y%m%d_%H%M%S'))
+
+        peaks = [pd.read_csv(prefix + '.csv').assign(sample=file_hash)
+                 for prefix, file_hash in zip(samples['prefix'], samples['hash'])]
+
+        if self.rt_reference is not None:
+            warps = rt_align.warp_files(list(samples['file']), self.rt_reference, n_jobs=n_jobs)
+            for file_peaks, path in zip(peaks, samples['file']):
+                for column in ('rt', 'rtmin', 'rtmax'):
+                    file_peaks[column] = rt_align.warp_rt(file_peaks[column], warps[path])
+
+        peaks = pd.concat(peaks, ignore_index=True)
+
+        matrix = feature_intensities(self.ref_data, peaks)
+
+        # files with no peak in any reference window still get a (zero) row
+        matrix = matrix.reindex(samples['hash']).fillna(0)
+        matrix.index = pd.Index(samples['name'], name='sample')
+        matrix.to_parquet(self.batch_file(batch))
+
+        index = samples.assign(batch=batch, added=now.isoformat(timespec='seconds'))
+        index[SAMPLE_COLUMNS].to_csv(self.samples_file, mode='a', index=False,
+                                     header=not os.path.exists(self.samples_file))
+
+        return matrix
+
+    def matrix(self, batches=None):
+        '''
+        feature matrix of the given batches (all of them if None), one row per file.
+        '''
+        if batches is None:
+            batches = self.samples()['batch'].unique()
+
+        matrices = [pd.read_parquet(self.batch_file(batch)).assign(batch=batch) for batch in batches]
+        if not matrices:
+            return pd.DataFrame(columns=self.features, dtype=float)
+
+        return pd.concat(matrices).set_index('batch', append=True)[self.features]
@@ -0,0 +1,126 @@
+'''
+
+Streaming ingestion of the uploaded zip folders.
+
+The upload is copied to disk in chunks (spool_upload) and the mzXML members are then extracted one
+at a time, also in chunks (extract_mzxml_zip), so a multi GB archive never has to be held in memory.
+Other members (e.g. __MACOSX metadata, notes, raw files) are skipped, paths leaving the output folder
+are refused and the size of each file and of the whole upload is limited.
+
+'''
+
+import os
+import shutil
+import tempfile
+import zipfile
+
+CHUNK_SIZE = 2**20
+
+MAX_FILE_BYTES = 2 * 2**30
+MAX_TOTAL_BYTES = 50 * 2**30
+
+
+class UploadError(ValueError):
+    '''
+    raised when an upload can not be ingested (too large, unsafe paths or no mzXML file).
+    '''
+
+
+def spool_upload(upload, directory=None, chunk_size=CHUNK_SIZE):
+    '''
+
+    Copies an uploaded file object (e.g. the streamlit UploadedFile) to a temporary file on disk, in
+    chunks, and returns its path. The caller removes the file when done.
+
+    '''
+    if hasattr(upload, 'seek'):
+        upload.seek(0)
+
+    fd, path = tempfile.mkstemp(suffix='.zip', dir=directory)
+    with os.fdopen(fd, 'wb') as spool:
+        shutil.copyfileobj(upload, spool, chunk_size)
+
+    return path
+
+
+def is_mzxml(info):
+    '''
+    whether a zip member is an mzXML file (and not a folder or the macOS resource fork of one).
+    '''
+    name = info.filename.replace('\\', '/')
+    return (not info.is_dir() and name.lower().endswith('.mzxml')
+            and not name.startswith('__MACOSX/') and not os.path.basename(name).startswith('._'))
+
+
+def extract_mzxml_zip(zip_file, output_folder, max_file_bytes=MAX_FILE_BYTES, max_total_bytes=MAX_TOTAL_BYTES,
+                      progress=None, chunk_size=CHUNK_SIZE):
+    '''
+
+    Extracts the mzXML members of a zip into output_folder, one member at a time and in chunks.
+    Returns the paths of the extracted files.
+
+
+    Parameters
+    ----------
+    zip_file : str or file object, default None
+        Zipped folder, ideally a path on disk (see spool_upload).
+
+    output_folder : str, default None
+        Folder to extract into, created if needed. The folder structure of the zip is kept, since
+        xcms uses it for the sample classes.
+
+    max_file_bytes : int, default 2 GB
+        Largest accepted mzXML file (uncompressed).
+
+    max_total_bytes : int, default 50 GB
+        Largest accepted total of the mzXML files (uncompressed).
+
+    progress : callable, default None
+        Called as progress(done_bytes, total_bytes, member_name) after each chunk.
+
+    '''
+    output_folder = os.path.abspath(output_folder)
+    os.makedirs(output_folder, exist_ok=True)
+
+    extracted = []
+
+    with zipfile.ZipFile(zip_file, 'r') as zip_ref:
+        members = [info for info in zip_ref.infolist() if is_mzxml(info)]
+
+        if not members:
+            raise UploadError('The zip folder has no mzXML file.')
+
+        # the sizes in the zip directory are checked first, so a too large upload fails before extracting anything
+        for info in members:
+            if info.file_size > max_file_bytes:
+                raise UploadError('%s is larger than the limit of %d MB per file.' % (info.filename, max_file_bytes // 2**20))
+
+        total_bytes = sum(info.file_size for info in members)
+        if total_bytes > max_total_bytes:
+            raise UploadError('The upload is larger than the limit of %d MB.' % (max_total_bytes // 2**20))
+
+        done_bytes = 0
+        for info in members:
+            target = os.path.abspath(os.path.join(output_folder, info.filename))
+            if os.path.commonpath([output_folder, target]) != output_folder:
+                raise UploadError('%s is outside of the zip folder.' % info.filename)
+
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+
+            # the declared sizes are not trusted while extracting: the written bytes are counted too
+            written = 0
+            with zip_ref.open(info) as source, open(target, 'wb') as destination:
+                for chunk in iter(lambda: source.read(chunk_size), b''):
+                    written += len(chunk)
+                    if written > max_file_bytes or done_bytes + len(chunk) > max_total_bytes:
+                        raise UploadError('%s is larger than declared in the zip folder.' % info.filename)
+
+                    destination.write(chunk)
+                    done_bytes += len(chunk)
+
+                    if progress is not None:
+                        progress(done_bytes, total_bytes, info.filename)
+
+            extracted.append(target)
+
+    return extracted
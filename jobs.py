@@ -0,0 +1,290 @@
+'''
+
+Background preprocessing jobs, so a long xcms run does not hold the Streamlit session.
+
+A submitted upload becomes a row of a SQLite job table and is processed by a small pool of worker
+threads, each job in its own working directory (no two users share the output folder). The R output
+is appended to the job log while it runs and the progress is written to the table, so the app only
+has to poll the job: a page refresh or a reconnect finds it again by its id. Jobs left queued or
+running when the process stopped are queued again on the next start.
+
+Usage:
+
+    queue = JobQueue()
+    job_id = queue.submit(zip_path, 'mikania')
+    queue.get(job_id)['status']          # queued, running, done or failed
+    queue.log(job_id)
+    csv_file, input_data = queue.result(job_id)
+
+'''
+
+import datetime
+import json
+import os
+import re
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import peak_table
+import qc_pipeline
+import tracing
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_ROOT = os.path.join(BASE_DIR, 'cache', 'jobs')
+DEFAULT_WORKERS = 2
+# seconds between two writes of the last R output line to the job table
+LOG_UPDATE_INTERVAL = 1.0
+
+STATUSES = ['queued', 'running', 'done', 'failed']
+
+PEAKS_PROGRESS = re.compile(r'^xcmsSet (\d+)/(\d+)')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    species TEXT NOT NULL,
+    backend TEXT NOT NULL,
+    n_jobs INTEGER,
+    alignment TEXT,
+    status TEXT NOT NULL,
+    progress REAL NOT NULL DEFAULT 0,
+    message TEXT NOT NULL DEFAULT '',
+    csv_file TEXT,
+    cached INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    created TEXT NOT NULL,
+    started TEXT,
+    finished TEXT,
+    trace TEXT
+)
+'''
+
+
+def now():
+    return datetime.datetime.now().isoformat(timespec='seconds')
+
+
+class JobQueue:
+    '''
+
+    Persistent queue of preprocessing jobs with a pool of worker threads.
+
+
+    Parameters
+    ----------
+    root : str, default cache/jobs
+        Folder of the job table (jobs.sqlite) and of one working directory per job.
+
+    max_workers : int, default 2
+        Number of jobs processed at the same time.
+
+    cache : xcms_cache.PeakTableCache, default None
+        Cache of peak tables passed to qc_pipeline.preprocess.
+
+    install : bool, default True
+        Whether the workers install the Bioconductor packages, for the species that need it.
+
+    '''
+
+    def __init__(self, root=DEFAULT_ROOT, max_workers=DEFAULT_WORKERS, cache=None, install=True):
+        self.root = root
+        self.cache = cache
+        self.install = install
+        self.db_file = os.path.join(root, 'jobs.sqlite')
+        self._lock = threading.Lock()
+
+        os.makedirs(root, exist_ok=True)
+        with self._connect() as db:
+            db.execute(SCHEMA)
+            # job tables made before the traces and the alignment were recorded
+            columns = [row[1] for row in db.execute('PRAGMA table_info(jobs)')]
+            for column in ('trace', 'alignment'):
+                if column not in columns:
+                    db.execute('ALTER TABLE jobs ADD COLUMN %s TEXT' % column)
+
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='xcms-job')
+
+        # jobs interrupted by a restart are run again
+        for job in self.jobs(statuses=['queued', 'running']):
+            self._update(job['id'], status='queued', progress=0, message='queued again after a restart')
+            self._pool.submit(self._run, job['id'])
+
+    def _connect(self):
+        return sqlite3.connect(self.db_file, timeout=30)
+
+    def _update(self, job_id, **values):
+        columns = ', '.join('%s = ?' % column for column in values)
+        with self._lock, self._connect() as db:
+            db.execute('UPDATE jobs SET %s WHERE id = ?' % columns, list(values.values()) + [job_id])
+
+    def job_dir(self, job_id):
+        return os.path.join(self.root, job_id)
+
+    def upload_path(self, job_id):
+        return os.path.join(self.job_dir(job_id), 'upload.zip')
+
+    def log_path(self, job_id):
+        return os.path.join(self.job_dir(job_id), 'job.log')
+
+    def submit(self, upload, species, backend='r', n_jobs=None, alignment=None):
+        '''
+
+        Queues the preprocessing of an upload and returns the job id. upload is the path of a zip
+        on disk (e.g. from ingest.spool_upload): it is moved into the job directory. backend, n_jobs
+        and alignment are passed to qc_pipeline.preprocess.
+
+        '''
+        qc_pipeline.get_species(species)
+
+        job_id = uuid.uuid4().hex[:16]
+        os.makedirs(self.job_dir(job_id))
+        shutil.move(upload, self.upload_path(job_id))
+
+        with self._lock, self._connect() as db:
+            db.execute('INSERT INTO jobs (id, species, backend, n_jobs, alignment, status, created) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                       (job_id, species, backend, n_jobs, alignment, 'queued', now()))
+
+        self._pool.submit(self._run, job_id)
+
+        return job_id
+
+    def _run(self, job_id):
+        trace = tracing.Trace('job %s' % job_id)
+        try:
+            csv_file, stdout = self._preprocess(job_id, trace)
+        except Exception as error:
+            # any error of the job (also an unknown species or a missing upload) fails it, none leaves it running
+            try:
+                with open(self.log_path(job_id), 'a') as log_file:
+                    log_file.write('%s: %s\n' % (type(error).__name__, error))
+            except OSError:
+                pass
+            self._update(job_id, status='failed', error=str(error), finished=now(), trace=trace.to_json())
+            return
+
+        self._update(job_id, status='done', progress=1, message='done', csv_file=csv_file,
+                     cached=int(stdout is None), finished=now(), trace=trace.to_json())
+
+        try:
+            os.remove(self.upload_path(job_id))
+        except FileNotFoundError:
+            pass
+
+    def _preprocess(self, job_id, trace):
+        '''
+        runs qc_pipeline.preprocess for a job in its working directory, recording the stages in trace.
+        '''
+        job = self.get(job_id)
+        if job is None:
+            raise KeyError('No job %s.' % job_id)
+        species = qc_pipeline.get_species(job['species'])
+        output_folder = os.path.join(self.job_dir(job_id), 'data')
+
+        # a job run again after a restart starts from a clean folder
+        shutil.rmtree(output_folder, ignore_errors=True)
+        self._update(job_id, status='running', started=now(), progress=0, message='extracting')
+
+        with open(self.log_path(job_id), 'a', buffering=1) as log_file:
+
+            def progress(done_bytes, total_bytes, name):
+                # the extraction is shown as the first 10 %, the table is written only per percent
+                percent = int(100 * done_bytes / total_bytes)
+                if percent != progress.percent:
+                    progress.percent = percent
+                    self._update(job_id, progress=percent / 1000, message='extracting %s' % name)
+            progress.percent = -1
+
+            def log(line):
+                log_file.write(line + '\n')
+
+                # the parallel peak detection reports each file, the rest of the run has no measurable progress.
+                # xcms prints thousands of lines: the table only gets the last one every LOG_UPDATE_INTERVAL
+                files = PEAKS_PROGRESS.match(line)
+                if files:
+                    self._update(job_id, progress=0.1 + 0.8 * int(files.group(1)) / int(files.group(2)), message=line[-200:])
+                elif time.monotonic() - log.updated < LOG_UPDATE_INTERVAL:
+                    return
+                else:
+                    self._update(job_id, message=line[-200:])
+                log.updated = time.monotonic()
+            log.updated = float('-inf')
+
+            with tracing.activate(trace):
+                csv_file, _, stdout = qc_pipeline.preprocess(
+                    self.upload_path(job_id), species, output_folder, cache=self.cache, n_jobs=job['n_jobs'],
+                    install=self.install, progress=progress, backend=job['backend'], log=log,
+                    alignment=job['alignment'])
+
+        return csv_file, stdout
+
+    def get(self, job_id):
+        '''
+        the row of a job as a dict, or None if there is no such job.
+        '''
+        with self._connect() as db:
+            db.row_factory = sqlite3.Row
+            row = db.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+
+        return dict(row) if row is not None else None
+
+    def jobs(self, statuses=None, limit=None):
+        '''
+        rows of the jobs (newest first), optionally only the ones with the given statuses.
+        '''
+        query = 'SELECT * FROM jobs'
+        args = []
+        if statuses:
+            query += ' WHERE status IN (%s)' % ', '.join('?' * len(statuses))
+            args += list(statuses)
+        query += ' ORDER BY created DESC'
+        if limit:
+            query += ' LIMIT %d' % limit
+
+        with self._connect() as db:
+            db.row_factory = sqlite3.Row
+            return [dict(row) for row in db.execute(query, args)]
+
+    def log(self, job_id, tail=None):
+        '''
+        the log of a job (its last tail lines if given).
+        '''
+        try:
+            with open(self.log_path(job_id), errors='replace') as log_file:
+                lines = log_file.readlines()
+        except FileNotFoundError:
+            return ''
+
+        return ''.join(lines[-tail:] if tail else lines)
+
+    def result(self, job_id):
+        '''
+        file path and peak table (as qc_pipeline.read_peak_table returns it) of a finished job.
+        '''
+        job = self.get(job_id)
+        if job is None or job['status'] != 'done':
+            raise ValueError('Job %s is not done.' % job_id)
+
+        # a table of the peak table cache is stored already without the sample class columns
+        job_dir = os.path.abspath(self.job_dir(job_id))
+        if os.path.commonpath([os.path.abspath(job['csv_file']), job_dir]) != job_dir:
+            return job['csv_file'], peak_table.read_table(job['csv_file'])
+
+        return qc_pipeline.read_peak_table(os.path.join(job_dir, 'data'))
+
+    def trace(self, job_id):
+        '''
+        the tracing.Trace of the stages of a finished job, or None.
+        '''
+        job = self.get(job_id)
+        if job is None or not job['trace']:
+            return None
+
+        return tracing.Trace.from_dict(json.loads(job['trace']))
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait=wait)
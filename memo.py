@@ -0,0 +1,186 @@
+'''
+
+Memoization of the pipeline functions that take and return DataFrames.
+
+The arguments are identified by a content fingerprint (pandas hash_pandas_object over the values and
+the index, plus the column names and dtypes), not by object identity, so the same peak table uploaded
+again or reread from the cache is a hit. Results are copied when stored and again when returned:
+a caller modifying its result (rounder and feature_correspondance write into their input) can not
+change what another session gets. The stored results are limited in bytes and evicted in least
+recently used order.
+
+Usage:
+
+    features = Memo(max_bytes=2**29)
+    model_input = features.memoize(qc_pipeline.model_input)
+    model_input(ref_data, input_data)
+    features.stats()    # {'hits': 0, 'misses': 1, ...}
+
+'''
+
+import collections
+import copy
+import functools
+import hashlib
+import threading
+
+import numpy as np
+import pandas as pd
+
+DEFAULT_MAX_BYTES = 512 * 2**20
+
+
+def fingerprint(value):
+    '''
+    hex digest identifying the content of a DataFrame, Series, array or plain (picklable by repr) value.
+    '''
+    h = hashlib.sha1()
+
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        h.update(type(value).__name__.encode())
+        h.update(pd.util.hash_pandas_object(value, index=True).to_numpy().tobytes())
+        if isinstance(value, pd.DataFrame):
+            h.update(repr(list(value.columns)).encode())
+            h.update(repr(list(value.dtypes.astype(str))).encode())
+        else:
+            h.update(repr((value.name, str(value.dtype))).encode())
+    elif isinstance(value, np.ndarray):
+        h.update(repr((value.dtype.str, value.shape)).encode())
+        h.update(np.ascontiguousarray(value).tobytes())
+    else:
+        h.update(repr(value).encode())
+
+    return h.hexdigest()
+
+
+def size_of(value):
+    '''
+    approximate size in bytes of a result.
+    '''
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(index=True, deep=True))
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, tuple):
+        return sum(size_of(item) for item in value)
+    return 64
+
+
+def frozen_copy(value):
+    '''
+    deep copy of a result, so the stored one is never shared with a caller.
+    '''
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return value.copy(deep=True)
+    if isinstance(value, tuple):
+        return tuple(frozen_copy(item) for item in value)
+    return copy.deepcopy(value)
+
+
+class Memo:
+    '''
+
+    Least recently used store of function results, shared by the functions it memoizes and safe to
+    use from several threads (streamlit sessions).
+
+
+    Parameters
+    ----------
+    max_bytes : int, default 512 MB
+        Size of the stored results above which the least recently used are removed. A result
+        larger than this is returned but not stored.
+
+    '''
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, func, args, kwargs):
+        '''
+        key of a call: the function and the fingerprints of its arguments.
+        '''
+        parts = [func.__module__, func.__qualname__]
+        parts += [fingerprint(arg) for arg in args]
+        parts += ['%s=%s' % (name, fingerprint(kwargs[name])) for name in sorted(kwargs)]
+        return hashlib.sha1('\0'.join(parts).encode()).hexdigest()
+
+    def get(self, key):
+        '''
+        copy of the result stored under key, or None.
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+
+        return frozen_copy(entry[0])
+
+    def put(self, key, value):
+        '''
+        stores a copy of value under key and evicts the least recently used results if needed.
+        '''
+        size = size_of(value)
+        if size > self.max_bytes:
+            return
+
+        value = frozen_copy(value)
+
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+
+            self._entries[key] = (value, size)
+            self._bytes += size
+
+            while self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def memoize(self, func):
+        '''
+        decorator: calls with the same argument contents return (a copy of) the stored result.
+        '''
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = self.key(func, args, kwargs)
+
+            result = self.get(key)
+            if result is None:
+                result = func(*args, **kwargs)
+                self.put(key, result)
+
+            return result
+
+        wrapper.memo = self
+        return wrapper
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        '''
+        dict with the hits, misses, evictions, number of stored results and their size in bytes.
+        '''
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+            }
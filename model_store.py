@@ -0,0 +1,206 @@
+'''
+
+Model artifacts loaded without a full pickle.load.
+
+A species model is stored as an uncompressed joblib file (model_*.joblib) next to its pickle. The
+NumPy arrays of the estimators (e.g. the training samples and the tree of a KNeighborsClassifier)
+are kept as raw buffers in that file and are memory mapped, read only, when it is loaded: they are
+not copied, and their pages are shared between the processes serving the app. (The trees of a
+random forest are still rebuilt from their arrays by scikit-learn.) A small JSON file next to it (model_*.joblib.json) records the versions the artifact was
+written with, the model it holds and the sha256 of the pickle it was built from, and is checked before
+the model is read:
+
+    python model_store.py model_mikania.pkl model_mikania.joblib
+
+An artifact is (re)built from the pickle on the first load if it is missing, built from another
+pickle (by content, so a checkout or a copy that only changes the file times does not rebuild it) or
+written with another scikit-learn release.
+
+'''
+
+import argparse
+import hashlib
+import json
+import os
+import pickle
+import platform
+import sys
+import tempfile
+import warnings
+
+import joblib
+import numpy as np
+import sklearn
+
+FORMAT_VERSION = 1
+
+
+def metadata_path(path):
+    return path + '.json'
+
+
+def file_sha256(path, chunk_size=2**20):
+    '''
+    sha256 of the content of a file, read in chunks.
+    '''
+    h = hashlib.sha256()
+    with open(path, 'rb') as data:
+        for chunk in iter(lambda: data.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def describe(model, pickle_sha256=None):
+    '''
+    metadata stored with an artifact: format, library versions, the kind of model and the sha256 of
+    the pickle it was built from. Nothing in it depends on when it was written, so rebuilding an
+    artifact from the same pickle gives the same file.
+    '''
+    steps = getattr(model, 'steps', None)
+
+    return {
+        'format': FORMAT_VERSION,
+        'sklearn': sklearn.__version__,
+        'numpy': np.__version__,
+        'python': platform.python_version(),
+        'estimator': '%s.%s' % (type(model).__module__, type(model).__qualname__),
+        'steps': [[name, type(step).__name__] for name, step in steps] if steps else None,
+        'n_features_in': int(model.n_features_in_) if hasattr(model, 'n_features_in_') else None,
+        'pickle_sha256': pickle_sha256,
+    }
+
+
+def read_metadata(path):
+    with open(metadata_path(path)) as metadata_file:
+        return json.load(metadata_file)
+
+
+def built_from(path):
+    '''
+    sha256 of the pickle an artifact was built from, None if its metadata is missing or does not say.
+    '''
+    try:
+        return read_metadata(path).get('pickle_sha256')
+    except (OSError, ValueError):
+        return None
+
+
+def check_version(metadata):
+    '''
+
+    Raises a ValueError if the artifact was written in another format or with another scikit-learn
+    release (major.minor) than the installed one, whose estimators may not read it correctly. Only
+    warns for a different patch release.
+
+    '''
+    if metadata.get('format') != FORMAT_VERSION:
+        raise ValueError('The model artifact has format %s, %s is expected.' % (metadata.get('format'), FORMAT_VERSION))
+
+    written = metadata.get('sklearn', '')
+    if written.split('.')[:2] != sklearn.__version__.split('.')[:2]:
+        raise ValueError('The model artifact was written with scikit-learn %s but %s is installed.'
+                         % (written, sklearn.__version__))
+    if written != sklearn.__version__:
+        warnings.warn('The model artifact was written with scikit-learn %s, %s is installed.' % (written, sklearn.__version__))
+
+
+def _atomic_write(path, write):
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    os.close(fd)
+    try:
+        write(tmp_file)
+        # mkstemp creates the file readable by its owner only, the artifacts are shared
+        os.chmod(tmp_file, 0o644)
+        os.replace(tmp_file, path)
+    except BaseException:
+        os.remove(tmp_file)
+        raise
+
+
+def save_model(model, path, pickle_sha256=None):
+    '''
+    writes the model as an uncompressed (memory mappable) joblib file and its metadata.
+    '''
+    _atomic_write(path, lambda tmp_file: joblib.dump(model, tmp_file))
+
+    def write_metadata(tmp_file):
+        with open(tmp_file, 'w') as metadata_file:
+            json.dump(describe(model, pickle_sha256), metadata_file, indent=1)
+            metadata_file.write('\n')
+    _atomic_write(metadata_path(path), write_metadata)
+
+
+def load_model(path, mmap=True):
+    '''
+    model of an artifact, after checking its metadata. Its arrays are memory mapped (read only) if mmap.
+    '''
+    check_version(read_metadata(path))
+
+    return joblib.load(path, mmap_mode='r' if mmap else None)
+
+
+def load_pickle(pickle_path):
+    with open(pickle_path, 'rb') as model_file:
+        return pickle.load(model_file)
+
+
+def load(pickle_path, artifact_path, mmap=True):
+    '''
+
+    Returns the model of a species from its artifact. The artifact is (re)built from the pickle first
+    if it is missing, was built from a pickle with another content, or can not be used with the
+    installed versions; if it can not be written (e.g. read only install), the model read from the
+    pickle is returned.
+
+
+    Parameters
+    ----------
+    pickle_path : str, default None
+        Path of the pickled model. Not needed if the artifact exists and is valid.
+
+    artifact_path : str, default None
+        Path of the .joblib artifact.
+
+    mmap : bool, default True
+        Whether the arrays of the model are memory mapped.
+
+    '''
+    pickle_sha256 = file_sha256(pickle_path) if os.path.exists(pickle_path) else None
+    has_pickle = pickle_sha256 is not None
+    stale = has_pickle and (not os.path.exists(artifact_path) or built_from(artifact_path) != pickle_sha256)
+
+    if not stale:
+        try:
+            return load_model(artifact_path, mmap=mmap)
+        except ValueError:
+            if not has_pickle:
+                raise
+
+    model = load_pickle(pickle_path)
+    try:
+        save_model(model, artifact_path, pickle_sha256)
+    except OSError:
+        return model
+
+    return load_model(artifact_path, mmap=mmap)
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('model', help='pickled model')
+    parser.add_argument('artifact', help='artifact to write (.joblib)')
+    args = parser.parse_args(argv)
+
+    model = load_pickle(args.model)
+    save_model(model, args.artifact, file_sha256(args.model))
+
+    metadata = read_metadata(args.artifact)
+    print('%s: %s, scikit-learn %s, %s features' % (args.artifact, metadata['estimator'], metadata['sklearn'],
+                                                     metadata['n_features_in']))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
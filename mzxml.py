@@ -0,0 +1,288 @@
+'''
+
+Reader of mzXML files, to inspect and validate the raw data on the Python side before the (slow)
+xcms preprocessing.
+
+The file is memory mapped and the byte offset of every scan is read once, from the index at the end
+of the file (or by searching the scan tags if the file has no index). The scan headers are small and
+parsed on request; the peak arrays (base64, optionally zlib compressed) are only decoded when the
+peaks of a scan are asked for, straight into NumPy arrays.
+
+Usage:
+
+    with MzXML('sample.mzXML') as run:
+        run.headers()            # one row per scan: rt, msLevel, polarity, centroided, TIC...
+        mz, intensity = run.peaks(0)
+        run.summary()
+
+'''
+
+import binascii
+import mmap
+import re
+import sys
+import zlib
+
+import numpy as np
+import pandas as pd
+
+SCAN_TAG = re.compile(rb'<scan\s')
+ATTRIBUTE = re.compile(rb'([\w:]+)\s*=\s*"([^"]*)"')
+INDEX_OFFSET = re.compile(rb'<indexOffset>\s*(\d+)\s*</indexOffset>')
+OFFSET = re.compile(rb'<offset\s+id="(\d+)"\s*>\s*(\d+)\s*</offset>')
+DURATION = re.compile(r'^-?P(?:T)?(?:(\d+(?:\.\d*)?)H)?(?:(\d+(?:\.\d*)?)M)?(?:(\d+(?:\.\d*)?)S)?$')
+
+HEADER_COLUMNS = {
+    'num': int,
+    'msLevel': int,
+    'peaksCount': int,
+    'polarity': str,
+    'centroided': str,
+    'retentionTime': str,
+    'lowMz': float,
+    'highMz': float,
+    'basePeakMz': float,
+    'basePeakIntensity': float,
+    'totIonCurrent': float,
+}
+
+
+class MzXMLError(ValueError):
+    '''
+    raised when a file is not a readable mzXML file.
+    '''
+
+
+def parse_duration(value):
+    '''
+    retention time in seconds from the xs:duration of mzXML (e.g. 'PT12.5S' or 'PT1M2.5S').
+    '''
+    match = DURATION.match(value.strip()) if value else None
+    if not match:
+        return np.nan
+
+    hours, minutes, seconds = (float(part) if part else 0.0 for part in match.groups())
+    return hours * 3600 + minutes * 60 + seconds
+
+
+def looks_centroided(mz, intensity):
+    '''
+
+    Guess of the acquisition mode of one spectrum, for files that do not say it. Profile spectra are
+    sampled on a regular m/z grid, so most of the differences between consecutive points are the
+    same, while the spacing between centroids is irregular.
+
+    '''
+    mz = mz[intensity > 0]
+    if len(mz) < 10:
+        return True
+
+    spacing = np.round(np.diff(mz), 3)
+    _, counts = np.unique(spacing, return_counts=True)
+
+    return counts.max() < 0.5 * len(spacing)
+
+
+class MzXML:
+    '''
+
+    Memory mapped mzXML file.
+
+
+    Parameters
+    ----------
+    path : str, default None
+        Path of the .mzXML file.
+
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+
+        try:
+            self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise MzXMLError('%s is empty.' % path)
+
+        if self._data.find(b'<mzXML', 0, 4096) < 0:
+            self.close()
+            raise MzXMLError('%s is not an mzXML file.' % path)
+
+        self.offsets = self._read_index()
+        if self.offsets is None:
+            self.offsets = np.array([match.start() for match in SCAN_TAG.finditer(self._data)], dtype=np.int64)
+
+        self._headers = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def close(self):
+        if not self._data.closed:
+            self._data.close()
+        self._file.close()
+
+    def _read_index(self):
+        '''
+        scan offsets from the index at the end of the file, or None if there is no (valid) index.
+        '''
+        tail = self._data[max(0, len(self._data) - 4096):]
+        match = INDEX_OFFSET.search(tail)
+        if not match:
+            return None
+
+        index_offset = int(match.group(1))
+        if not 0 < index_offset < len(self._data):
+            return None
+
+        end = self._data.find(b'</index>', index_offset)
+        if end < 0:
+            return None
+
+        offsets = np.array([int(offset) for _, offset in OFFSET.findall(self._data[index_offset:end])], dtype=np.int64)
+
+        # an index written by a buggy converter is detected by its first offset not being a scan
+        if len(offsets) == 0 or not self._data[offsets[0]:offsets[0] + 6].startswith(b'<scan'):
+            return None
+
+        return offsets
+
+    def _start_tag(self, i):
+        '''
+        attributes of the opening <scan ...> tag of scan i, as a dict of strings.
+        '''
+        start = int(self.offsets[i])
+        end = self._data.find(b'>', start)
+        return {name.decode(): value.decode() for name, value in ATTRIBUTE.findall(self._data[start:end])}
+
+    def header(self, i):
+        '''
+        attributes of scan i (position in the file, not the scan number), as strings.
+        '''
+        return self._start_tag(i)
+
+    def headers(self):
+        '''
+
+        DataFrame with one row per scan: num, msLevel, peaksCount, polarity, centroided, rt (seconds),
+        lowMz, highMz, basePeakMz, basePeakIntensity and totIonCurrent. Parsed once and kept.
+
+        '''
+        if self._headers is None:
+            rows = [self._start_tag(i) for i in range(len(self))]
+            table = pd.DataFrame(rows, columns=list(HEADER_COLUMNS))
+
+            for column, kind in HEADER_COLUMNS.items():
+                if kind is not str:
+                    table[column] = pd.to_numeric(table[column], errors='coerce')
+
+            table['rt'] = [parse_duration(value) for value in table.pop('retentionTime')]
+            self._headers = table
+
+        return self._headers
+
+    def peaks(self, i):
+        '''
+        m/z and intensity arrays (float64) of scan i, decoded on request.
+        '''
+        start = int(self.offsets[i])
+
+        # the <peaks> of scan i comes before any nested or following scan
+        peaks_start = self._data.find(b'<peaks', start + 1)
+        next_scan = self._data.find(b'<scan', start + 1)
+        if peaks_start < 0 or (0 <= next_scan < peaks_start):
+            return np.empty(0), np.empty(0)
+
+        tag_end = self._data.find(b'>', peaks_start)
+        attributes = {name.decode(): value.decode() for name, value in ATTRIBUTE.findall(self._data[peaks_start:tag_end])}
+
+        if self._data[tag_end - 1:tag_end] == b'/':
+            return np.empty(0), np.empty(0)
+
+        text_end = self._data.find(b'</peaks>', tag_end)
+        raw = binascii.a2b_base64(self._data[tag_end + 1:text_end])
+
+        if attributes.get('compressionType', 'none') == 'zlib':
+            raw = zlib.decompress(raw)
+
+        precision = attributes.get('precision', '32')
+        order = '<' if attributes.get('byteOrder', 'network') == 'little' else '>'
+        values = np.frombuffer(raw, dtype='%sf%d' % (order, int(precision) // 8)).astype(np.float64)
+
+        pairs = values.reshape(-1, 2)
+        if attributes.get('pairOrder', attributes.get('contentType', 'm/z-int')) in ('int-m/z',):
+            return pairs[:, 1], pairs[:, 0]
+
+        return pairs[:, 0], pairs[:, 1]
+
+    def tic(self, ms_level=1):
+        '''
+
+        Total ion chromatogram: retention times (seconds) and TIC of the scans of ms_level. Uses the
+        totIonCurrent of the headers, and decodes the peaks only for the scans that do not have it.
+
+        '''
+        headers = self.headers()
+        scans = headers.index[headers['msLevel'].fillna(1) == ms_level]
+        tic = headers.loc[scans, 'totIonCurrent'].to_numpy(copy=True)
+
+        for position in np.flatnonzero(np.isnan(tic)):
+            tic[position] = self.peaks(scans[position])[1].sum()
+
+        return headers.loc[scans, 'rt'].to_numpy(), tic
+
+    def polarity(self):
+        '''
+        set of the polarities ('-' and/or '+') of the scans. Empty if the file does not say.
+        '''
+        return set(self.headers()['polarity'].dropna()) & {'-', '+'}
+
+    def centroided(self, sample_scans=5):
+        '''
+
+        Whether the spectra are centroided: from the centroided attribute of the scans or of the
+        dataProcessing element, and otherwise guessed from the peaks of a few scans.
+
+        '''
+        flags = self.headers()['centroided'].dropna()
+        if len(flags):
+            return bool((flags == '1').all())
+
+        head = self._data[:self._data.find(b'<scan')]
+        match = re.search(rb'<dataProcessing[^>]*centroided="(\d)"', head)
+        if match:
+            return match.group(1) == b'1'
+
+        scans = np.linspace(0, len(self) - 1, min(sample_scans, len(self))).astype(int)
+        return all(looks_centroided(*self.peaks(i)) for i in scans)
+
+    def summary(self):
+        '''
+        dict with the scan count, polarity, centroided flag, rt range (seconds) and total TIC of the file.
+        '''
+        headers = self.headers()
+        _, tic = self.tic()
+
+        return {
+            'file': self.path,
+            'scans': len(self),
+            'polarity': ''.join(sorted(self.polarity())) or None,
+            'centroided': self.centroided() if len(self) else None,
+            'rt_min': headers['rt'].min(),
+            'rt_max': headers['rt'].max(),
+            'tic': float(tic.sum()),
+        }
+
+
+if __name__ == '__main__':
+    for path in sys.argv[1:]:
+        with MzXML(path) as run:
+            print(run.summary())
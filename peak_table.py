@@ -0,0 +1,134 @@
+'''
+
+Files of the peak tables handed from R to Python.
+
+The R scripts write the CAMERA peak list as an Arrow IPC file (.arrow, the format of
+arrow::write_feather) when the arrow R package is installed, and as csv otherwise. The Arrow file is
+typed, so nothing is parsed from text, and its schema metadata lists the sample columns and the
+sample class columns (the per class peak counts added by getPeaklist), so Python does not have to
+guess them from the folder layout:
+
+    index_column     name of the column with the row names (the index of the table)
+    sample_columns   intensity columns, one per mzXML file, tab separated
+    class_columns    sample class columns, tab separated
+
+The files are memory mapped when read and only the requested columns are converted to pandas.
+The peak table cache (xcms_cache) stores its tables in the same format.
+
+'''
+
+import os
+import tempfile
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.ipc
+
+ARROW_EXTENSION = '.arrow'
+CSV_EXTENSION = '.csv'
+EXTENSIONS = [ARROW_EXTENSION, CSV_EXTENSION]
+
+
+def _split(value):
+    return [name for name in value.decode().split('\t') if name] if value else []
+
+
+def read_schema(path):
+    '''
+    schema of an Arrow peak table (only the footer of the file is read).
+    '''
+    with pa.memory_map(path) as source:
+        return pa.ipc.open_file(source).schema
+
+
+def sample_columns(path):
+    '''
+    intensity columns listed in the metadata of an Arrow peak table.
+    '''
+    return _split((read_schema(path).metadata or {}).get(b'sample_columns'))
+
+
+def class_columns(path):
+    '''
+    sample class columns listed in the metadata of an Arrow peak table.
+    '''
+    return _split((read_schema(path).metadata or {}).get(b'class_columns'))
+
+
+def read_arrow(path, columns=None, drop_classes=True):
+    '''
+
+    Reads an Arrow peak table as a DataFrame. The file is memory mapped and only the selected columns
+    (all but the sample class columns by default) are converted.
+
+
+    Parameters
+    ----------
+    path : str or bytes, default None
+        Path of the .arrow file, or its content (e.g. the body of an HTTP request).
+
+    columns : list, default None
+        Columns to read (besides the index). All if None.
+
+    drop_classes : bool, default True
+        Whether the sample class columns listed in the metadata are left out.
+
+    '''
+    source = pa.memory_map(path) if isinstance(path, str) else pa.BufferReader(path)
+    with source:
+        table = pa.ipc.open_file(source).read_all()
+
+    metadata = table.schema.metadata or {}
+    index_column = metadata.get(b'index_column', b'').decode()
+
+    if columns is None:
+        columns = table.column_names
+        if drop_classes:
+            classes = set(_split(metadata.get(b'class_columns')))
+            columns = [name for name in columns if name not in classes]
+    if index_column and index_column not in columns:
+        columns = [index_column] + list(columns)
+
+    table_data = table.select(columns).to_pandas()
+
+    # the R row names become the index, as with read_csv(index_col=[0])
+    if index_column:
+        index = table_data.pop(index_column)
+        if index.dtype == object:
+            index = pd.to_numeric(index, errors='ignore')
+        table_data.index = pd.Index(index.to_numpy(), name=None)
+
+    return table_data
+
+
+def write_arrow(table_data, path, sample_columns=(), class_columns=()):
+    '''
+
+    Writes a peak table as an Arrow IPC file, through a temporary file so a reader never sees half
+    of it. The index is stored as a column, named in the metadata with the sample and class columns.
+
+    '''
+    table_data = table_data.rename_axis('rowname').reset_index()
+    table = pa.Table.from_pandas(table_data, preserve_index=False)
+    table = table.replace_schema_metadata(dict(table.schema.metadata or {}, **{
+        'index_column': 'rowname',
+        'sample_columns': '\t'.join(sample_columns),
+        'class_columns': '\t'.join(class_columns),
+    }))
+
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    with os.fdopen(fd, 'wb') as tmp, pa.ipc.new_file(tmp, table.schema) as writer:
+        writer.write_table(table)
+    os.replace(tmp_file, path)
+
+    return path
+
+
+def read_table(path, drop_classes=True):
+    '''
+    reads a peak table file, Arrow or csv (by extension).
+    '''
+    if path.endswith(ARROW_EXTENSION):
+        return read_arrow(path, drop_classes=drop_classes)
+
+    return pd.read_csv(path, index_col=[0])
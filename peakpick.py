@@ -0,0 +1,474 @@
+'''
+
+NumPy/SciPy peak detection in the style of the xcms matchedFilter method, as an alternative to the
+R preprocessing for deployments without R and Bioconductor.
+
+find_peaks follows the steps of matchedFilter with the same settings as the xcmsSet block of
+xcms_may.R / xcms_mik.R (fwhm, sigma, snthresh, step, steps, max, mzdiff):
+
+    1. the centroids of each MS1 scan are binned in m/z bins of width step (max intensity per bin);
+    2. slices of steps neighbouring bins are merged (max) into extracted ion chromatograms;
+    3. every chromatogram is filtered with the second derivative of a gaussian of width sigma;
+    4. up to max peaks per slice are taken from the filtered signal, above snthresh times the noise,
+       each one spanning the scans where the filtered signal stays positive;
+    5. overlapping peaks (closer than mzdiff in m/z) are removed, keeping the most intense.
+
+All slices are processed at once, as rows of a bins x scans matrix. group_density then groups the
+peaks of several files like group(method="density") and gives a table with the columns of
+getPeaklist: mz, mzmin, mzmax, rt, rtmin, rtmax, npeaks and one intensity column per file (there is
+no retcor, fillPeaks or CAMERA: a file without a peak in a group has a zero intensity, and the
+annotation columns are left empty).
+
+compare_peaks and the command line build a comparison report against the xcmsSet peaks of R:
+
+    python peakpick.py --species mikania output_mik/batch/*/*.mzXML --report comparison.csv
+
+'''
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+from scipy.ndimage import convolve1d
+
+import mzxml
+import xcms_parallel
+import xcms_params
+
+PEAK_COLUMNS = ['mz', 'mzmin', 'mzmax', 'rt', 'rtmin', 'rtmax', 'into', 'intf', 'maxo', 'maxf', 'sn']
+
+
+def read_centroids(path):
+    '''
+
+    Reads the MS1 centroids of an mzXML file. Returns the retention time of each scan (seconds) and
+    the m/z, intensity and scan position of every centroid, as flat arrays.
+
+    '''
+    with mzxml.MzXML(path) as run:
+        headers = run.headers()
+        scans = headers.index[headers['msLevel'].fillna(1) == 1]
+
+        mz, intensity, scan = [], [], []
+        for position, i in enumerate(scans):
+            scan_mz, scan_intensity = run.peaks(i)
+            mz.append(scan_mz)
+            intensity.append(scan_intensity)
+            scan.append(np.full(len(scan_mz), position, dtype=np.int64))
+
+        rt = headers.loc[scans, 'rt'].to_numpy(dtype=float)
+
+    if not mz:
+        return rt, np.empty(0), np.empty(0), np.empty(0, dtype=np.int64)
+
+    return rt, np.concatenate(mz), np.concatenate(intensity), np.concatenate(scan)
+
+
+def matched_filter(sigma):
+    '''
+    second derivative of a gaussian (sigma in scans), sign changed so the peak is positive, with unit norm.
+    '''
+    half = max(int(np.ceil(4 * sigma)), 1)
+    x = np.arange(-half, half + 1, dtype=float)
+    filt = (sigma**2 - x**2) / sigma**4 * np.exp(-x**2 / (2 * sigma**2))
+    return filt / np.sqrt(np.sum(filt**2))
+
+
+def rect_unique(mzmin, mzmax, rtmin, rtmax, order, mzdiff=0.0):
+    '''
+
+    Positions (in order) of the rectangles that do not overlap (or touch) a previous one, as xcms
+    rectUnique. The m/z ranges are widened by mzdiff before the test, so a negative mzdiff allows
+    some overlap.
+
+    The overlapping pairs are found at once with the m/z lower bounds sorted and two searchsorted
+    calls (as feature_eng.candidate_pairs): a rectangle can only overlap the ones whose mzmin is
+    within its m/z range widened by mzdiff and by the widest rectangle. Only the rectangles that
+    overlap a previous one are then visited in order, each against its own overlapping ones.
+
+    '''
+    order = np.asarray(order, dtype=np.int64)
+    if len(order) == 0:
+        return order
+
+    start, end = mzmin[order], mzmax[order]
+    low, high = start - mzdiff, end + mzdiff
+    rt_start, rt_end = rtmin[order], rtmax[order]
+
+    # pairs (a, b) of positions in order with the mzmin of b in the window of a
+    by_mz = np.argsort(start, kind='stable')
+    first = np.searchsorted(start[by_mz], low - (end - start).max(), side='left')
+    last = np.searchsorted(start[by_mz], high, side='right')
+    counts = last - first
+    a = np.repeat(np.arange(len(order)), counts)
+    b = by_mz[np.repeat(first, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)]
+
+    overlap = ((b < a) & (low[a] <= end[b]) & (high[a] >= start[b])
+               & (rt_start[a] <= rt_end[b]) & (rt_end[a] >= rt_start[b]))
+    later, earlier = a[overlap], b[overlap]
+
+    # the rectangles without a previous overlapping one are kept whatever the others are
+    kept = np.ones(len(order), dtype=bool)
+    bounds = np.flatnonzero(np.diff(later, prepend=-1, append=len(order)))
+    for begin, stop in zip(bounds[:-1], bounds[1:]):
+        if kept[earlier[begin:stop]].any():
+            kept[later[begin]] = False
+
+    return order[kept]
+
+
+def find_peaks(path, fwhm=30, sigma=None, snthresh=10, step=0.1, steps=2, max=5, mzdiff=None, **ignored):
+    '''
+
+    matchedFilter style peak detection on one mzXML file. The keyword arguments are the ones of the
+    xcmsSet block (so xcms_params.PARAMS[species]['xcmsSet'] can be passed with **); the ones that do
+    not apply here (method, index) are ignored. Returns a DataFrame with the columns of the xcms peaks
+    matrix: mz, mzmin, mzmax, rt, rtmin, rtmax (seconds), into, intf, maxo, maxf and sn.
+
+    '''
+    sigma = fwhm / 2.3548 if sigma is None else sigma
+    mzdiff = 0.8 - step * steps if mzdiff is None else mzdiff
+
+    rt, mz, intensity, scan = read_centroids(path)
+    n_scans = len(rt)
+    if len(mz) == 0 or n_scans < 3:
+        return pd.DataFrame(columns=PEAK_COLUMNS, dtype=float)
+
+    # 1. profile matrix, bins x scans: intensity and m/z of the most intense centroid of each cell
+    first_bin = np.floor(mz.min() / step)
+    n_bins = int(np.ceil(mz.max() / step) - first_bin) + 1
+    cell = np.rint(mz / step - first_bin).astype(np.int64) * n_scans + scan
+
+    order = np.lexsort((intensity, cell))
+    last = order[np.append(cell[order][1:] != cell[order][:-1], True)]
+
+    profile = np.zeros(n_bins * n_scans)
+    profile[cell[last]] = intensity[last]
+    profile = profile.reshape(n_bins, n_scans)
+    profile_mz = np.zeros(n_bins * n_scans)
+    profile_mz[cell[last]] = mz[last]
+    profile_mz = profile_mz.reshape(n_bins, n_scans)
+
+    # 2. slices of steps bins (slice i covers bins i to i + steps - 1)
+    steps = int(min(steps, n_bins))
+    n_slices = n_bins - steps + 1
+    eic = profile[:n_slices].copy()
+    for k in range(1, steps):
+        np.maximum(eic, profile[k:k + n_slices], out=eic)
+
+    # 3. matched filter along the scans, sigma converted from seconds to scans
+    scan_interval = np.median(np.diff(rt)) if n_scans > 1 else 1.0
+    filtered = convolve1d(eic, matched_filter(sigma / scan_interval), axis=1, mode='constant')
+
+    positive = eic > 0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        noise = np.where(positive.any(axis=1), (eic * positive).sum(axis=1) / positive.sum(axis=1), np.inf)
+
+    # 4. up to max peaks per slice, all slices at once
+    rows = np.arange(n_slices)
+    columns = np.arange(n_scans)
+    remaining = filtered.copy()
+    alive = np.ones(n_slices, dtype=bool)
+    found = []
+
+    for _ in range(int(max)):
+        top = remaining.argmax(axis=1)
+        value = remaining[rows, top]
+        alive &= (value > 0) & (value >= snthresh * noise)
+        if not alive.any():
+            break
+
+        # the peak spans the scans around the top where the filtered signal stays positive
+        not_positive = remaining <= 0
+        left = np.maximum.accumulate(np.where(not_positive, columns, -1), axis=1)
+        right = np.minimum.accumulate(np.where(not_positive, columns, n_scans)[:, ::-1], axis=1)[:, ::-1]
+
+        slices = rows[alive]
+        top = top[alive]
+        low = left[slices, top] + 1
+        high = right[slices, top] - 1
+        found.append((slices, top, low, high, value[alive]))
+
+        span = np.zeros_like(remaining, dtype=bool)
+        span[slices] = (columns >= low[:, None]) & (columns <= high[:, None])
+        remaining[span] = 0
+
+    if not found:
+        return pd.DataFrame(columns=PEAK_COLUMNS, dtype=float)
+
+    slices, top, low, high, maxf = (np.concatenate(part) for part in zip(*found))
+
+    # peak areas from cumulative sums over the scans
+    eic_sum = np.concatenate([np.zeros((n_slices, 1)), np.cumsum(eic, axis=1)], axis=1)
+    filtered_sum = np.concatenate([np.zeros((n_slices, 1)), np.cumsum(filtered, axis=1)], axis=1)
+    width = np.where(high > low, (rt[high] - rt[low]) / np.maximum(high - low, 1), scan_interval)
+
+    # m/z of the cells of the peak above half of its height (the noise of the slice is left out)
+    n_peaks = len(slices)
+    maxo, peak_mz, peak_mzmin, peak_mzmax = (np.empty(n_peaks) for _ in range(4))
+    for i, (s, lo, hi) in enumerate(zip(slices, low, high)):
+        box = profile[s:s + steps, lo:hi + 1]
+        maxo[i] = box.max()
+        half = box >= maxo[i] / 2
+        values = profile_mz[s:s + steps, lo:hi + 1][half]
+        peak_mz[i] = np.average(values, weights=box[half])
+        peak_mzmin[i] = values.min()
+        peak_mzmax[i] = values.max()
+
+    peaks = pd.DataFrame({
+        'mz': peak_mz,
+        'mzmin': peak_mzmin,
+        'mzmax': peak_mzmax,
+        'rt': rt[top],
+        'rtmin': rt[low],
+        'rtmax': rt[high],
+        'into': width * (eic_sum[slices, high + 1] - eic_sum[slices, low]),
+        'intf': width * (filtered_sum[slices, high + 1] - filtered_sum[slices, low]),
+        'maxo': maxo,
+        'maxf': maxf,
+        'sn': maxf / noise[slices],
+    })
+
+    # 5. neighbouring slices share bins and find the same peak: keep the most intense
+    order = np.argsort(-peaks['into'].to_numpy(), kind='stable')
+    keep = rect_unique(peaks['mzmin'].to_numpy(), peaks['mzmax'].to_numpy(), peaks['rtmin'].to_numpy(),
+                       peaks['rtmax'].to_numpy(), order, mzdiff)
+
+    return peaks.iloc[np.sort(keep)].reset_index(drop=True)
+
+
+def descend_min(y, top):
+    '''
+    range around top where y keeps decreasing on both sides, as xcms descendMin.
+    '''
+    low = top
+    while low > 0 and y[low - 1] <= y[low]:
+        low -= 1
+    high = top
+    while high < len(y) - 1 and y[high + 1] <= y[high]:
+        high += 1
+    return low, high
+
+
+def group_density(peaks, sample_names, sample_classes, bw=30, mzwid=0.25, minfrac=0.5, minsamp=1, max=50,
+                  n_points=512, **ignored):
+    '''
+
+    Groups the peaks of several files as xcms group(method="density") and returns a table with the
+    columns of getPeaklist (without the sample class columns): mz, mzmin, mzmax, rt, rtmin, rtmax,
+    npeaks, one column per file with the into of its peak closest to the group rt (zero if the file
+    has no peak in the group), and empty isotopes, adduct and pcgroup columns.
+
+
+    Parameters
+    ----------
+    peaks : pandas DataFrame, default None
+        Peaks of all files (find_peaks output) with the position of the file in a sample column.
+
+    sample_names : list, default None
+        Name of each file, used for the intensity columns.
+
+    sample_classes : list, default None
+        Class (sample folder) of each file, used for minfrac.
+
+    bw, mzwid, minfrac, minsamp, max : default as xcms
+        Parameters of the group block of xcms_params.
+
+    '''
+    sample_classes = pd.Series(sample_classes)
+    class_codes, class_names = pd.factorize(sample_classes)
+    class_size = np.bincount(class_codes, minlength=len(class_names))
+
+    peaks = peaks.sort_values('mz', kind='stable').reset_index(drop=True)
+    mz = peaks['mz'].to_numpy()
+    rt = peaks['rt'].to_numpy()
+    peak_class = class_codes[peaks['sample'].to_numpy()]
+
+    groups = []
+    if len(peaks):
+        mass = np.arange(mz[0], mz[-1] + mzwid, mzwid / 2)
+        starts = np.searchsorted(mz, mass[:-2], side='left')
+        ends = np.searchsorted(mz, mass[2:], side='left')
+
+        for start, end in zip(starts, ends):
+            if end <= start:
+                continue
+
+            slice_rt = rt[start:end]
+            grid = np.linspace(slice_rt.min() - 3 * bw, slice_rt.max() + 3 * bw, n_points)
+            density = np.exp(-0.5 * ((grid[:, None] - slice_rt[None, :]) / bw)**2).sum(axis=1)
+            threshold = density.max() / 20
+
+            n_groups = 0
+            while n_groups < max:
+                top = density.argmax()
+                if density[top] <= threshold:
+                    break
+
+                low, high = descend_min(density, top)
+                density[low:high + 1] = 0
+
+                members = start + np.flatnonzero((slice_rt >= grid[low]) & (slice_rt <= grid[high]))
+                if len(members) == 0:
+                    continue
+
+                files = np.unique(peaks['sample'].to_numpy()[members])
+                per_class = np.bincount(class_codes[files], minlength=len(class_names))
+                if not np.any((per_class >= class_size * minfrac) & (per_class >= minsamp)):
+                    continue
+
+                n_groups += 1
+                groups.append(members)
+
+    if not groups:
+        return pd.DataFrame(columns=['mz', 'mzmin', 'mzmax', 'rt', 'rtmin', 'rtmax', 'npeaks'] + list(sample_names)
+                            + ['isotopes', 'adduct', 'pcgroup'])
+
+    table = pd.DataFrame({
+        'mz': [np.median(mz[g]) for g in groups],
+        'mzmin': [mz[g].min() for g in groups],
+        'mzmax': [mz[g].max() for g in groups],
+        'rt': [np.median(rt[g]) for g in groups],
+        'rtmin': [rt[g].min() for g in groups],
+        'rtmax': [rt[g].max() for g in groups],
+        'npeaks': [len(g) for g in groups],
+    })
+
+    # overlapping slices find the same groups twice: keep the one with more peaks
+    order = np.lexsort((table['mz'].to_numpy(), -table['npeaks'].to_numpy()))
+    keep = np.sort(rect_unique(table['mzmin'].to_numpy(), table['mzmax'].to_numpy(), table['rtmin'].to_numpy(),
+                               table['rtmax'].to_numpy(), order))
+    table = table.iloc[keep].reset_index(drop=True)
+    groups = [groups[i] for i in keep]
+
+    # intensity of each file: its peak closest to the group median rt. Without fillPeaks the files with
+    # no peak in the group are zero, not NaN: data_prep drops the rows with a NaN in any sample
+    intensities = np.zeros((len(groups), len(sample_names)))
+    for row, members in enumerate(groups):
+        member_peaks = peaks.iloc[members]
+        distance = (member_peaks['rt'] - table['rt'].iat[row]).abs()
+        closest = member_peaks.assign(distance=distance).sort_values('distance').drop_duplicates('sample')
+        intensities[row, closest['sample'].to_numpy()] = closest['into'].to_numpy()
+
+    table = pd.concat([table, pd.DataFrame(intensities, columns=list(sample_names))], axis=1)
+    table['isotopes'] = ''
+    table['adduct'] = ''
+    table['pcgroup'] = 0
+
+    return table
+
+
+def peaklist(folder, params, warps=None):
+    '''
+
+    Runs find_peaks on every mzXML file under folder and groups the result. Returns a table shaped
+    like the one read by qc_pipeline.read_peak_table. If warps (file -> warp, see rt_align.warp_files)
+    are given, the retention times of the peaks of each file are aligned to the reference profile
+    before the grouping.
+
+    '''
+    samples = xcms_parallel.find_mzxml(folder)
+
+    file_peaks = []
+    for i, path in enumerate(samples['file']):
+        peaks = find_peaks(path, **params['xcmsSet']).assign(sample=i)
+        if warps is not None:
+            # as rt_align.warp_rt: the shift is interpolated between the segment centres of the warp
+            raw, corrected = warps[path]
+            for column in ('rt', 'rtmin', 'rtmax'):
+                peaks[column] = peaks[column] + np.interp(peaks[column], raw, corrected - raw)
+        file_peaks.append(peaks)
+
+    peaks = pd.concat(file_peaks, ignore_index=True)
+
+    return group_density(peaks, samples['name'], samples['class'], **params['group'])
+
+
+def compare_peaks(python_peaks, r_peaks, mz_tol=0.5, rt_tol=10.0):
+    '''
+
+    Compares the peaks found by find_peaks with the ones of xcmsSet on the same file. A peak of R is
+    recovered if a Python peak is within mz_tol (Da) and rt_tol (seconds) of it. Returns a dict with
+    the number of peaks of each, the recall (fraction of R peaks recovered), the precision (fraction
+    of Python peaks matched to an R peak), the median m/z and rt differences of the matches and the
+    rank correlation of their into.
+
+    '''
+    python_peaks = python_peaks.sort_values('mz').reset_index(drop=True)
+    py_mz = python_peaks['mz'].to_numpy()
+    py_rt = python_peaks['rt'].to_numpy()
+
+    r_mz = r_peaks['mz'].to_numpy()
+    r_rt = r_peaks['rt'].to_numpy()
+
+    # candidate pairs from the m/z window, then the closest rt among them
+    first = np.searchsorted(py_mz, r_mz - mz_tol, side='left')
+    last = np.searchsorted(py_mz, r_mz + mz_tol, side='right')
+    counts = last - first
+    r_index = np.repeat(np.arange(len(r_mz)), counts)
+    py_index = np.repeat(first - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+
+    rt_difference = np.abs(py_rt[py_index] - r_rt[r_index])
+    close = rt_difference <= rt_tol
+    pairs = pd.DataFrame({'r': r_index[close], 'py': py_index[close], 'drt': rt_difference[close]})
+    pairs = pairs.sort_values('drt', kind='stable').drop_duplicates('r')
+
+    report = {
+        'python_peaks': len(python_peaks),
+        'r_peaks': len(r_peaks),
+        'recall': len(pairs) / len(r_peaks) if len(r_peaks) else np.nan,
+        'precision': pairs['py'].nunique() / len(python_peaks) if len(python_peaks) else np.nan,
+        'median_mz_difference': np.median(np.abs(py_mz[pairs['py']] - r_mz[pairs['r']])) if len(pairs) else np.nan,
+        'median_rt_difference': pairs['drt'].median() if len(pairs) else np.nan,
+        'into_correlation': np.nan,
+    }
+
+    if len(pairs) > 2 and 'into' in r_peaks:
+        report['into_correlation'] = pd.Series(python_peaks['into'].to_numpy()[pairs['py']]).corr(
+            pd.Series(r_peaks['into'].to_numpy()[pairs['r']]), method='spearman')
+
+    return report
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('files', nargs='+', help='mzXML files')
+    parser.add_argument('--species', required=True, help='species whose xcmsSet parameters are used: %s' % ', '.join(xcms_params.PARAMS))
+    parser.add_argument('--r-peaks-dir', default=xcms_parallel.DEFAULT_CACHE_DIR,
+                        help='folder with the xcmsSet results of R (the per file cache of xcms_parallel)')
+    parser.add_argument('--mz-tol', type=float, default=0.5, help='m/z tolerance of the comparison (Da)')
+    parser.add_argument('--rt-tol', type=float, default=10.0, help='rt tolerance of the comparison (seconds)')
+    parser.add_argument('--report', help='write the comparison report to this csv')
+    args = parser.parse_args(argv)
+
+    params = xcms_params.PARAMS[args.species]
+    rows = []
+
+    for path in args.files:
+        start = time.perf_counter()
+        python_peaks = find_peaks(path, **params['xcmsSet'])
+        row = {'file': path, 'seconds': time.perf_counter() - start}
+
+        r_csv = xcms_parallel.peaks_cache_prefix(path, params, args.r_peaks_dir) + '.csv'
+        if os.path.exists(r_csv):
+            row.update(compare_peaks(python_peaks, pd.read_csv(r_csv), args.mz_tol, args.rt_tol))
+        else:
+            row.update({'python_peaks': len(python_peaks), 'r_peaks': np.nan})
+
+        rows.append(row)
+
+    report = pd.DataFrame(rows)
+    print(report.to_string(index=False))
+
+    if args.report:
+        report.to_csv(args.report, index=False)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
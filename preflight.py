@@ -0,0 +1,243 @@
+'''
+
+Pre-flight check of an upload, before the (slow) xcms preprocessing.
+
+Every mzXML file of the folder is opened in parallel (see mzxml: only the scan headers and the peaks
+of a few scans are read) and summarized: scan count, polarity, centroided flag, rt range and TIC.
+The batch is then checked as a whole, so a bad upload is refused in seconds instead of after minutes
+of R:
+
+    errors      no mzXML file, unreadable or empty files, profile mode spectra, a polarity other
+                than the one of the species, sample names used twice or equal to a sample folder
+                name (the folder columns of the peak table are dropped by name, see
+                qc_pipeline.read_peak_table)
+    warnings    sample folders without mzXML files, samples with fewer replicates than expected,
+                files without polarity, files whose rt range or TIC is far from the others
+
+Usage:
+
+    python preflight.py upload_folder --polarity negative
+
+'''
+
+import argparse
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import mzxml
+import xcms_parallel
+
+POLARITIES = {'negative': '-', 'positive': '+'}
+
+DEFAULT_SAMPLE_SCANS = 5
+DEFAULT_MIN_REPLICATES = 2
+# a file whose rt range is shorter than this fraction of the median, or whose TIC is below it, is flagged
+RT_RANGE_FRACTION = 0.8
+TIC_FRACTION = 0.1
+
+FILE_COLUMNS = ['file', 'class', 'name', 'scans', 'polarity', 'centroided', 'rt_min', 'rt_max', 'tic',
+                'empty_scans', 'error']
+
+
+class PreflightError(ValueError):
+    '''
+    the upload does not pass the pre-flight check, see Report.
+    '''
+
+    def __init__(self, report):
+        self.report = report
+        super().__init__('The upload was refused:\n%s' % '\n'.join(report.errors()))
+
+
+class Report:
+    '''
+
+    Result of a pre-flight check.
+
+
+    Attributes
+    ----------
+    files : pandas.DataFrame
+        One row per mzXML file (see FILE_COLUMNS), with the error message of the files that could not be read.
+
+    issues : list
+        (level, message) pairs, level being 'error' or 'warning'.
+
+    '''
+
+    def __init__(self, files, issues):
+        self.files = files
+        self.issues = issues
+
+    def errors(self):
+        return [message for level, message in self.issues if level == 'error']
+
+    def warnings(self):
+        return [message for level, message in self.issues if level == 'warning']
+
+    @property
+    def ok(self):
+        return not self.errors()
+
+    def raise_for_errors(self):
+        if not self.ok:
+            raise PreflightError(self)
+
+
+def check_file(path, sample_scans=DEFAULT_SAMPLE_SCANS):
+    '''
+
+    Summary of one mzXML file (see mzxml.MzXML.summary), plus the number of empty spectra among
+    sample_scans scans spread over the run. A file that can not be read has its error message instead.
+
+    '''
+    try:
+        with mzxml.MzXML(path) as run:
+            summary = run.summary()
+
+            scans = np.linspace(0, len(run) - 1, min(sample_scans, len(run))).astype(int)
+            summary['empty_scans'] = sum(len(run.peaks(i)[0]) == 0 for i in scans)
+    except (OSError, ValueError) as error:
+        return {'file': path, 'error': str(error) or type(error).__name__}
+
+    summary['error'] = None
+    return summary
+
+
+def check_files(files, n_jobs=None, sample_scans=DEFAULT_SAMPLE_SCANS):
+    '''
+    check_file of each file, on n_jobs threads (the CPU count if None), as a DataFrame in the order of files.
+    '''
+    with ThreadPoolExecutor(max_workers=n_jobs or os.cpu_count()) as pool:
+        rows = list(pool.map(lambda path: check_file(path, sample_scans=sample_scans), files))
+
+    return pd.DataFrame(rows, columns=[column for column in FILE_COLUMNS if column not in ('class', 'name')])
+
+
+def empty_sample_folders(folder):
+    '''
+    sample folders (the subfolders of the directories in folder, as qc_pipeline.sample_class_names) without mzXML files.
+    '''
+    empty = []
+    for root, subfolders, names in os.walk(folder):
+        if os.path.relpath(root, folder).count(os.sep) != 1 or subfolders:
+            continue
+        if not any(name.lower().endswith('.mzxml') for name in names):
+            empty.append(os.path.relpath(root, folder))
+
+    return sorted(empty)
+
+
+def check_batch(files, polarity=None, min_replicates=DEFAULT_MIN_REPLICATES):
+    '''
+
+    Issues of a batch, from the per file summaries (files as returned by check_folder) as a list of
+    (level, message) pairs. See the module docstring for the checks.
+
+
+    Parameters
+    ----------
+    files : pandas.DataFrame
+        One row per mzXML file, with its class (sample folder) and name.
+
+    polarity : str, default None
+        Expected polarity, 'negative' or 'positive'. Not checked if None.
+
+    min_replicates : int, default 2
+        Number of files a sample is expected to have.
+
+    '''
+    issues = []
+
+    def add(level, message, names):
+        names = list(names)
+        if names:
+            issues.append((level, '%s: %s' % (message, ', '.join(map(str, names)))))
+
+    if len(files) == 0:
+        return [('error', 'No mzXML file found.')]
+
+    unreadable = files[files['error'].notna()]
+    for _, row in unreadable.iterrows():
+        issues.append(('error', '%s can not be read: %s' % (os.path.basename(row['file']), row['error'])))
+
+    readable = files[files['error'].isna()]
+    add('error', 'Files without scans', readable.loc[readable['scans'] == 0, 'name'])
+    readable = readable[readable['scans'] > 0]
+
+    add('error', 'Files in profile mode (the spectra have to be centroided)',
+        readable.loc[readable['centroided'].eq(False), 'name'])
+
+    if polarity is not None:
+        expected = POLARITIES[polarity]
+        known = readable[readable['polarity'].notna()]
+        add('error', 'Files not acquired in %s mode only' % polarity, known.loc[known['polarity'] != expected, 'name'])
+        add('warning', 'Files without polarity', readable.loc[readable['polarity'].isna(), 'name'])
+
+    add('warning', 'Files with empty spectra', readable.loc[readable['empty_scans'] > 0, 'name'])
+
+    # the sample names become the intensity columns of the peak table
+    names = files['name'].value_counts()
+    add('error', 'Sample names used by more than one file', names.index[names > 1])
+    add('error', 'Sample names equal to a sample folder name', sorted(set(files['name']) & set(files['class'])))
+
+    replicates = files['class'].value_counts().sort_index()
+    add('warning', 'Samples with fewer than %d replicates' % min_replicates,
+        ['%s (%d)' % (name, count) for name, count in replicates.items() if count < min_replicates])
+
+    if len(readable) > 1:
+        rt_range = readable['rt_max'] - readable['rt_min']
+        add('warning', 'Files with a shorter run than the others',
+            readable.loc[rt_range < RT_RANGE_FRACTION * rt_range.median(), 'name'])
+        add('warning', 'Files with a much lower TIC than the others',
+            readable.loc[readable['tic'] < TIC_FRACTION * readable['tic'].median(), 'name'])
+
+    return issues
+
+
+def check_folder(folder, polarity=None, min_replicates=DEFAULT_MIN_REPLICATES, n_jobs=None,
+                 sample_scans=DEFAULT_SAMPLE_SCANS):
+    '''
+
+    Pre-flight check of the mzXML files under folder (an extracted upload). Returns a Report; the
+    parameters are those of check_files and check_batch.
+
+    '''
+    found = xcms_parallel.find_mzxml(folder)
+    summaries = check_files(list(found['file']), n_jobs=n_jobs, sample_scans=sample_scans)
+    files = pd.concat([found, summaries.drop(columns='file')], axis=1)[FILE_COLUMNS]
+
+    issues = check_batch(files, polarity=polarity, min_replicates=min_replicates)
+
+    empty = empty_sample_folders(folder)
+    if empty and len(files):
+        issues.append(('warning', 'Sample folders without mzXML files: %s' % ', '.join(empty)))
+
+    return Report(files, issues)
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('folder', help='folder with the sample subfolders of mzXML files')
+    parser.add_argument('--polarity', choices=sorted(POLARITIES), help='expected polarity (not checked by default)')
+    parser.add_argument('--min-replicates', type=int, default=DEFAULT_MIN_REPLICATES,
+                        help='replicates expected per sample (default %(default)s)')
+    parser.add_argument('--jobs', type=int, help='files read in parallel (default: CPU count)')
+    args = parser.parse_args(argv)
+
+    report = check_folder(args.folder, polarity=args.polarity, min_replicates=args.min_replicates, n_jobs=args.jobs)
+
+    print(report.files.drop(columns='file').to_string(index=False))
+    for level, message in report.issues:
+        print('%s: %s' % (level, message))
+
+    return 0 if report.ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,196 @@
+'''
+
+Command line entry point of MedPlant-AI. Runs the same preprocessing (xcms_may.R / xcms_mik.R) and
+feature engineering pipeline as the Streamlit app, without a browser, and writes the sample
+classification to a CSV or Parquet file.
+
+Each input is a zipped folder (as uploaded in the app) or a directory with one subfolder per sample
+holding its mzXML replicates. Zips are extracted into --workdir, directories are processed in place
+(the R script writes its peak table into them).
+
+Examples:
+
+    python qc_batch.py lots_2023_06.zip --species mikania --output predictions.csv
+    python qc_batch.py batch1/ batch2/ --species maytenus --output predictions.parquet
+    python qc_batch.py lots_2023_06.zip --species mikania --jobs 32
+    python qc_batch.py lots_2023_06.zip --species mikania --backend python
+    python qc_batch.py lots_2023_06_02.zip --species mikania --store stores/mikania
+    python qc_batch.py lots_2023_06.zip --species mikania --trace timings.json
+    python qc_batch.py lots_*.zip --species mikania --warm-r
+    python qc_batch.py lots_2023_06.zip --species mikania --mz-tol 0.5 --rt-tol 0.3
+    python qc_batch.py lots_2023_06.zip --species mikania --rt-reference
+    python qc_batch.py lots_2023_06.zip --species mikania --explain 5
+
+'''
+
+import argparse
+import os
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+import explain
+import qc_pipeline
+import incremental
+import r_worker
+import rt_align
+import tracing
+import xcms_cache
+import xcms_params
+
+
+def process_input(path, species, workdir, install=True, n_jobs=None, cache=None, store=None, backend='r', sparse=False,
+                  matching=None, check=True, alignment=None, explain_top=None):
+    '''
+
+    Runs the full pipeline (unzip, xcms, feature engineering and prediction) on one input and returns
+    the classification DataFrame. With a store (incremental.IncrementalStore), only the files that
+    are not in it yet are processed and classified. With sparse, the model input is built as a
+    sparse matrix (see qc_pipeline.model_input_sparse). matching are the tolerances of the feature
+    matching (see qc_pipeline.model_input), the reference windows are used if None. With check, the
+    mzXML files are checked first and an input that fails the check is not processed (see preflight).
+    alignment is passed to qc_pipeline.preprocess. With explain_top, the explanation of each
+    prediction (its explain_top most contributing features and the missing ones, see explain) is
+    added to the result.
+
+    '''
+    name = os.path.splitext(os.path.basename(os.path.normpath(path)))[0]
+    model = qc_pipeline.load_species_model(species)
+    samples = None
+    feature_names = None
+
+    if store is not None:
+        folder = path
+        if not os.path.isdir(path):
+            folder = os.path.join(workdir, name)
+            qc_pipeline.extract_zip(path, folder)
+
+        if check:
+            qc_pipeline.run_preflight(folder, species, n_jobs=n_jobs)
+
+        if install and species['install_packages']:
+            qc_pipeline.install_bioc_packages()
+
+        input_data_model = store.add_batch(folder, xcms_params.PARAMS[species['short_name']], batch=name, n_jobs=n_jobs)
+        if len(input_data_model) == 0:
+            return pd.DataFrame(columns=['batch', 'sample', 'prediction'])
+    else:
+        _, input_data, _ = qc_pipeline.preprocess(path, species, os.path.join(workdir, name), cache=cache,
+                                                  n_jobs=n_jobs, install=install, backend=backend, check=check,
+                                                  alignment=alignment)
+
+        ref_data = qc_pipeline.load_reference(species, model=model)
+        if sparse:
+            samples, input_data_model = qc_pipeline.model_input_sparse(ref_data, input_data, matching=matching)
+            # the columns of the matrix, see feature_eng.data_prep_sparse
+            feature_names = np.unique(ref_data['features'].astype(str))
+        else:
+            input_data_model = qc_pipeline.model_input(ref_data, input_data, matching=matching)
+
+    result = qc_pipeline.predict(model, input_data_model, samples=samples)
+    if explain_top:
+        with tracing.span('explain'):
+            result = result.merge(explain.explain(model, input_data_model, top=explain_top, samples=samples,
+                                                  feature_names=feature_names), on='sample')
+    result.insert(0, 'batch', os.path.basename(os.path.normpath(path)))
+
+    return result
+
+
+def write_result(result, output):
+    '''
+    writes the result as Parquet if the output file ends with .parquet, otherwise as CSV.
+    '''
+    if output.endswith('.parquet'):
+        result.to_parquet(output, index=False)
+    else:
+        result.to_csv(output, index=False)
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('inputs', nargs='+', help='zip files or directories with the mzXML files')
+    parser.add_argument('--species', required=True,
+                        help='species to classify: %s' % ', '.join(config['short_name'] for config in qc_pipeline.SPECIES.values()))
+    parser.add_argument('--output', default='predictions.csv', help='result file (.csv or .parquet)')
+    parser.add_argument('--workdir', help='folder to extract the zip files into (default: a temporary folder)')
+    parser.add_argument('--jobs', type=int,
+                        help='run the peak detection as one R process per file, JOBS at a time (cached per file)')
+    parser.add_argument('--cache-dir', default=xcms_cache.DEFAULT_CACHE_DIR, help='folder of the peak table cache')
+    parser.add_argument('--cache-size', type=float, default=xcms_cache.DEFAULT_MAX_BYTES / 2**30,
+                        help='size of the peak table cache, in GB (least recently used tables are removed)')
+    parser.add_argument('--no-cache', action='store_true', help='always run R, without reading or filling the cache')
+    parser.add_argument('--store',
+                        help='incremental mode: feature store folder, only the files not in it yet are processed and classified')
+    parser.add_argument('--skip-install', action='store_true', help='do not check/install the Bioconductor packages')
+    parser.add_argument('--backend', choices=['r', 'python'], default='r',
+                        help='peak detection with xcms (r) or with the NumPy implementation of peakpick (python, no R needed)')
+    parser.add_argument('--sparse', action='store_true',
+                        help='build the model input as a sparse float32 matrix (less memory for batches with many samples)')
+    parser.add_argument('--mz-tol', type=float,
+                        help='match the features by tolerance (one peak per reference feature): m/z tolerance in Da')
+    parser.add_argument('--ppm', type=float, help='m/z tolerance of the matching by tolerance, in ppm')
+    parser.add_argument('--rt-tol', type=float, help='rt tolerance of the matching by tolerance, in minutes (default 0.5)')
+    parser.add_argument('--warm-r', action='store_true',
+                        help='run the R scripts in long lived R processes that load xcms once (faster for many small inputs)')
+    parser.add_argument('--rt-reference', action='store_true',
+                        help='align the retention times of each file to the reference profile of the species (see rt_align) instead of retcor')
+    parser.add_argument('--skip-preflight', action='store_true',
+                        help='do not check the mzXML files (polarity, centroid mode, replicates...) before the preprocessing')
+    parser.add_argument('--explain', type=int, metavar='N',
+                        help='add the N features that contributed most to each prediction and the missing reference features')
+    parser.add_argument('--trace', help='JSON file to write the time and memory of each stage to')
+    args = parser.parse_args(argv)
+
+    matching = None
+    if args.mz_tol is not None or args.ppm is not None or args.rt_tol is not None:
+        if args.store:
+            parser.error('--store matches the features with the reference windows, the tolerances are not supported with it')
+        matching = {'mz_tol': args.mz_tol if args.mz_tol is not None else (0 if args.ppm else 0.5),
+                    'rt_tol': args.rt_tol if args.rt_tol is not None else 0.5, 'ppm': args.ppm}
+
+    if args.store and args.backend != 'r':
+        parser.error('--store uses the per file xcms peak detection, --backend python is not supported with it')
+
+    species = qc_pipeline.get_species(args.species)
+    workdir = args.workdir or tempfile.mkdtemp(prefix='medplant_')
+    store = None
+    if args.store:
+        rt_reference = rt_align.load_reference(species['rt_profile']) if args.rt_reference else None
+        store = incremental.IncrementalStore(args.store, qc_pipeline.load_reference(species), rt_reference=rt_reference)
+    cache = None if args.no_cache else xcms_cache.PeakTableCache(args.cache_dir, int(args.cache_size * 2**30))
+    if args.warm_r:
+        r_worker.start_pool(size=args.jobs or 1, prestart=True)
+
+    results = []
+    failed = 0
+    trace = tracing.Trace('qc_batch %s' % species['short_name'])
+    for path in args.inputs:
+        try:
+            with tracing.activate(trace), tracing.span('input', path=path):
+                results.append(process_input(path, species, workdir, install=not args.skip_install, n_jobs=args.jobs, cache=cache,
+                                             store=store, backend=args.backend, sparse=args.sparse, matching=matching,
+                                             check=not args.skip_preflight, alignment='reference' if args.rt_reference else None,
+                                             explain_top=args.explain))
+            print('%s: %d samples classified' % (path, len(results[-1])))
+        except Exception as error:
+            failed += 1
+            print('%s: %s' % (path, error), file=sys.stderr)
+
+    if args.trace:
+        with open(args.trace, 'w') as trace_file:
+            trace_file.write(trace.to_json(indent=1))
+        print(trace.summary().to_string(index=False))
+
+    if results:
+        write_result(pd.concat(results, ignore_index=True), args.output)
+        print('predictions written to %s' % args.output)
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
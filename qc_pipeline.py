@@ -0,0 +1,468 @@
+import functools
+import glob
+import os
+import pickle
+import subprocess
+import tempfile
+
+import pandas as pd
+
+import feature_eng
+import ingest
+import memo
+import model_store
+import peak_table
+import peakpick
+import preflight
+import ref_index
+import registry
+import rt_align
+import tracing
+import xcms_cache
+import xcms_parallel
+import xcms_params
+
+# ----------- Species configuration ----------- #
+
+# one entry per species in species.json, see registry
+SPECIES = registry.load_manifest()
+
+# CAMERA annotation columns, not used by the model
+ANNOTATION_COLUMNS = ['isotopes', 'adduct', 'pcgroup']
+# xcms group columns of the peak table, before the sample columns
+GROUP_COLUMNS = ['mz', 'mzmin', 'mzmax', 'rt', 'rtmin', 'rtmax', 'npeaks']
+
+
+def get_species(name):
+    '''
+    returns the configuration of a species, given its full name (e.g. 'Mikania laevigata') or short name (e.g. 'mikania').
+    '''
+    return registry.find_species(SPECIES, name)
+
+
+# ----------- R preprocessing ----------- #
+
+BIOC_PACKAGES = ['xcms', 'CAMERA']
+
+
+def bioc_packages_installed(lib='R_libs'):
+    '''
+    whether xcms and CAMERA are installed in the lib folder (checked on disk, without starting R).
+    '''
+    return all(os.path.exists(os.path.join(lib, package, 'DESCRIPTION')) for package in BIOC_PACKAGES)
+
+
+@functools.lru_cache(maxsize=None)
+def install_bioc_packages():
+    '''
+
+    Installs xcms and CAMERA (Bioconductor 3.11) in the R_libs folder, if they are not there yet.
+    Runs once per process.
+
+    '''
+    if bioc_packages_installed():
+        return
+
+    # Create a directory your app can write to
+    os.makedirs("R_libs", exist_ok=True)
+
+    r_code = """
+    # Set a custom library path
+    .libPaths(c("./R_libs", .libPaths()))
+
+    # Increase timeout and use multiple cores
+    options(timeout = 600)
+    options(Ncpus = 4)
+
+    # Use RStudio Package Manager for faster installations
+    options(repos = c(REPO_NAME = "https://packagemanager.rstudio.com/all/latest"))
+
+    # Install BiocManager if not already installed
+    if (!requireNamespace("BiocManager", quietly = TRUE))
+        install.packages("BiocManager", lib = "./R_libs")
+
+    # Use Bioconductor version 3.11
+    BiocManager::install(version = "3.11", lib = "./R_libs", ask = FALSE, dependencies = c("Imports", "Depends"))
+
+    # Update Matrix package
+    install.packages("Matrix", lib = "./R_libs", version = "1.3.0", ask = FALSE)
+
+    # Install specific versions of xcms and CAMERA
+    BiocManager::install("xcms", lib = "./R_libs", ask = FALSE, dependencies = c("Imports", "Depends"))
+    BiocManager::install("CAMERA", lib = "./R_libs", ask = FALSE, dependencies = c("Imports", "Depends"))
+
+    # Optional: the peak table is written as an Arrow file with it, as csv without
+    tryCatch(install.packages("arrow", lib = "./R_libs"),
+             error = function(e) message("arrow not installed, the peak table will be written as csv"))
+
+    # Verify installations
+    if (!requireNamespace("xcms", quietly = TRUE)) {
+        stop("xcms package not found!")
+    }
+    if (!requireNamespace("CAMERA", quietly = TRUE)) {
+        stop("CAMERA package not found!")
+    }
+    """
+
+    result = subprocess.run(["Rscript", "-e", r_code], text=True)
+
+    if result.returncode != 0:
+        raise Exception("Failed to install Bioconductor packages.")
+
+
+def extract_zip(zip_file, output_folder, progress=None):
+    '''
+
+    Extracts the mzXML files of the uploaded folder (path or file object) into output_folder, creating
+    it if needed. The files are streamed one at a time and their size is limited (see ingest).
+
+    '''
+    return ingest.extract_mzxml_zip(zip_file, output_folder, progress=progress)
+
+
+def run_xcms(script, params, output_folder, log=None):
+    '''
+
+    Runs the xcms/CAMERA R script inside output_folder, with params (xcms_params.PARAMS[species])
+    written to the R parameter file the script reads. xcms reads every mzXML file under it, using
+    the subfolders as sample classes, and the script writes the peak table there as a csv.
+
+    Returns the finished subprocess.CompletedProcess, with the R stdout. If log is given, it is
+    called with each line of the R output while the script runs.
+
+    '''
+    with tempfile.TemporaryDirectory() as tmp:
+        params_file = os.path.join(tmp, 'params.R')
+        xcms_params.write_r_params(params, params_file)
+        return xcms_parallel.run_rscript([script, params_file], cwd=output_folder, log=log)
+
+
+def run_preflight(folder, species, n_jobs=None, log=None):
+    '''
+
+    Checks the mzXML files of an upload (see preflight) against the polarity of the species. The
+    summary of the files and the warnings are passed to log; raises a preflight.PreflightError if
+    the upload has errors, and returns the preflight.Report otherwise.
+
+    '''
+    with tracing.span('preflight'):
+        report = preflight.check_folder(folder, polarity=species.get('polarity'), n_jobs=n_jobs)
+
+    if log is not None:
+        for line in report.files.drop(columns='file').to_string(index=False).splitlines():
+            log(line)
+        for level, message in report.issues:
+            log('%s: %s' % (level, message))
+
+    report.raise_for_errors()
+
+    return report
+
+
+def sample_class_names(output_folder):
+    '''
+
+    Names of the sample folders (the subfolders of each directory in output_folder). xcms uses them
+    as sample classes and getPeaklist adds one column per class, which is not an intensity column.
+
+    '''
+    folder_names = []
+
+    for subfolder_name in sorted(os.listdir(output_folder)):
+        subfolder_path = os.path.join(output_folder, subfolder_name)
+        if os.path.isdir(subfolder_path):
+            folder_names += [name for name in sorted(os.listdir(subfolder_path))
+                             if os.path.isdir(os.path.join(subfolder_path, name))]
+
+    return folder_names
+
+
+def read_peak_table(output_folder):
+    '''
+
+    Reads the peak table written by the R script in output_folder and drops the sample class columns.
+
+    Returns the file path and the DataFrame. The table is an Arrow file (see peak_table), whose
+    metadata lists the sample class columns, or a csv if R had no arrow package; the class columns
+    of a csv are found from the folder names. If more than one table is found, the newest is used.
+
+    '''
+    table_files = [path for extension in peak_table.EXTENSIONS
+                   for path in glob.glob(os.path.join(output_folder, '*' + extension))]
+
+    if len(table_files) == 0:
+        raise FileNotFoundError('No CSV file found in %s.' % output_folder)
+
+    table_file = max(table_files, key=os.path.getmtime)
+    if table_file.endswith(peak_table.ARROW_EXTENSION):
+        return table_file, peak_table.read_arrow(table_file)
+
+    input_data = pd.read_csv(table_file, index_col=[0])
+
+    folder_names = [name for name in sample_class_names(output_folder) if name in input_data.columns]
+
+    return table_file, input_data.drop(folder_names, axis=1)
+
+
+def preprocess(upload, species, output_folder, cache=None, n_jobs=None, install=True, progress=None, backend='r',
+               log=None, check=True, alignment=None):
+    '''
+
+    Runs the R preprocessing of an upload and returns the path of the peak table file, the peak
+    table (as read_peak_table) and the R output. If cache has a table for the same mzXML content and R parameters, it is returned
+    instead and R is not run (the R output is then None).
+
+
+    Parameters
+    ----------
+    upload : str or file object, default None
+        Zipped folder (path or file object) or a directory with the mzXML files. A directory is
+        processed in place, a zip is extracted into output_folder.
+
+    species : dict, default None
+        Species configuration, as returned by get_species.
+
+    output_folder : str, default None
+        Folder where the zip is extracted and the R script is run.
+
+    cache : xcms_cache.PeakTableCache, default None
+        Cache of peak tables. Not used if None.
+
+    n_jobs : int, default None
+        If given, the peak detection runs on n_jobs parallel R processes (see xcms_parallel),
+        otherwise the species R script runs once on the whole folder.
+
+    install : bool, default True
+        Whether to install the Bioconductor packages first, for the species that need it.
+
+    progress : callable, default None
+        Called during the extraction of a zip, see ingest.extract_mzxml_zip.
+
+    backend : str, default 'r'
+        'r' for xcms/CAMERA, or 'python' for the NumPy peak detection and grouping of peakpick
+        (same xcms parameters, no R needed; n_jobs and install are then not used).
+
+    log : callable, default None
+        Called with each line of the R output (or progress messages) while the preprocessing runs.
+
+    check : bool, default True
+        Whether the mzXML files are checked before the preprocessing (see run_preflight). The
+        preflight.PreflightError of a bad upload is raised before R is started.
+
+    alignment : str, default None
+        'reference' to align the retention times of each file to the reference profile of the
+        species (see rt_align) instead of retcor. The R preprocessing then runs per file, on n_jobs
+        (or the CPU count) parallel R processes.
+
+    '''
+    if backend not in ('r', 'python'):
+        raise ValueError("backend must be 'r' or 'python', not %r" % backend)
+    if alignment not in (None, 'reference'):
+        raise ValueError("alignment must be None or 'reference', not %r" % alignment)
+
+    reference = None
+    if alignment == 'reference':
+        reference = rt_align.load_reference(species['rt_profile'])
+        # the species scripts run retcor on the whole folder, the per file preprocessing can skip it
+        if backend == 'r' and not n_jobs:
+            n_jobs = os.cpu_count()
+
+    is_folder = isinstance(upload, str) and os.path.isdir(upload)
+
+    if backend == 'python':
+        params_text = 'python\n' + xcms_params.r_parameter_block(xcms_params.PARAMS[species['short_name']])
+    elif n_jobs:
+        params_text = 'parallel\n' + xcms_params.r_parameter_block(xcms_params.PARAMS[species['short_name']])
+    else:
+        # the parameters as the parallel path, plus the code of the species script and of the helpers it sources
+        params_text = 'script\n' + xcms_params.r_parameter_block(xcms_params.PARAMS[species['short_name']])
+        for path in (species['script'], xcms_parallel.COMMON_SCRIPT):
+            with open(path) as script:
+                params_text += script.read()
+    if reference is not None:
+        params_text += '\nreference %s\n' % reference['hash']
+
+    key = None
+    if cache is not None:
+        with tracing.span('cache lookup'):
+            if is_folder:
+                content_hash = xcms_cache.folder_content_hash(upload)
+            else:
+                content_hash = xcms_cache.zip_content_hash(upload)
+                if hasattr(upload, 'seek'):
+                    upload.seek(0)
+
+            key = xcms_cache.cache_key(content_hash, params_text)
+            cached = cache.get(key)
+
+        if cached is not None:
+            return cached + (None,)
+
+    if is_folder:
+        output_folder = upload
+    else:
+        with tracing.span('unzip'):
+            extract_zip(upload, output_folder, progress=progress)
+
+    if check:
+        run_preflight(output_folder, species, n_jobs=n_jobs, log=log)
+
+    # the steps timed by the R scripts are recorded in the current trace, if any
+    if tracing.current() is not None:
+        log = tracing.log_filter(log)
+
+    warps = None
+    if reference is not None:
+        with tracing.span('rt warps'):
+            files = list(xcms_parallel.find_mzxml(output_folder)['file'])
+            warps = rt_align.warp_files(files, reference, n_jobs=n_jobs, log=log)
+
+    if backend == 'python':
+        with tracing.span('peakpick'):
+            input_data = peakpick.peaklist(output_folder, xcms_params.PARAMS[species['short_name']], warps=warps)
+            sample_columns = [name for name in input_data.columns if name not in GROUP_COLUMNS + ANNOTATION_COLUMNS]
+            peak_table.write_arrow(input_data, os.path.join(output_folder, 'peakpick.arrow'), sample_columns)
+        process = subprocess.CompletedProcess(['peakpick'], 0, stdout=('%d features\n' % len(input_data)).encode())
+        if log is not None:
+            log(process.stdout.decode().strip())
+    else:
+        if install and species['install_packages']:
+            with tracing.span('install'):
+                install_bioc_packages()
+
+        with tracing.span('xcms'):
+            if n_jobs:
+                process = xcms_parallel.run_xcms_parallel(xcms_params.PARAMS[species['short_name']], output_folder,
+                                                          n_jobs=n_jobs, warps=warps, log=log)
+            else:
+                process = run_xcms(species['script'], xcms_params.PARAMS[species['short_name']], output_folder, log=log)
+
+    if process.returncode != 0:
+        raise RuntimeError('xcms failed (exit code %d)' % process.returncode)
+
+    with tracing.span('read peak table'):
+        csv_file, input_data = read_peak_table(output_folder)
+
+    if cache is not None:
+        csv_file = cache.put(key, input_data)
+
+    return csv_file, input_data, process.stdout
+
+
+# ----------- Model ----------- #
+
+def load_model(model_path):
+    '''
+
+    model_path: path to model file. Eg: 'C:/Users/name/Documents/dev/model.pkl'
+
+    '''
+    with open(model_path, 'rb') as model_file:
+        pickled_model = pickle.load(model_file)
+    return pickled_model
+
+
+def load_species_model(species):
+    '''
+    model of a species from its memory mapped artifact (see model_store), built from the pickle if needed.
+    '''
+    return model_store.load(species['model'], species['model_artifact'])
+
+
+def load_refdata(ref_path):
+    '''
+    returns the data used for training. It will be a reference data to create the feature names of input data.
+    '''
+    return pd.read_csv(ref_path)
+
+
+def load_reference(species, model=None):
+    '''
+
+    Returns the reference windows and feature names of a species from its binary index (see
+    ref_index), without the training intensities. Checked against the model if one is given.
+
+    '''
+    return ref_index.load_reference(species['ref_data'], species['ref_index'], model=model, name=species['short_name'])
+
+
+def match_features(ref_data, input_data_rounded, matching=None):
+    '''
+    names the features of the rounded peak table: with the reference windows (feature_eng.feature_correspondance),
+    or with the tolerances of matching (feature_eng.feature_matching), e.g. {'mz_tol': 0.5, 'rt_tol': 0.3, 'ppm': None}.
+    '''
+    if matching is None:
+        with tracing.span('feature_correspondance'):
+            return feature_eng.feature_correspondance(ref_data, input_data_rounded)
+
+    with tracing.span('feature_matching'):
+        return feature_eng.feature_matching(ref_data, input_data_rounded, **matching)
+
+
+def model_input(ref_data, input_data, matching=None):
+    '''
+
+    Runs the feature engineering pipeline (rounder, feature_correspondance, data_cleaning and data_prep)
+    on the peak table and returns the samples x features matrix expected by the model.
+
+
+    Parameters
+    ----------
+    ref_data : pandas DataFrame, default None
+        Data used for training, as returned by load_refdata or load_reference.
+
+    input_data : pandas DataFrame, default None
+        Peak table as returned by read_peak_table.
+
+    matching : dict, default None
+        Tolerances of feature_eng.feature_matching, used instead of feature_correspondance if given.
+
+    '''
+    with tracing.span('rounder'):
+        input_data_rounded = feature_eng.rounder(input_data.drop(ANNOTATION_COLUMNS, axis=1, errors='ignore'))
+    input_data_feat = match_features(ref_data, input_data_rounded, matching)
+    with tracing.span('data_cleaning'):
+        _, input_data_clean = feature_eng.data_cleaning(ref_data, input_data_feat)
+    with tracing.span('data_prep'):
+        input_data_prep = feature_eng.data_prep(ref_data, input_data_clean)
+
+    return input_data_prep.set_index('index').T
+
+
+def model_input_sparse(ref_data, input_data, matching=None):
+    '''
+
+    Same pipeline as model_input, but the samples x features matrix is built as a float32 CSR matrix
+    (see feature_eng.data_prep_sparse), for large batches. Returns the sample names and the matrix,
+    which the model Pipeline accepts as is.
+
+    '''
+    with tracing.span('rounder'):
+        input_data_rounded = feature_eng.rounder(input_data.drop(ANNOTATION_COLUMNS, axis=1, errors='ignore'))
+    input_data_feat = match_features(ref_data, input_data_rounded, matching)
+    with tracing.span('data_cleaning'):
+        _, input_data_clean = feature_eng.data_cleaning(ref_data, input_data_feat)
+    with tracing.span('data_prep_sparse'):
+        samples, _, matrix = feature_eng.data_prep_sparse(ref_data, input_data_clean)
+
+    return samples, matrix
+
+
+# model inputs of the peak tables already seen (by content), shared by every session of the app
+feature_memo = memo.Memo()
+cached_model_input = feature_memo.memoize(model_input)
+
+
+def predict(model, input_data_model, samples=None):
+    '''
+
+    Returns a DataFrame with the sample names and the probability given by the model to each of them.
+    The names are the index of input_data_model, or samples for a matrix (see model_input_sparse).
+
+    '''
+    result = pd.DataFrame(input_data_model.index if samples is None else pd.Index(samples))
+    with tracing.span('predict_proba'):
+        result['prediction'] = model.predict_proba(input_data_model)[:, 1]
+    result.rename(columns={0:'sample'},inplace=True)
+
+    return result
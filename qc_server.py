@@ -0,0 +1,505 @@
+'''
+
+Local HTTP prediction service, for a LIMS pushing peak tables that were already preprocessed.
+
+The models and reference indexes of every species of species.json are loaded once and kept in
+memory. Each request is turned into a model input (qc_pipeline.model_input_sparse) in its own thread;
+the inputs of the requests arriving at the same time are then stacked and classified by a single
+predict_proba call per species (micro-batching), which costs about the same as the call for one
+request.
+
+Endpoints:
+
+    POST /predict?species=mikania   peak table as csv (text/csv) or Arrow IPC
+                                    (application/vnd.apache.arrow.file), as read_peak_table returns it;
+                                    answers {"species": ..., "predictions": [{"sample": ..., "prediction": ...}]},
+                                    404 for an unknown species, 503 for one whose reference is not installed
+    GET  /stats                     requests, throughput, latency percentiles and batch sizes
+    GET  /health                    species and models loaded
+
+Usage:
+
+    python qc_server.py --port 8502
+    python qc_server.py --client http://127.0.0.1:8502 --species mikania --table data.csv --requests 200 --concurrency 8
+
+'''
+
+import argparse
+import collections
+import io
+import json
+import os
+import queue
+import sys
+import threading
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.ipc
+from scipy import sparse
+
+import peak_table
+import qc_pipeline
+import ref_index
+import registry
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8502
+DEFAULT_MAX_BATCH_ROWS = 4096
+DEFAULT_MAX_WAIT = 0.005
+
+ARROW_TYPE = 'application/vnd.apache.arrow.file'
+CSV_TYPE = 'text/csv'
+
+
+class ServerStats:
+    '''
+
+    Counters and latencies of the requests handled by the server (the latencies of the last window
+    requests are kept for the percentiles).
+
+    '''
+
+    def __init__(self, window=10000):
+        self.started = time.time()
+        self.requests = 0
+        self.samples = 0
+        self.errors = 0
+        self.batches = 0
+        self.batch_requests = 0
+        self.batch_rows = 0
+        self.predict_seconds = 0.0
+        self._latencies = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record_request(self, seconds, samples):
+        with self._lock:
+            self.requests += 1
+            self.samples += samples
+            self._latencies.append(seconds)
+
+    def record_error(self):
+        with self._lock:
+            self.errors += 1
+
+    def record_batch(self, requests, rows, seconds):
+        with self._lock:
+            self.batches += 1
+            self.batch_requests += requests
+            self.batch_rows += rows
+            self.predict_seconds += seconds
+
+    def snapshot(self):
+        '''
+        dict with the counters, the throughput since the start and the latency percentiles in ms.
+        '''
+        with self._lock:
+            uptime = time.time() - self.started
+            latencies = np.array(self._latencies) * 1000
+            stats = {
+                'uptime_s': round(uptime, 1),
+                'requests': self.requests,
+                'samples': self.samples,
+                'errors': self.errors,
+                'requests_per_s': round(self.requests / uptime, 2) if uptime else 0,
+                'samples_per_s': round(self.samples / uptime, 2) if uptime else 0,
+                'batches': self.batches,
+                'requests_per_batch': round(self.batch_requests / self.batches, 2) if self.batches else 0,
+                'rows_per_batch': round(self.batch_rows / self.batches, 1) if self.batches else 0,
+                'predict_ms_per_batch': round(1000 * self.predict_seconds / self.batches, 2) if self.batches else 0,
+            }
+
+        for percentile in (50, 90, 99):
+            stats['latency_p%d_ms' % percentile] = round(float(np.percentile(latencies, percentile)), 2) if len(latencies) else None
+        stats['latency_max_ms'] = round(float(latencies.max()), 2) if len(latencies) else None
+
+        return stats
+
+
+class MicroBatcher:
+    '''
+
+    Thread classifying the model inputs of one species. The inputs submitted while a predict_proba
+    call runs (or within max_wait seconds of the first one) are stacked into a single call.
+
+
+    Parameters
+    ----------
+    model : sklearn estimator, default None
+        Model of the species.
+
+    max_rows : int, default 4096
+        Number of samples above which a batch is not extended any more.
+
+    max_wait : float, default 0.005
+        Seconds the first input of a batch waits for others.
+
+    stats : ServerStats, default None
+        Where the batches are counted.
+
+    '''
+
+    def __init__(self, model, max_rows=DEFAULT_MAX_BATCH_ROWS, max_wait=DEFAULT_MAX_WAIT, stats=None):
+        self.model = model
+        self.max_rows = max_rows
+        self.max_wait = max_wait
+        self.stats = stats
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._loop, name='micro-batcher', daemon=True)
+        self._thread.start()
+
+    def predict(self, matrix):
+        '''
+        probabilities of the rows of matrix (a model input), once its batch is done.
+        '''
+        future = Future()
+        self._queue.put((matrix, future))
+        return future.result()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _next_batch(self, first):
+        batch = [first]
+        rows = first[0].shape[0]
+        deadline = time.perf_counter() + self.max_wait
+
+        while rows < self.max_rows:
+            timeout = deadline - time.perf_counter()
+            try:
+                item = self._queue.get(timeout=max(timeout, 0)) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                # closing: the batch is finished first
+                self._queue.put(None)
+                break
+            batch.append(item)
+            rows += item[0].shape[0]
+
+        return batch, rows
+
+    def _loop(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+
+            batch, rows = self._next_batch(first)
+            start = time.perf_counter()
+
+            try:
+                matrix = sparse.vstack([matrix for matrix, _ in batch], format='csr')
+                proba = self.model.predict_proba(matrix)[:, 1]
+            except Exception as error:
+                for _, future in batch:
+                    future.set_exception(error)
+                continue
+
+            if self.stats is not None:
+                self.stats.record_batch(len(batch), rows, time.perf_counter() - start)
+
+            offsets = np.cumsum([0] + [matrix.shape[0] for matrix, _ in batch])
+            for (_, future), begin, end in zip(batch, offsets[:-1], offsets[1:]):
+                future.set_result(proba[begin:end])
+
+
+class PredictionService:
+    '''
+
+    Models of the species, one MicroBatcher each, and the statistics of the server.
+
+
+    Parameters
+    ----------
+    species_registry : registry.Registry, default None
+        Species to serve. All the species of species.json, kept loaded, if None.
+
+    max_rows, max_wait : see MicroBatcher.
+
+    '''
+
+    def __init__(self, species_registry=None, max_rows=DEFAULT_MAX_BATCH_ROWS, max_wait=DEFAULT_MAX_WAIT):
+        if species_registry is None:
+            manifest = registry.load_manifest()
+            species_registry = registry.Registry(manifest, max_loaded=len(manifest))
+
+        self.registry = species_registry
+        self.max_rows = max_rows
+        self.max_wait = max_wait
+        self.stats = ServerStats()
+        self._batchers = {}
+        self._lock = threading.Lock()
+
+    def preload(self):
+        '''
+        loads every species now instead of on its first request. Returns the names of the ones that
+        could not be loaded (e.g. a missing reference) with the error.
+        '''
+        failed = {}
+        for name in self.registry.names():
+            try:
+                self.batcher(name)
+            except Exception as error:
+                failed[name] = str(error)
+        return failed
+
+    def batcher(self, species):
+        name = self.registry.species(species)['name']
+
+        with self._lock:
+            if name not in self._batchers:
+                self._batchers[name] = MicroBatcher(self.registry.model(name), self.max_rows, self.max_wait, self.stats)
+            return self._batchers[name]
+
+    def predict(self, species, input_data):
+        '''
+        DataFrame with the sample names and predictions of a peak table, as qc_pipeline.predict.
+        '''
+        artifacts = self.registry.artifacts(species)
+        samples, matrix = qc_pipeline.model_input_sparse(artifacts.reference, input_data)
+
+        result = pd.DataFrame({'sample': samples})
+        result['prediction'] = self.batcher(species).predict(matrix)
+
+        return result
+
+    def close(self):
+        with self._lock:
+            batchers, self._batchers = self._batchers, {}
+        for batcher in batchers.values():
+            batcher.close()
+
+
+def read_body_table(body, content_type):
+    '''
+    peak table sent in a request body, as csv or Arrow IPC.
+    '''
+    if content_type.split(';')[0].strip() == ARROW_TYPE:
+        input_data = peak_table.read_arrow(body)
+    else:
+        input_data = pd.read_csv(io.BytesIO(body), index_col=[0])
+
+    missing = [column for column in qc_pipeline.GROUP_COLUMNS if column not in input_data.columns]
+    if missing:
+        raise ValueError('The peak table has no %s column.' % ', '.join(missing))
+
+    return input_data
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    @property
+    def service(self):
+        return self.server.service
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = urllib.parse.urlparse(self.path).path
+
+        if path == '/stats':
+            self.send_json(200, self.service.stats.snapshot())
+        elif path == '/health':
+            self.send_json(200, {'species': self.service.registry.names(), 'loaded': self.service.registry.loaded()})
+        else:
+            self.send_json(404, {'error': 'Unknown path %s.' % path})
+
+    def do_POST(self):
+        url = urllib.parse.urlparse(self.path)
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        if url.path != '/predict':
+            self.send_json(404, {'error': 'Unknown path %s.' % url.path})
+            return
+
+        start = time.perf_counter()
+        species = urllib.parse.parse_qs(url.query).get('species', [''])[0]
+
+        # only an unknown species is a 404, a KeyError of the prediction itself is a server error
+        try:
+            name = self.service.registry.species(species)['name']
+        except registry.UnknownSpecies as error:
+            self.service.stats.record_error()
+            self.send_json(404, {'error': error.args[0]})
+            return
+
+        try:
+            input_data = read_body_table(body, self.headers.get('Content-Type', CSV_TYPE))
+            result = self.service.predict(name, input_data)
+        except (ValueError, pa.ArrowInvalid, pd.errors.ParserError) as error:
+            self.service.stats.record_error()
+            self.send_json(400, {'error': str(error)})
+            return
+        except ref_index.ReferenceNotAvailable as error:
+            # a species of the manifest that is not installed on this server
+            self.service.stats.record_error()
+            self.send_json(503, {'error': str(error)})
+            return
+        except Exception as error:
+            self.service.stats.record_error()
+            self.send_json(500, {'error': '%s: %s' % (type(error).__name__, error)})
+            return
+
+        self.service.stats.record_request(time.perf_counter() - start, len(result))
+        self.send_json(200, {'species': name, 'predictions': result.to_dict(orient='records')})
+
+
+def make_server(service, host=DEFAULT_HOST, port=DEFAULT_PORT, verbose=False):
+    '''
+    HTTP server of the service (not started, see serve_forever). Port 0 picks a free port.
+    '''
+    server = ThreadingHTTPServer((host, port), RequestHandler)
+    server.daemon_threads = True
+    server.service = service
+    server.verbose = verbose
+    return server
+
+
+# ----------- Client ----------- #
+
+class Client:
+    '''
+
+    Client of the prediction service, e.g. Client('http://127.0.0.1:8502').predict('mikania', table).
+
+    '''
+
+    def __init__(self, url, timeout=300):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def _request(self, path, body=None, content_type=None):
+        request = urllib.request.Request(self.url + path, data=body,
+                                         headers={'Content-Type': content_type} if content_type else {})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+    def predict(self, species, input_data):
+        '''
+        predictions of a peak table (DataFrame, or path of an .arrow or .csv file) as a DataFrame.
+        '''
+        if isinstance(input_data, str):
+            with open(input_data, 'rb') as table_file:
+                body = table_file.read()
+            content_type = ARROW_TYPE if input_data.endswith(peak_table.ARROW_EXTENSION) else CSV_TYPE
+        else:
+            body = encode_arrow(input_data)
+            content_type = ARROW_TYPE
+
+        answer = self._request('/predict?species=%s' % urllib.parse.quote(species), body, content_type)
+        return pd.DataFrame(answer['predictions'], columns=['sample', 'prediction'])
+
+    def stats(self):
+        return self._request('/stats')
+
+    def health(self):
+        return self._request('/health')
+
+
+def encode_arrow(input_data):
+    '''
+    Arrow IPC bytes of a peak table, as a request body.
+    '''
+    table = pa.Table.from_pandas(input_data.rename_axis('rowname').reset_index(), preserve_index=False)
+    table = table.replace_schema_metadata(dict(table.schema.metadata or {}, index_column='rowname'))
+
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def load_test(client, species, input_data, requests=100, concurrency=8):
+    '''
+
+    Sends the same peak table requests times from concurrency threads. Returns the throughput and the
+    latency percentiles seen by the client.
+
+    '''
+    def one(_):
+        start = time.perf_counter()
+        client.predict(species, input_data)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = np.array(list(pool.map(one, range(requests)))) * 1000
+    seconds = time.perf_counter() - start
+
+    return {
+        'requests': requests,
+        'concurrency': concurrency,
+        'seconds': round(seconds, 3),
+        'requests_per_s': round(requests / seconds, 2),
+        'latency_p50_ms': round(float(np.percentile(latencies, 50)), 2),
+        'latency_p90_ms': round(float(np.percentile(latencies, 90)), 2),
+        'latency_p99_ms': round(float(np.percentile(latencies, 99)), 2),
+    }
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default=DEFAULT_HOST, help='address to listen on')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='port to listen on')
+    parser.add_argument('--max-batch-rows', type=int, default=DEFAULT_MAX_BATCH_ROWS,
+                        help='number of samples above which concurrent requests are not batched together')
+    parser.add_argument('--max-wait-ms', type=float, default=DEFAULT_MAX_WAIT * 1000,
+                        help='time a request waits for others to share its predict_proba call')
+    parser.add_argument('--verbose', action='store_true', help='log every request')
+    parser.add_argument('--client', metavar='URL', help='load test a running server instead of starting one')
+    parser.add_argument('--species', help='species of the load test')
+    parser.add_argument('--table', help='peak table (.csv or .arrow) sent by the load test')
+    parser.add_argument('--requests', type=int, default=100, help='number of requests of the load test')
+    parser.add_argument('--concurrency', type=int, default=8, help='number of concurrent requests of the load test')
+    args = parser.parse_args(argv)
+
+    if args.client:
+        if not (args.species and args.table):
+            parser.error('--client needs --species and --table')
+
+        client = Client(args.client)
+        print(json.dumps(load_test(client, args.species, args.table, args.requests, args.concurrency), indent=1))
+        print(json.dumps(client.stats(), indent=1))
+        return 0
+
+    service = PredictionService(max_rows=args.max_batch_rows, max_wait=args.max_wait_ms / 1000)
+    for name, error in service.preload().items():
+        print('%s not loaded: %s' % (name, error), file=sys.stderr)
+
+    server = make_server(service, args.host, args.port, verbose=args.verbose)
+    print('serving %s on http://%s:%d' % (', '.join(service.registry.loaded()), *server.server_address[:2]))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,257 @@
+'''
+
+Warm R processes for the preprocessing scripts.
+
+Every Rscript started for a run loads xcms, CAMERA and their Bioconductor dependencies again, which
+takes several seconds before any file is read. An RWorker is a long lived Rscript (r_worker.R) that
+loads them once and then runs the scripts it is sent one after the other, with their own working
+directory and arguments, so a small upload is processed in about the time of the xcms steps alone.
+
+A WorkerPool starts up to size workers as scripts come and keeps them for the next ones. When a pool
+is started with start_pool, xcms_parallel.run_rscript sends the scripts to it instead of starting
+Rscript (the scripts themselves are unchanged):
+
+    r_worker.start_pool(size=2, prestart=True)
+    qc_pipeline.preprocess(...)
+    r_worker.stop_pool()
+
+A worker is restarted after max_jobs scripts, or if its R process dies (the script then fails as
+with a cold Rscript).
+
+'''
+
+import atexit
+import os
+import shutil
+import subprocess
+import threading
+
+import tracing
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+WORKER_SCRIPT = os.path.join(BASE_DIR, 'r_worker.R')
+
+DEFAULT_POOL_SIZE = 1
+DEFAULT_MAX_JOBS = 50
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class RWorker:
+    '''
+
+    One long lived R process running scripts sent to it, one at a time.
+
+
+    Parameters
+    ----------
+    max_jobs : int, default 50
+        Number of scripts after which the R process is restarted (R does not give all the memory of
+        a run back).
+
+    '''
+
+    def __init__(self, max_jobs=DEFAULT_MAX_JOBS):
+        self.max_jobs = max_jobs
+        self.jobs_done = 0
+        self._process = None
+        self._lock = threading.Lock()
+
+    def alive(self):
+        return self._process is not None and self._process.poll() is None
+
+    def start(self):
+        '''
+        starts the R process and waits until it has loaded the libraries.
+        '''
+        with tracing.span('R worker start'):
+            # the working directory is the one Rscript would have, for the ./R_libs library path
+            self._process = subprocess.Popen(['Rscript', WORKER_SCRIPT], stdin=subprocess.PIPE,
+                                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            self.jobs_done = 0
+
+            output = []
+            for line in self._process.stdout:
+                if line.rstrip(b'\n') == b'READY':
+                    return
+                output.append(line)
+
+        self._process.wait()
+        raise RuntimeError('The R worker did not start (exit code %s):\n%s'
+                           % (self._process.returncode, b''.join(output).decode(errors='replace')))
+
+    def stop(self):
+        if self._process is None:
+            return
+
+        if self.alive():
+            self._process.stdin.close()
+            try:
+                self._process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self._process.kill()
+                self._process.wait()
+        self._process = None
+
+    def run(self, script, args=(), cwd=None, log=None):
+        '''
+
+        Runs an R script in the worker, starting or restarting its R process if needed. Returns a
+        subprocess.CompletedProcess like xcms_parallel.run_rscript, with the output of the script
+        (stdout and stderr). If log is given, it is called with each line of the output.
+
+        '''
+        # relative paths are relative to cwd, as for an Rscript started there
+        cwd = os.path.abspath(cwd or os.getcwd())
+        fields = ['RUN', cwd, os.path.join(cwd, script)] + [str(arg) for arg in args]
+        if any('\t' in field or '\n' in field for field in fields):
+            raise ValueError('The arguments of an R worker job can not contain tabs or newlines: %r' % fields)
+
+        with self._lock:
+            if not self.alive() or self.jobs_done >= self.max_jobs:
+                self.stop()
+                self.start()
+
+            self._process.stdin.write(('\t'.join(fields) + '\n').encode())
+            self._process.stdin.flush()
+
+            lines = []
+            returncode = None
+            for line in self._process.stdout:
+                text = line.decode(errors='replace').rstrip('\n')
+                if text.startswith('DONE\t'):
+                    returncode = int(text.split('\t')[1])
+                    break
+                lines.append(line)
+                if log is not None:
+                    log(text)
+
+            self.jobs_done += 1
+
+            # the R process died during the script (e.g. a crash in a C routine)
+            if returncode is None:
+                returncode = self._process.wait() or 1
+                self._process = None
+
+        return subprocess.CompletedProcess(['r_worker', script] + list(args), returncode, stdout=b''.join(lines))
+
+
+class WorkerPool:
+    '''
+
+    RWorkers shared by the threads running scripts. A script is run by an idle worker, by a new one
+    if fewer than size were started, or else waits for a worker to be done: the workers are started
+    on demand and reused, never started for a single script (e.g. the parallel peak detection of
+    more files than workers).
+
+
+    Parameters
+    ----------
+    size : int, default 1
+        Largest number of workers (R processes) of the pool.
+
+    max_jobs : int, default 50
+        See RWorker.
+
+    '''
+
+    def __init__(self, size=DEFAULT_POOL_SIZE, max_jobs=DEFAULT_MAX_JOBS):
+        self.size = size
+        self.max_jobs = max_jobs
+        self._idle = []
+        self._started = 0
+        self._available = threading.Condition()
+
+    def _acquire(self):
+        with self._available:
+            while not self._idle and self._started >= self.size:
+                self._available.wait()
+            if self._idle:
+                return self._idle.pop()
+            self._started += 1
+        return RWorker(max_jobs=self.max_jobs)
+
+    def _release(self, worker):
+        # a worker whose R process died is restarted by its next run
+        with self._available:
+            self._idle.append(worker)
+            self._available.notify()
+
+    def prestart(self):
+        '''
+        starts the workers in a background thread, so the first run does not wait for R. Errors
+        (e.g. R not installed) are left to the first run.
+        '''
+        def start():
+            while True:
+                with self._available:
+                    if self._started >= self.size:
+                        return
+                    self._started += 1
+
+                worker = RWorker(max_jobs=self.max_jobs)
+                try:
+                    worker.start()
+                except (OSError, RuntimeError):
+                    return
+                finally:
+                    # a worker that did not start is started by its first run
+                    self._release(worker)
+
+        threading.Thread(target=start, name='r-worker-start', daemon=True).start()
+
+    def run(self, script, args=(), cwd=None, log=None):
+        '''
+        runs a script on a warm worker, see RWorker.run.
+        '''
+        worker = self._acquire()
+        try:
+            return worker.run(script, args, cwd=cwd, log=log)
+        finally:
+            self._release(worker)
+
+    def stop(self):
+        with self._available:
+            idle, self._idle = self._idle, []
+            self._started -= len(idle)
+        for worker in idle:
+            worker.stop()
+
+
+def start_pool(size=DEFAULT_POOL_SIZE, max_jobs=DEFAULT_MAX_JOBS, prestart=False):
+    '''
+    makes xcms_parallel.run_rscript use a pool of warm workers (the one already started, if any).
+    Returns None, and the scripts are run with a cold Rscript, if Rscript is not on the PATH.
+    '''
+    global _pool
+
+    if shutil.which('Rscript') is None:
+        return None
+
+    with _pool_lock:
+        if _pool is None:
+            _pool = WorkerPool(size=size, max_jobs=max_jobs)
+            if prestart:
+                _pool.prestart()
+
+    return _pool
+
+
+def active_pool():
+    '''
+    the pool started with start_pool, or None (scripts are run with a cold Rscript).
+    '''
+    return _pool
+
+
+@atexit.register
+def stop_pool():
+    global _pool
+
+    with _pool_lock:
+        pool, _pool = _pool, None
+
+    if pool is not None:
+        pool.stop()
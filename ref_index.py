@@ -0,0 +1,173 @@
+'''
+
+Compact binary index of the reference data (ref_data_*.csv).
+
+The feature engineering only needs the feature names and the mz/rt windows of the reference, not the
+intensity columns of the training samples (most of the csv). The index keeps just those, as one
+NumPy structured array saved as .npy next to the model: float32 windows, the npeaks priority and the
+feature name, with the rows already in the order used by feature_correspondance (higher npeaks
+first). It is memory mapped when loaded, so opening it costs almost nothing.
+
+The index is built once (at packaging time, or on the first load if it is missing or older than the
+csv) and checked against the number of features the model was trained with:
+
+    python ref_index.py ref_data_mikania.csv ref_index_mikania.npy --model model_mikania.pkl
+
+'''
+
+import argparse
+import os
+import pickle
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+WINDOW_COLUMNS = ['mz', 'mzmin', 'mzmax', 'rt', 'rtmin', 'rtmax']
+
+
+class ReferenceNotAvailable(FileNotFoundError):
+    '''
+    neither the reference data csv nor the index of a species is installed.
+    '''
+
+
+def build_index(ref_data):
+    '''
+
+    Structured array with the features, windows (float32) and npeaks (int32) of the reference, in
+    the order of feature_correspondance (sorted by npeaks, higher first).
+
+    '''
+    ref_data = ref_data.sort_values('npeaks', ascending=False, ignore_index=True)
+
+    features = ref_data['features'].astype(str)
+    dtype = ([('features', 'U%d' % max(features.str.len().max(), 1))]
+             + [(column, np.float32) for column in WINDOW_COLUMNS] + [('npeaks', np.int32)])
+
+    index = np.empty(len(ref_data), dtype=dtype)
+    index['features'] = features.to_numpy()
+    for column in WINDOW_COLUMNS:
+        index[column] = ref_data[column].to_numpy(dtype=np.float32)
+    index['npeaks'] = ref_data['npeaks'].to_numpy(dtype=np.int32)
+
+    return index
+
+
+def save_index(index, path):
+    '''
+    writes the index as .npy, through a temporary file so a reader never sees half of it.
+    '''
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    with os.fdopen(fd, 'wb') as tmp:
+        np.save(tmp, index)
+    os.replace(tmp_file, path)
+
+
+def load_index(path):
+    '''
+    memory mapped index.
+    '''
+    return np.load(path, mmap_mode='r')
+
+
+def as_frame(index):
+    '''
+    the index as a DataFrame with the columns of the reference used by feature_eng (features, windows and npeaks).
+    '''
+    return pd.DataFrame({column: index[column] for column in index.dtype.names}, copy=False)
+
+
+def feature_order(index):
+    '''
+    feature names in the order of the model input (sorted, as data_prep does).
+    '''
+    return np.unique(index['features'])
+
+
+def check_model(index, model):
+    '''
+    raises a ValueError if the model was not trained with the number of features of the index.
+    '''
+    n_features = len(feature_order(index))
+    expected = getattr(model, 'n_features_in_', None)
+
+    if expected is not None and expected != n_features:
+        raise ValueError('The reference index has %d features but the model expects %d.' % (n_features, expected))
+
+
+def check_available(ref_path, index_path, name=None):
+    '''
+    raises a ReferenceNotAvailable if neither the reference data csv nor its index exists.
+    '''
+    if not os.path.exists(index_path) and not os.path.exists(ref_path):
+        raise ReferenceNotAvailable('The reference for %s is not available: neither %s nor %s is installed.'
+                                    % (name or 'this species', os.path.basename(ref_path), os.path.basename(index_path)))
+
+
+def load_reference(ref_path, index_path, model=None, name=None):
+    '''
+
+    Returns the reference as a DataFrame read from the index. The index is (re)built from the csv
+    first if it does not exist or is older than the csv; if it can not be written (e.g. read only
+    install), the built index is used from memory.
+
+
+    Parameters
+    ----------
+    ref_path : str, default None
+        Path of the reference data csv. Not needed if the index exists.
+
+    index_path : str, default None
+        Path of the .npy index.
+
+    model : sklearn estimator, default None
+        If given, the index is checked against its n_features_in_.
+
+    name : str, default None
+        Species name, for the ReferenceNotAvailable raised if neither file exists.
+
+    '''
+    check_available(ref_path, index_path, name)
+
+    stale = (os.path.exists(ref_path)
+             and (not os.path.exists(index_path) or os.path.getmtime(index_path) < os.path.getmtime(ref_path)))
+
+    if stale:
+        index = build_index(pd.read_csv(ref_path))
+        try:
+            save_index(index, index_path)
+        except OSError:
+            pass
+    else:
+        index = load_index(index_path)
+
+    if model is not None:
+        check_model(index, model)
+
+    return as_frame(index)
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('ref_data', help='reference data csv')
+    parser.add_argument('index', help='index file to write (.npy)')
+    parser.add_argument('--model', help='pickled model to check the index against')
+    args = parser.parse_args(argv)
+
+    index = build_index(pd.read_csv(args.ref_data))
+
+    if args.model:
+        with open(args.model, 'rb') as model_file:
+            check_model(index, pickle.load(model_file))
+
+    save_index(index, args.index)
+    print('%s: %d windows, %d features' % (args.index, len(index), len(feature_order(index))))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
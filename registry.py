@@ -0,0 +1,146 @@
+'''
+
+Registry of the species the app can classify.
+
+Each species is one entry of species.json (its full name as key): the short name used on the command
+line and by xcms_params, the R preprocessing script, the pickled model and its memory mapped artifact
+(see model_store), the reference data and its binary index (see ref_index), the reference rt profile
+(see rt_align), the output folder of the R script, whether the Bioconductor packages have to be
+installed first and the ionization mode of the data (checked by preflight). File paths are relative
+to the manifest.
+
+The model and the reference of a species are only loaded when it is first used, and at most
+max_loaded species are kept in memory (least recently used first out), so adding a species costs a
+manifest entry and does not make the startup slower.
+
+'''
+
+import collections
+import json
+import os
+import threading
+
+import model_store
+import ref_index
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+MANIFEST_PATH = os.path.join(BASE_DIR, 'species.json')
+PATH_KEYS = ['script', 'model', 'model_artifact', 'ref_data', 'ref_index', 'rt_profile']
+DEFAULT_MAX_LOADED = 2
+
+Artifacts = collections.namedtuple('Artifacts', ['species', 'model', 'reference'])
+
+
+def load_manifest(path=MANIFEST_PATH):
+    '''
+    species configurations of a manifest, by full name, with the file paths made absolute.
+    '''
+    with open(path) as manifest_file:
+        manifest = json.load(manifest_file)
+
+    folder = os.path.dirname(os.path.abspath(path))
+    for config in manifest.values():
+        for key in PATH_KEYS:
+            config[key] = os.path.join(folder, config[key])
+
+    return manifest
+
+
+class UnknownSpecies(KeyError):
+    '''
+    raised for a species name that is not in the manifest.
+    '''
+
+
+def find_species(manifest, name):
+    '''
+    returns the configuration of a species, given its full name (e.g. 'Mikania laevigata') or short name (e.g. 'mikania').
+    '''
+    for species, config in manifest.items():
+        if name.lower() in (species.lower(), config['short_name']):
+            return dict(config, name=species)
+
+    raise UnknownSpecies('Unknown species %r. Options are: %s' % (name, ', '.join(manifest)))
+
+
+class Registry:
+    '''
+
+    Lazily loaded models and references of the species of a manifest. Safe to share between threads
+    (streamlit sessions): a species is loaded once even if asked for by several sessions at once.
+
+
+    Parameters
+    ----------
+    manifest : dict or str, default None
+        Species configurations (as load_manifest returns them) or the path of a manifest.
+        species.json if None.
+
+    max_loaded : int, default 2
+        Number of species whose model and reference are kept in memory.
+
+    '''
+
+    def __init__(self, manifest=None, max_loaded=DEFAULT_MAX_LOADED):
+        if manifest is None or isinstance(manifest, str):
+            manifest = load_manifest(manifest or MANIFEST_PATH)
+
+        self.manifest = manifest
+        self.max_loaded = max_loaded
+        self._loaded = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._species_locks = {name: threading.Lock() for name in manifest}
+
+    def names(self):
+        return list(self.manifest)
+
+    def species(self, name):
+        return find_species(self.manifest, name)
+
+    def loaded(self):
+        '''
+        names of the species currently in memory, least recently used first.
+        '''
+        with self._lock:
+            return list(self._loaded)
+
+    def artifacts(self, name):
+        '''
+        Artifacts (species configuration, model and reference) of a species, loaded on first use.
+        Raises a ref_index.ReferenceNotAvailable if the reference of the species is not installed.
+        '''
+        species = self.species(name)
+        name = species['name']
+
+        with self._lock:
+            if name in self._loaded:
+                self._loaded.move_to_end(name)
+                return self._loaded[name]
+
+        with self._species_locks[name]:
+            # another thread may have loaded it while this one was waiting
+            with self._lock:
+                if name in self._loaded:
+                    return self._loaded[name]
+
+            # a species of the manifest whose reference is not installed is refused before its model is loaded
+            ref_index.check_available(species['ref_data'], species['ref_index'], species['short_name'])
+            model = model_store.load(species['model'], species['model_artifact'])
+
+            reference = ref_index.load_reference(species['ref_data'], species['ref_index'], model=model,
+                                                 name=species['short_name'])
+            artifacts = Artifacts(species, model, reference)
+
+            with self._lock:
+                self._loaded[name] = artifacts
+                while len(self._loaded) > self.max_loaded:
+                    self._loaded.popitem(last=False)
+
+        return artifacts
+
+    def model(self, name):
+        return self.artifacts(name).model
+
+    def reference(self, name):
+        return self.artifacts(name).reference
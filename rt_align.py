@@ -0,0 +1,317 @@
+'''
+
+Retention time alignment of each file against a stored reference profile of the species.
+
+retcor(method="obiwarp") warps the files of an upload against a center sample of the same upload:
+its cost grows with the upload and the aligned rt frame depends on the batch, not on the one the
+reference data of the model was built in. Here every species has a reference profile (rt_profile in
+species.json), built once from the training runs, and each new file is warped to it on its own:
+
+    1. the MS1 centroids of the file are binned on the m/z x rt grid of the reference (log intensity,
+       every rt column scaled to unit norm, as the cor_opt distance of obiwarp);
+    2. the rt axis is cut into segments and the similarity of each segment with the reference is
+       computed for every shift up to max_shift;
+    3. the shifts of the segments are chosen together by dynamic programming, with a penalty on the
+       change of shift between neighbouring segments, so the warp is smooth and monotone;
+    4. the warp (the raw rt of the segment centres and the reference rt they map to) is cached by
+       file hash, so a file is never aligned twice.
+
+The files are aligned in parallel and the cost of an upload is linear in its number of files. The
+warps are applied to the peaks of each file instead of retcor (see xcms_align.R and
+peakpick.peaklist).
+
+A reference profile is built from the training runs (aligned to their center run, then the median):
+
+    python rt_align.py build rt_profile_mikania.npz training/*/*.mzXML
+    python rt_align.py warp rt_profile_mikania.npz upload/*/*.mzXML
+
+'''
+
+import argparse
+import hashlib
+import os
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import mzxml
+import peakpick
+import xcms_parallel
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_CACHE_DIR = os.path.join(BASE_DIR, 'cache', 'warps')
+
+# grid of the profiles: 1 Da as the profStep of retcor, 1 second
+MZ_STEP = 1.0
+RT_STEP = 1.0
+
+# warp: segment length and largest shift (seconds), penalty per second of shift change between segments
+SEGMENT = 30.0
+MAX_SHIFT = 60.0
+SHIFT_PENALTY = 0.01
+
+
+# ----------- Profiles ----------- #
+
+def grid(start, stop, step):
+    '''
+    lower edges of the bins of width step covering [start, stop].
+    '''
+    return start + step * np.arange(int(np.floor((stop - start) / step)) + 1)
+
+
+def file_profile(path, mz_grid, rt_grid):
+    '''
+
+    log1p of the summed MS1 intensity of an mzXML file in the bins of mz_grid x rt_grid (the lower
+    bin edges, evenly spaced), as a float32 matrix with one row per m/z bin. Centroids outside the
+    grid are left out.
+
+    '''
+    mz_step = mz_grid[1] - mz_grid[0] if len(mz_grid) > 1 else MZ_STEP
+    rt_step = rt_grid[1] - rt_grid[0] if len(rt_grid) > 1 else RT_STEP
+
+    rt, mz, intensity, scan = peakpick.read_centroids(path)
+    rows = np.floor((mz - mz_grid[0]) / mz_step).astype(np.int64)
+    columns = np.floor((rt - rt_grid[0]) / rt_step).astype(np.int64)[scan]
+    inside = (rows >= 0) & (rows < len(mz_grid)) & (columns >= 0) & (columns < len(rt_grid))
+
+    counts = np.bincount(rows[inside] * len(rt_grid) + columns[inside], weights=intensity[inside],
+                         minlength=len(mz_grid) * len(rt_grid))
+
+    return np.log1p(counts).reshape(len(mz_grid), len(rt_grid)).astype(np.float32)
+
+
+def unit_columns(profile):
+    '''
+    profile with every rt column scaled to unit norm (empty columns stay zero).
+    '''
+    norm = np.sqrt(np.einsum('ij,ij->j', profile, profile, dtype=np.float64))
+    return (profile / np.where(norm > 0, norm, 1)).astype(np.float32)
+
+
+# ----------- Reference ----------- #
+
+def save_reference(path, profile, mz_grid, rt_grid, n_files):
+    '''
+    writes a reference profile as .npz, through a temporary file so a reader never sees half of it.
+    '''
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    with os.fdopen(fd, 'wb') as tmp:
+        np.savez(tmp, profile=profile.astype(np.float32), mz_grid=mz_grid, rt_grid=rt_grid, n_files=n_files)
+    os.replace(tmp_file, path)
+
+
+def load_reference(path):
+    '''
+
+    Reference profile of a species as a dict: profile (unit columns), mz_grid, rt_grid, n_files and
+    hash (of the file, part of the warp cache keys). Raises a FileNotFoundError naming the build
+    command if the species has no reference profile yet.
+
+    '''
+    if not os.path.exists(path):
+        raise FileNotFoundError('No reference profile %s. Build it from the training runs with: '
+                                'python rt_align.py build %s <mzXML files>' % (path, os.path.basename(path)))
+
+    with np.load(path) as data:
+        reference = {name: data[name] for name in data.files}
+
+    reference['profile'] = unit_columns(reference['profile'])
+    reference['n_files'] = int(reference['n_files'])
+    reference['hash'] = xcms_parallel.file_hash(path)[:16]
+
+    return reference
+
+
+def build_reference(files, mz_step=MZ_STEP, rt_step=RT_STEP, n_jobs=None):
+    '''
+
+    Reference profile of training runs: their profiles on a common grid, each one warped to the
+    center run (the one most similar to the others), then the median. Returns the profile (log1p
+    intensities), mz_grid and rt_grid, as save_reference takes them.
+
+    '''
+    def ranges(path):
+        with mzxml.MzXML(path) as run:
+            headers = run.headers()
+            return headers['rt'].min(), headers['rt'].max(), headers['lowMz'].min(), headers['highMz'].max()
+
+    with ThreadPoolExecutor(max_workers=n_jobs or os.cpu_count()) as pool:
+        rt_min, rt_max, mz_min, mz_max = np.array(list(pool.map(ranges, files))).T
+
+    rt_grid = grid(rt_min.min(), rt_max.max(), rt_step)
+    mz_grid = grid(np.floor(mz_min.min() / mz_step) * mz_step, mz_max.max(), mz_step)
+
+    with ThreadPoolExecutor(max_workers=n_jobs or os.cpu_count()) as pool:
+        profiles = list(pool.map(lambda path: file_profile(path, mz_grid, rt_grid), files))
+
+    units = [unit_columns(profile) for profile in profiles]
+    similarity = np.array([[np.einsum('ij,ij->', a, b) for b in units] for a in units])
+    center = int(similarity.sum(axis=1).argmax())
+
+    reference = {'profile': units[center], 'rt_grid': rt_grid}
+    aligned = [warp_profile(profile, rt_grid, estimate_warp(unit, reference))
+               for profile, unit in zip(profiles, units)]
+
+    return np.median(aligned, axis=0), mz_grid, rt_grid
+
+
+# ----------- Warps ----------- #
+
+def estimate_warp(profile, reference, segment=SEGMENT, max_shift=MAX_SHIFT, penalty=SHIFT_PENALTY):
+    '''
+
+    Warp of a profile (unit columns, on the grid of the reference) to the reference. Returns a
+    2 x n_segments array: the raw rt of the segment centres and the reference rt they map to.
+
+
+    Parameters
+    ----------
+    profile : numpy array, default None
+        Profile of the file, from file_profile and unit_columns.
+
+    reference : dict, default None
+        Reference profile, as load_reference returns it.
+
+    segment : float, default 30
+        Length of the segments (seconds) whose shifts are estimated.
+
+    max_shift : float, default 60
+        Largest shift (seconds) between the file and the reference.
+
+    penalty : float, default 0.01
+        Cost of a change of shift of one second between neighbouring segments, against a segment
+        similarity between 0 and 1 (the mean cosine of its columns).
+
+    '''
+    ref_profile, rt_grid = reference['profile'], reference['rt_grid']
+    rt_step = rt_grid[1] - rt_grid[0]
+    n_columns = len(rt_grid)
+    shifts = np.arange(-int(round(max_shift / rt_step)), int(round(max_shift / rt_step)) + 1)
+    width = max(int(round(segment / rt_step)), 1)
+    starts = np.arange(0, n_columns, width)
+
+    # cosine of every reference column with the column of the file shift bins later, for every shift
+    padded = np.zeros((profile.shape[0], n_columns + 2 * shifts[-1]), dtype=np.float32)
+    padded[:, shifts[-1]:shifts[-1] + n_columns] = profile
+    column_scores = np.empty((len(shifts), n_columns))
+    for k, shift in enumerate(shifts):
+        column_scores[k] = np.einsum('ij,ij->j', ref_profile, padded[:, shifts[-1] + shift:shifts[-1] + shift + n_columns])
+    scores = np.add.reduceat(column_scores, starts, axis=1) / np.diff(np.append(starts, n_columns))
+
+    # best path of shifts over the segments; a change of shift smaller than a segment keeps the warp monotone
+    change = np.abs(shifts[:, None] - shifts[None, :])
+    transition = np.where(change < width, -penalty * rt_step * change, -np.inf)
+    value = scores[:, 0].copy()
+    previous = np.empty((len(starts), len(shifts)), dtype=np.int64)
+    for s in range(1, len(starts)):
+        candidates = value[None, :] + transition
+        previous[s] = candidates.argmax(axis=1)
+        value = scores[:, s] + candidates[np.arange(len(shifts)), previous[s]]
+
+    path = np.empty(len(starts), dtype=np.int64)
+    path[-1] = value.argmax()
+    for s in range(len(starts) - 1, 0, -1):
+        path[s - 1] = previous[s, path[s]]
+
+    centres = rt_grid[0] + rt_step * (starts + np.diff(np.append(starts, n_columns)) / 2)
+
+    return np.vstack([centres + rt_step * shifts[path], centres])
+
+
+def warp_rt(rt, warp):
+    '''
+    reference rt of raw retention times, interpolating the shift of the warp (constant beyond its ends).
+    '''
+    raw, corrected = warp
+    return np.asarray(rt, dtype=float) + np.interp(rt, raw, corrected - raw)
+
+
+def warp_profile(profile, rt_grid, warp):
+    '''
+    profile resampled on the reference rt frame: each column takes the raw column its rt maps to.
+    '''
+    raw, corrected = warp
+    source = np.rint((np.asarray(rt_grid) + np.interp(rt_grid, corrected, raw - corrected) - rt_grid[0])
+                     / (rt_grid[1] - rt_grid[0])).astype(np.int64)
+    inside = (source >= 0) & (source < len(rt_grid))
+
+    warped = np.zeros_like(profile)
+    warped[:, inside] = profile[:, source[inside]]
+
+    return warped
+
+
+def warp_cache_path(path, reference, cache_dir=DEFAULT_CACHE_DIR, segment=SEGMENT, max_shift=MAX_SHIFT,
+                    penalty=SHIFT_PENALTY):
+    '''
+    cache location of the warp of a file to a reference profile with the given settings.
+    '''
+    settings = hashlib.sha256(repr((segment, max_shift, penalty)).encode()).hexdigest()[:8]
+    return os.path.join(cache_dir, '%s_%s_%s.npy' % (xcms_parallel.file_hash(path)[:32], reference['hash'], settings))
+
+
+def file_warp(path, reference, cache_dir=DEFAULT_CACHE_DIR, **settings):
+    '''
+    warp of one mzXML file to the reference, read from the cache or estimated (and cached).
+    '''
+    cache_path = warp_cache_path(path, reference, cache_dir, **settings)
+    if os.path.exists(cache_path):
+        return np.load(cache_path)
+
+    profile = unit_columns(file_profile(path, reference['mz_grid'], reference['rt_grid']))
+    warp = estimate_warp(profile, reference, **settings)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_file = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as tmp:
+        np.save(tmp, warp)
+    os.replace(tmp_file, cache_path)
+
+    return warp
+
+
+def warp_files(files, reference, n_jobs=None, cache_dir=DEFAULT_CACHE_DIR, log=None):
+    '''
+
+    Warps of the files to the reference (see file_warp), estimated on n_jobs threads (the CPU count
+    if None). Returns a dict file -> warp. log is called with a line as each file is done.
+
+    '''
+    warps = {}
+    with ThreadPoolExecutor(max_workers=n_jobs or os.cpu_count()) as pool:
+        for path, warp in zip(files, pool.map(lambda path: file_warp(path, reference, cache_dir), files)):
+            warps[path] = warp
+            if log is not None:
+                log('rt warp %d/%d: %s (shift %+.1f to %+.1f s)' % (len(warps), len(files), os.path.basename(path),
+                                                                   (warp[1] - warp[0]).min(), (warp[1] - warp[0]).max()))
+
+    return warps
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['build', 'warp'])
+    parser.add_argument('reference', help='reference profile (.npz), written by build and read by warp')
+    parser.add_argument('files', nargs='+', help='mzXML files')
+    parser.add_argument('--jobs', type=int, help='files processed in parallel (default: CPU count)')
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR, help='folder of the cached warps')
+    args = parser.parse_args(argv)
+
+    if args.command == 'build':
+        profile, mz_grid, rt_grid = build_reference(args.files, n_jobs=args.jobs)
+        save_reference(args.reference, profile, mz_grid, rt_grid, len(args.files))
+        print('%s: %d files, %d m/z x %d rt bins' % (args.reference, len(args.files), len(mz_grid), len(rt_grid)))
+    else:
+        warp_files(args.files, load_reference(args.reference), n_jobs=args.jobs, cache_dir=args.cache_dir, log=print)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,94 @@
+'''
+small synthetic mzXML files for the tests.
+'''
+
+import base64
+import os
+import zipfile
+
+import numpy as np
+
+# (mz, rt in seconds, height) of the chromatographic peaks of every run
+PEAKS = [(200.1, 60.0, 5e5), (350.2, 120.0, 2e5), (512.3, 180.0, 1e6)]
+
+
+def write_mzxml(path, scans=120, rt_step=2.0, polarity='-', centroided=True, profile=False, peaks=PEAKS, seed=0):
+    '''
+
+    Writes an indexed mzXML file of scans MS1 spectra, rt_step seconds apart: a few noise centroids
+    plus the gaussian chromatographic peaks of peaks. With profile, every spectrum is sampled on a
+    regular m/z grid instead. centroided is the value of the centroided attribute of the scans, which
+    is left out if None. polarity is '-', '+' or None (no attribute).
+
+    '''
+    rng = np.random.default_rng(seed)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    body = [b'<?xml version="1.0" encoding="ISO-8859-1"?>\n'
+            b'<mzXML xmlns="http://sashimi.sourceforge.net/schema_revision/mzXML_3.2">\n'
+            b'<msRun scanCount="%d">\n' % scans]
+    offsets = []
+    position = len(body[0])
+    for i in range(scans):
+        rt = i * rt_step
+        if profile:
+            mz = np.arange(100.0, 600.0, 0.05)
+            intensity = rng.uniform(0, 100, len(mz))
+        else:
+            mz = rng.uniform(100, 600, 30)
+            intensity = rng.uniform(0, 100, 30)
+        for peak_mz, peak_rt, height in peaks:
+            apex = height * np.exp(-0.5 * ((rt - peak_rt) / 6.0) ** 2)
+            if profile:
+                intensity = intensity + apex * np.exp(-0.5 * ((mz - peak_mz) / 0.02) ** 2)
+            else:
+                mz, intensity = np.append(mz, peak_mz), np.append(intensity, apex)
+        order = np.argsort(mz)
+        mz, intensity = mz[order], intensity[order]
+
+        values = np.empty(2 * len(mz), dtype='>f4')
+        values[0::2], values[1::2] = mz, intensity
+
+        attributes = 'num="%d" msLevel="1" peaksCount="%d" retentionTime="PT%gS" lowMz="%g" highMz="%g" totIonCurrent="%g"' % (
+            i + 1, len(mz), rt, mz[0], mz[-1], intensity.sum())
+        if polarity is not None:
+            attributes += ' polarity="%s"' % polarity
+        if centroided is not None:
+            attributes += ' centroided="%d"' % centroided
+        scan = (b'<scan %s>\n<peaks precision="32" byteOrder="network" contentType="m/z-int" compressionType="none">'
+                % attributes.encode() + base64.b64encode(values.tobytes()) + b'</peaks>\n</scan>\n')
+
+        offsets.append(position)
+        body.append(scan)
+        position += len(scan)
+
+    index_offset = position + len(b'</msRun>\n')
+    body.append(b'</msRun>\n<index name="scan">\n')
+    body += [b'<offset id="%d">%d</offset>\n' % (i + 1, offset) for i, offset in enumerate(offsets)]
+    body.append(b'</index>\n<indexOffset>%d</indexOffset>\n</mzXML>\n' % index_offset)
+
+    with open(path, 'wb') as mzxml_file:
+        mzxml_file.write(b''.join(body))
+
+    return path
+
+
+def write_upload(folder, samples=('a', 'b'), replicates=2, **options):
+    '''
+    writes a batch folder, one subfolder per sample with its replicates (see write_mzxml), and returns the file paths.
+    '''
+    return [write_mzxml(os.path.join(folder, sample, '%s_%d.mzXML' % (sample, replicate)), seed=10 * i + replicate, **options)
+            for i, sample in enumerate(samples) for replicate in range(1, replicates + 1)]
+
+
+def write_zip(zip_path, folder):
+    '''
+    zips a batch folder as it is uploaded in the app (the sample subfolders at the root of the zip).
+    '''
+    with zipfile.ZipFile(zip_path, 'w') as archive:
+        for root, _, names in os.walk(folder):
+            for name in names:
+                path = os.path.join(root, name)
+                archive.write(path, os.path.relpath(path, folder))
+
+    return zip_path
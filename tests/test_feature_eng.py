@@ -0,0 +1,100 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.optimize import linear_sum_assignment
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import feature_eng
+
+
+def reference(mz, rt):
+    return pd.DataFrame({'features': ['%d_%s' % (round(m), r) for m, r in zip(mz, rt)], 'mz': mz, 'rt': rt})
+
+
+def targets(mz, rt):
+    return pd.DataFrame({'mz': mz, 'rt': rt, 'npeaks': np.arange(len(mz), 0, -1)})
+
+
+def brute_force_cost(n_targets, n_refs, targets_, refs, score, unmatched):
+    '''
+    lowest total cost of a one to one assignment, from the dense matrix with one unmatched column per target.
+    '''
+    cost = np.full((n_targets, n_refs + n_targets), np.inf)
+    cost[targets_, refs] = score
+    cost[np.arange(n_targets), n_refs + np.arange(n_targets)] = unmatched
+    rows, columns = linear_sum_assignment(cost)
+    return cost[rows, columns].sum()
+
+
+def test_candidate_pairs_are_the_pairs_within_the_window():
+    rng = np.random.default_rng(1)
+    target_mz = rng.uniform(100, 110, 50)
+    ref_mz = rng.uniform(100, 110, 40)
+    window = rng.uniform(0, 0.5, 50)
+
+    found = set(zip(*feature_eng.candidate_pairs(target_mz, ref_mz, window)))
+    expected = {(i, j) for i in range(50) for j in range(40) if abs(target_mz[i] - ref_mz[j]) <= window[i]}
+
+    assert found == expected
+
+
+@pytest.mark.parametrize('seed', range(30))
+def test_best_assignment_has_the_lowest_total_cost(seed):
+    rng = np.random.default_rng(seed)
+    n_targets, n_refs = rng.integers(1, 9), rng.integers(1, 9)
+    pairs = rng.random((n_targets, n_refs)) < 0.5
+    targets_, refs = np.nonzero(pairs)
+    score = rng.uniform(0, np.sqrt(2), len(targets_))
+
+    accepted = feature_eng.best_assignment(targets_, refs, score)
+
+    assert len(set(targets_[accepted])) == len(accepted)
+    assert len(set(refs[accepted])) == len(accepted)
+    cost = score[accepted].sum() + feature_eng.UNMATCHED_SCORE * (n_targets - len(accepted))
+    assert cost == pytest.approx(brute_force_cost(n_targets, n_refs, targets_, refs, score, feature_eng.UNMATCHED_SCORE))
+
+
+def test_best_assignment_beats_the_greedy_one():
+    # greedy takes target 0 - ref 0 (0.1) and leaves target 1 unmatched; the optimum matches both
+    targets_, refs, score = np.array([0, 0, 1]), np.array([0, 1, 0]), np.array([0.1, 0.3, 0.2])
+
+    accepted = feature_eng.best_assignment(targets_, refs, score)
+
+    assert sorted(zip(targets_[accepted], refs[accepted])) == [(0, 1), (1, 0)]
+
+
+def test_empty_candidate_set():
+    assert len(feature_eng.best_assignment(np.array([], dtype=int), np.array([], dtype=int), np.array([]))) == 0
+
+    result = feature_eng.feature_matching(reference([500.0], [5.0]), targets([100.0, 200.0], [5.0, 5.0]))
+    assert result['features'].isna().all()
+
+
+def test_ppm_window_is_used_when_larger_than_the_da_window():
+    ref_data = reference([1000.0], [5.0])
+    target_data = targets([1000.015], [5.0])
+
+    assert feature_eng.feature_matching(ref_data, target_data.copy(), mz_tol=0.01)['features'].isna().all()
+    # 20 ppm of 1000 is 0.02 Da
+    matched = feature_eng.feature_matching(ref_data, target_data.copy(), mz_tol=0.01, ppm=20)
+    assert list(matched['features']) == ['1000_5.0']
+
+
+def test_rt_tolerance_edge_is_included():
+    ref_data = reference([300.0], [5.0])
+
+    assert list(feature_eng.feature_matching(ref_data, targets([300.0], [5.5]), rt_tol=0.5)['features']) == ['300_5.0']
+    assert feature_eng.feature_matching(ref_data, targets([300.0], [5.51]), rt_tol=0.5)['features'].isna().all()
+
+
+def test_a_reference_is_given_to_the_closest_of_two_targets():
+    ref_data = reference([300.0], [5.0])
+
+    result = feature_eng.feature_matching(ref_data, targets([300.0, 300.0], [5.3, 5.1]), rt_tol=0.5)
+
+    assert result.loc[result['rt'] == 5.1, 'features'].tolist() == ['300_5.0']
+    assert result.loc[result['rt'] == 5.3, 'features'].isna().all()
@@ -0,0 +1,66 @@
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import incremental
+import xcms_params
+import xcms_parallel
+
+PARAMS = xcms_params.PARAMS['mikania']
+
+REF_DATA = pd.DataFrame({
+    'features': ['200_5.0', '350_10.0'],
+    'mz': [200, 350], 'mzmin': [199, 349], 'mzmax': [201, 351],
+    'rt': [5.0, 10.0], 'rtmin': [4.5, 9.5], 'rtmax': [5.5, 10.5],
+    'npeaks': [3, 2],
+})
+
+
+def add_file(folder, cache_dir, name, into):
+    '''
+    writes a file to the batch folder and the xcmsSet result of its content to the peak cache, so no R is run.
+    '''
+    path = os.path.join(folder, 'a', name + '.mzXML')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as data:
+        data.write('<mzXML>%s</mzXML>\n' % name)
+
+    prefix = xcms_parallel.peaks_cache_prefix(path, PARAMS, cache_dir)
+    pd.DataFrame({'mz': [200.1, 350.2], 'mzmin': [200.09, 350.19], 'mzmax': [200.11, 350.21],
+                  'rt': [300.0, 600.0], 'rtmin': [295.0, 595.0], 'rtmax': [305.0, 605.0],
+                  'into': into}).to_csv(prefix + '.csv', index=False)
+    open(prefix + '.rds', 'w').close()
+
+
+def test_second_batch_only_appends_the_new_files(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    os.makedirs(cache_dir)
+    store = incremental.IncrementalStore(str(tmp_path / 'store'), REF_DATA)
+
+    add_file(str(tmp_path / 'b1'), cache_dir, 's1', [10.0, 20.0])
+    add_file(str(tmp_path / 'b1'), cache_dir, 's2', [30.0, 40.0])
+    first = store.add_batch(str(tmp_path / 'b1'), PARAMS, batch='b1', cache_dir=cache_dir)
+    assert list(first.index) == ['s1', 's2']
+    stored = store.matrix()
+
+    # s1 again (same content) and a new s3
+    add_file(str(tmp_path / 'b2'), cache_dir, 's1', [10.0, 20.0])
+    add_file(str(tmp_path / 'b2'), cache_dir, 's3', [50.0, 0.0])
+    second = store.add_batch(str(tmp_path / 'b2'), PARAMS, batch='b2', cache_dir=cache_dir)
+
+    assert list(second.index) == ['s3']
+    assert list(second.loc['s3']) == [50.0, 0.0]
+    pd.testing.assert_frame_equal(store.matrix(['b1']), stored)
+    assert list(store.matrix().index.get_level_values('sample')) == ['s1', 's2', 's3']
+    assert list(store.samples()['batch']) == ['b1', 'b1', 'b2']
+
+
+def test_store_is_tied_to_its_alignment(tmp_path):
+    incremental.IncrementalStore(str(tmp_path), REF_DATA)
+
+    with pytest.raises(ValueError):
+        incremental.IncrementalStore(str(tmp_path), REF_DATA, rt_reference={'hash': '0123abcd'})
@@ -0,0 +1,61 @@
+import os
+import sqlite3
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import jobs
+import mzxml_files
+
+
+def upload(tmp_path):
+    mzxml_files.write_upload(str(tmp_path / 'batch'))
+    return mzxml_files.write_zip(str(tmp_path / 'batch.zip'), str(tmp_path / 'batch'))
+
+
+def test_submitted_job_is_done(tmp_path):
+    queue = jobs.JobQueue(root=str(tmp_path / 'jobs'), max_workers=1)
+    job_id = queue.submit(upload(tmp_path), 'mikania', backend='python')
+    queue.shutdown()
+
+    job = queue.get(job_id)
+    assert job['status'] == 'done', job['error']
+    assert job['progress'] == 1
+    _, input_data = queue.result(job_id)
+    assert len(input_data) == len(mzxml_files.PEAKS)
+    assert not os.path.exists(queue.upload_path(job_id))
+
+
+def test_job_of_a_bad_upload_fails(tmp_path):
+    bad = tmp_path / 'bad.zip'
+    bad.write_bytes(b'not a zip file')
+
+    queue = jobs.JobQueue(root=str(tmp_path / 'jobs'), max_workers=1)
+    job_id = queue.submit(str(bad), 'mikania', backend='python')
+    queue.shutdown()
+
+    job = queue.get(job_id)
+    assert job['status'] == 'failed'
+    assert job['error']
+    assert job['error'] in queue.log(job_id)
+
+
+def test_interrupted_jobs_are_queued_again(tmp_path):
+    root = str(tmp_path / 'jobs')
+    queue = jobs.JobQueue(root=root, max_workers=1)
+    queue.shutdown()
+
+    # a job running when the process stopped, and a queued job whose species is gone
+    for job_id, species, status in [('interrupted', 'mikania', 'running'), ('gone', 'nope', 'queued')]:
+        os.makedirs(queue.job_dir(job_id))
+        os.replace(upload(tmp_path), queue.upload_path(job_id))
+        with sqlite3.connect(queue.db_file) as db:
+            db.execute('INSERT INTO jobs (id, species, backend, status, progress, created) VALUES (?, ?, ?, ?, ?, ?)',
+                       (job_id, species, 'python', status, 0.5, jobs.now()))
+
+    queue = jobs.JobQueue(root=root, max_workers=1)
+    queue.shutdown()
+
+    assert queue.get('interrupted')['status'] == 'done'
+    assert queue.get('gone')['status'] == 'failed'
+    assert 'nope' in queue.get('gone')['error']
@@ -0,0 +1,80 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import memo
+
+
+def peak_table(rows=100, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({'mz': rng.uniform(100, 600, rows), 'rt': rng.uniform(0, 600, rows),
+                         's1': rng.uniform(0, 1e6, rows)})
+
+
+def test_hit_returns_a_copy():
+    calls = []
+
+    def scale(table):
+        calls.append(1)
+        return table * 2
+
+    scaled = memo.Memo().memoize(scale)
+    table = peak_table()
+
+    first = scaled(table)
+    first.loc[0, 's1'] = -1.0
+    second = scaled(table.copy())
+
+    assert len(calls) == 1
+    assert second is not first
+    assert second.loc[0, 's1'] == table.loc[0, 's1'] * 2
+    assert scaled.memo.stats()['hits'] == 1
+
+
+def test_changed_intensity_misses():
+    scaled = memo.Memo().memoize(lambda table: table * 2)
+    table = peak_table()
+    scaled(table)
+
+    changed = table.copy()
+    changed.loc[5, 's1'] += 1.0
+    result = scaled(changed)
+
+    assert result.loc[5, 's1'] == changed.loc[5, 's1'] * 2
+    assert scaled.memo.stats()['misses'] == 2
+    # a renamed sample is another table too
+    scaled(table.rename(columns={'s1': 's2'}))
+    assert scaled.memo.stats()['misses'] == 3
+
+
+def test_results_are_evicted_by_size():
+    size = memo.size_of(peak_table())
+    store = memo.Memo(max_bytes=int(2.5 * size))
+    scaled = store.memoize(lambda table: table * 2)
+    tables = [peak_table(seed=seed) for seed in range(3)]
+
+    scaled(tables[0])
+    scaled(tables[1])
+    # tables[0] is used again, tables[1] is the least recently used when tables[2] comes in
+    scaled(tables[0])
+    scaled(tables[2])
+
+    stats = store.stats()
+    assert (stats['entries'], stats['evictions']) == (2, 1)
+    assert stats['bytes'] <= store.max_bytes
+
+    scaled(tables[0])
+    scaled(tables[1])
+    assert store.stats()['hits'] == 2
+
+    # a result larger than the store is returned but not stored
+    large = peak_table(rows=1000)
+    pd.testing.assert_frame_equal(scaled(large), large * 2)
+    misses = store.stats()['misses']
+    scaled(large)
+    assert store.stats()['misses'] == misses + 1
+    assert store.stats()['bytes'] <= store.max_bytes
@@ -0,0 +1,55 @@
+import os
+import pickle
+import sys
+
+import numpy as np
+from sklearn.neighbors import KNeighborsClassifier
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import model_store
+
+
+def write_pickle(path, n_neighbors):
+    rng = np.random.default_rng(0)
+    model = KNeighborsClassifier(n_neighbors=n_neighbors).fit(rng.random((20, 4)), np.arange(20) % 2)
+    with open(path, 'wb') as model_file:
+        pickle.dump(model, model_file)
+
+
+def test_artifact_is_rebuilt_only_when_the_pickle_content_changes(tmp_path):
+    pickle_path, artifact_path = str(tmp_path / 'model.pkl'), str(tmp_path / 'model.joblib')
+    write_pickle(pickle_path, 3)
+
+    assert model_store.load(pickle_path, artifact_path).n_neighbors == 3
+    metadata = model_store.read_metadata(artifact_path)
+    assert metadata['pickle_sha256'] == model_store.file_sha256(pickle_path)
+    assert 'created' not in metadata
+
+    # a pickle newer than the artifact (e.g. after a checkout) with the same content is not rebuilt
+    os.utime(artifact_path, (1000, 1000))
+    model_store.load(pickle_path, artifact_path)
+    assert os.path.getmtime(artifact_path) == 1000
+
+    write_pickle(pickle_path, 5)
+    os.utime(pickle_path, (500, 500))
+    assert model_store.load(pickle_path, artifact_path).n_neighbors == 5
+
+
+def test_metadata_does_not_depend_on_when_it_is_written(tmp_path):
+    pickle_path = str(tmp_path / 'model.pkl')
+    write_pickle(pickle_path, 3)
+    model = model_store.load_pickle(pickle_path)
+
+    model_store.save_model(model, str(tmp_path / 'a.joblib'), model_store.file_sha256(pickle_path))
+    model_store.save_model(model, str(tmp_path / 'b.joblib'), model_store.file_sha256(pickle_path))
+
+    with open(str(tmp_path / 'a.joblib.json')) as a, open(str(tmp_path / 'b.joblib.json')) as b:
+        assert a.read() == b.read()
+
+
+def test_shipped_artifacts_match_their_pickles():
+    base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    for species in ('mikania', 'maytenus'):
+        artifact_path = os.path.join(base_dir, 'model_%s.joblib' % species)
+        assert model_store.built_from(artifact_path) == model_store.file_sha256(os.path.join(base_dir, 'model_%s.pkl' % species))
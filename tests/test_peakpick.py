@@ -0,0 +1,56 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import peakpick
+import qc_pipeline
+
+
+def peak(sample, mz, rt, into):
+    return {'mz': mz, 'mzmin': mz - 0.01, 'mzmax': mz + 0.01, 'rt': rt, 'rtmin': rt - 5, 'rtmax': rt + 5,
+            'into': into, 'intf': into, 'maxo': into, 'maxf': into, 'sn': 10.0, 'sample': sample}
+
+
+def test_peak_found_in_some_files_reaches_the_model_input():
+    # 200.1 @ 300 s is found in every file, 350.2 @ 600 s only in the first two
+    peaks = pd.DataFrame([peak(i, 200.1, 300.0, 1000.0 * (i + 1)) for i in range(3)]
+                         + [peak(i, 350.2, 600.0, 50.0 * (i + 1)) for i in range(2)])
+    names = ['s1', 's2', 's3']
+
+    table = peakpick.group_density(peaks, names, ['a', 'a', 'a'], minfrac=0.5)
+    assert len(table) == 2
+    assert not table[names].isna().any().any()
+
+    ref_data = pd.DataFrame({
+        'features': ['200_5.0', '350_10.0'],
+        'mz': [200, 350], 'mzmin': [199, 349], 'mzmax': [201, 351],
+        'rt': [5.0, 10.0], 'rtmin': [4.5, 9.5], 'rtmax': [5.5, 10.5],
+        'npeaks': [3, 2],
+    })
+    matrix = qc_pipeline.model_input(ref_data, table)
+
+    np.testing.assert_array_equal(matrix.loc[names, '350_10.0'], [50.0, 100.0, 0.0])
+    np.testing.assert_array_equal(matrix.loc[names, '200_5.0'], [1000.0, 2000.0, 3000.0])
+
+
+def test_rect_unique_keeps_the_rectangles_without_a_previous_overlap():
+    rng = np.random.default_rng(0)
+    for mzdiff in (0.0, -0.2, 0.3):
+        mz, width = rng.uniform(100, 105, 60), rng.uniform(0, 0.5, 60)
+        rt, rt_width = rng.uniform(0, 100, 60), rng.uniform(0, 10, 60)
+        order = rng.permutation(60)
+
+        keep = peakpick.rect_unique(mz - width, mz + width, rt - rt_width, rt + rt_width, order, mzdiff)
+
+        # as xcms rectUnique: each rectangle in order is kept if it overlaps none of the kept ones
+        expected = []
+        for i in order:
+            if not any(mz[i] - width[i] - mzdiff <= mz[k] + width[k] and mz[i] + width[i] + mzdiff >= mz[k] - width[k]
+                       and rt[i] - rt_width[i] <= rt[k] + rt_width[k] and rt[i] + rt_width[i] >= rt[k] - rt_width[k]
+                       for k in expected):
+                expected.append(i)
+        np.testing.assert_array_equal(keep, expected)
@@ -0,0 +1,92 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mzxml
+import mzxml_files
+import preflight
+
+
+def check(folder):
+    return preflight.check_folder(folder, polarity='negative', n_jobs=1)
+
+
+def test_valid_centroided_upload_passes(tmp_path):
+    mzxml_files.write_upload(str(tmp_path))
+
+    report = check(str(tmp_path))
+
+    assert report.ok, report.issues
+    assert report.warnings() == []
+    assert list(report.files['centroided']) == [True] * 4
+    report.raise_for_errors()
+
+
+def test_no_mzxml_file(tmp_path):
+    (tmp_path / 'a').mkdir()
+    (tmp_path / 'a' / 'notes.txt').write_text('no data')
+
+    assert check(str(tmp_path)).errors() == ['No mzXML file found.']
+
+
+def test_unreadable_and_empty_files(tmp_path):
+    mzxml_files.write_upload(str(tmp_path))
+    (tmp_path / 'a' / 'a_3.mzXML').write_text('<html>not mzXML</html>')
+    (tmp_path / 'b' / 'b_3.mzXML').write_bytes(b'')
+    mzxml_files.write_mzxml(str(tmp_path / 'b' / 'b_4.mzXML'), scans=0)
+
+    errors = check(str(tmp_path)).errors()
+
+    assert any(message.startswith('a_3.mzXML can not be read') for message in errors)
+    assert any(message.startswith('b_3.mzXML can not be read') for message in errors)
+    assert 'Files without scans: b_4' in errors
+
+
+def test_profile_mode_is_refused(tmp_path):
+    mzxml_files.write_upload(str(tmp_path))
+    mzxml_files.write_mzxml(str(tmp_path / 'a' / 'a_1.mzXML'), centroided=False)
+    # no centroided attribute: the mode is guessed from the spectra (mzxml.looks_centroided)
+    mzxml_files.write_mzxml(str(tmp_path / 'b' / 'b_1.mzXML'), centroided=None, profile=True)
+    mzxml_files.write_mzxml(str(tmp_path / 'b' / 'b_2.mzXML'), centroided=None)
+
+    report = check(str(tmp_path))
+
+    assert report.errors() == ['Files in profile mode (the spectra have to be centroided): a_1, b_1']
+    with pytest.raises(preflight.PreflightError):
+        report.raise_for_errors()
+
+
+def test_looks_centroided(tmp_path):
+    centroids = mzxml_files.write_mzxml(str(tmp_path / 'centroid.mzXML'), scans=1)
+    profile = mzxml_files.write_mzxml(str(tmp_path / 'profile.mzXML'), scans=1, profile=True)
+
+    with mzxml.MzXML(centroids) as run:
+        assert mzxml.looks_centroided(*run.peaks(0))
+    with mzxml.MzXML(profile) as run:
+        assert not mzxml.looks_centroided(*run.peaks(0))
+
+
+def test_other_polarity_is_refused(tmp_path):
+    mzxml_files.write_upload(str(tmp_path))
+    mzxml_files.write_mzxml(str(tmp_path / 'a' / 'a_2.mzXML'), polarity='+')
+    mzxml_files.write_mzxml(str(tmp_path / 'b' / 'b_2.mzXML'), polarity=None)
+
+    report = check(str(tmp_path))
+
+    assert report.errors() == ['Files not acquired in negative mode only: a_2']
+    assert report.warnings() == ['Files without polarity: b_2']
+
+
+def test_duplicate_sample_names_are_refused(tmp_path):
+    mzxml_files.write_upload(str(tmp_path))
+    # the same file name in two sample folders, and a file named as a sample folder
+    mzxml_files.write_mzxml(str(tmp_path / 'b' / 'a_1.mzXML'), seed=5)
+    mzxml_files.write_mzxml(str(tmp_path / 'b' / 'a.mzXML'), seed=6)
+
+    errors = check(str(tmp_path)).errors()
+
+    assert errors == ['Sample names used by more than one file: a_1',
+                      'Sample names equal to a sample folder name: a']
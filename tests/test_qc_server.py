@@ -0,0 +1,55 @@
+import os
+import sys
+import threading
+import urllib.error
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import qc_server
+
+TABLE = pd.DataFrame({'mz': [200.1], 'mzmin': [200.0], 'mzmax': [200.2], 'rt': [300.0], 'rtmin': [295.0],
+                      'rtmax': [305.0], 'npeaks': [2], 's1': [1000.0], 's2': [0.0]}, index=['M200T300'])
+
+
+@pytest.fixture
+def server():
+    service = qc_server.PredictionService()
+    http_server = qc_server.make_server(service, port=0)
+    thread = threading.Thread(target=http_server.serve_forever, daemon=True)
+    thread.start()
+    yield http_server
+    http_server.shutdown()
+    service.close()
+
+
+def status(client, species, body=b'', content_type=qc_server.CSV_TYPE):
+    try:
+        client._request('/predict?species=%s' % species, body, content_type)
+    except urllib.error.HTTPError as error:
+        return error.code
+    return 200
+
+
+def test_predict(server):
+    client = qc_server.Client('http://127.0.0.1:%d' % server.server_port)
+
+    result = client.predict('mikania', TABLE)
+
+    assert list(result['sample']) == ['s1', 's2']
+
+
+def test_errors_are_mapped_to_their_status(server):
+    client = qc_server.Client('http://127.0.0.1:%d' % server.server_port)
+
+    assert status(client, 'nope') == 404
+    assert status(client, 'mikania', b'not,a\npeak,table\n') == 400
+
+    def broken(species, input_data):
+        raise KeyError('mz')
+    server.service.predict = broken
+
+    assert status(client, 'mikania', qc_server.encode_arrow(TABLE), qc_server.ARROW_TYPE) == 500
+    assert server.service.stats.snapshot()['errors'] == 3
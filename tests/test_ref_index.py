@@ -0,0 +1,25 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ref_index
+
+
+def test_frame_uses_the_memory_mapped_windows(tmp_path):
+    ref_data = pd.DataFrame({'features': ['200_5.0', '350_10.0', '350_10.0'], 'mz': [200.0, 350.0, 350.1],
+                             'mzmin': [199.0, 349.0, 349.5], 'mzmax': [201.0, 351.0, 351.5], 'rt': [5.0, 10.0, 10.1],
+                             'rtmin': [4.5, 9.5, 9.6], 'rtmax': [5.5, 10.5, 10.6], 'npeaks': [2, 5, 1]})
+    index_path = str(tmp_path / 'ref_index.npy')
+    ref_index.save_index(ref_index.build_index(ref_data), index_path)
+    index = ref_index.load_index(index_path)
+
+    frame = ref_index.as_frame(index)
+
+    for column in ref_index.WINDOW_COLUMNS + ['npeaks']:
+        assert np.shares_memory(frame[column].to_numpy(), index[column])
+    assert list(frame['features']) == ['350_10.0', '200_5.0', '350_10.0']
+    np.testing.assert_array_equal(frame['mzmin'], np.float32([349.0, 199.0, 349.5]))
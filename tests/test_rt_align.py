@@ -0,0 +1,53 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rt_align
+
+RT_GRID = rt_align.grid(0.0, 900.0, rt_align.RT_STEP)
+# seconds, a sixth of a segment and well inside the rt windows of the reference features
+TOLERANCE = 5.0
+
+
+def profile(peaks, rt):
+    '''
+    log1p profile (one row per m/z bin) of gaussian peaks (row, rt, width, height) at the retention times rt.
+    '''
+    values = np.zeros((20, len(rt)))
+    for row, centre, width, height in peaks:
+        values[row] += height * np.exp(-0.5 * ((rt - centre) / width) ** 2)
+    return np.log1p(values).astype(np.float32)
+
+
+def test_known_shift_and_stretch_is_recovered():
+    rng = np.random.default_rng(0)
+    peaks = list(zip(rng.integers(0, 20, 80), rng.uniform(20, 880, 80), rng.uniform(3, 8, 80), rng.uniform(1e3, 1e6, 80)))
+
+    # the file elutes later and slower than the reference: raw rt = 1.03 * reference rt + 12
+    stretch, shift = 1.03, 12.0
+    reference = {'profile': rt_align.unit_columns(profile(peaks, RT_GRID)), 'rt_grid': RT_GRID}
+    run = rt_align.unit_columns(profile(peaks, (RT_GRID - shift) / stretch))
+
+    raw, corrected = rt_align.estimate_warp(run, reference)
+
+    # the segment centres of the warp, away from the ends of the run (the stretched run ends before the reference)
+    inside = (corrected > 60) & (corrected < 840)
+    error = raw[inside] - (stretch * corrected[inside] + shift)
+    assert np.abs(error).max() <= TOLERANCE
+
+    # warp_rt takes a raw rt back to the reference frame
+    rt = np.array([150.0, 400.0, 700.0])
+    np.testing.assert_allclose(rt_align.warp_rt(stretch * rt + shift, (raw, corrected)), rt, atol=TOLERANCE)
+
+
+def test_identical_profile_has_no_shift():
+    rng = np.random.default_rng(1)
+    peaks = list(zip(rng.integers(0, 20, 60), rng.uniform(20, 880, 60), rng.uniform(3, 8, 60), rng.uniform(1e3, 1e6, 60)))
+    reference = {'profile': rt_align.unit_columns(profile(peaks, RT_GRID)), 'rt_grid': RT_GRID}
+
+    raw, corrected = rt_align.estimate_warp(reference['profile'], reference)
+
+    np.testing.assert_array_equal(raw, corrected)
@@ -0,0 +1,70 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mzxml_files
+import xcms_cache
+
+
+def table(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({'mz': rng.uniform(100, 600, rows), 'rt': rng.uniform(0, 600, rows),
+                         's1': rng.uniform(0, 1e6, rows)}, index=['M%d' % i for i in range(rows)])
+
+
+def test_hit_returns_the_stored_table(tmp_path):
+    cache = xcms_cache.PeakTableCache(str(tmp_path))
+    key = xcms_cache.cache_key('upload', 'params')
+
+    assert cache.get(key) is None
+    cache.put(key, table(20))
+
+    table_file, cached = cache.get(key)
+    assert os.path.dirname(table_file) == str(tmp_path)
+    pd.testing.assert_frame_equal(cached, table(20), check_names=False)
+
+
+def test_key_changes_with_the_content_and_the_parameters(tmp_path):
+    folder = str(tmp_path / 'batch')
+    files = mzxml_files.write_upload(folder)
+    zip_hash = xcms_cache.zip_content_hash(mzxml_files.write_zip(str(tmp_path / 'batch.zip'), folder))
+    folder_hash = xcms_cache.folder_content_hash(folder)
+
+    # a zip and its extracted folder are the same upload
+    assert zip_hash == folder_hash
+    assert xcms_cache.cache_key(folder_hash, 'a') != xcms_cache.cache_key(folder_hash, 'b')
+
+    mzxml_files.write_mzxml(files[0], seed=99)
+    assert xcms_cache.folder_content_hash(folder) != folder_hash
+    mzxml_files.write_mzxml(files[0], seed=1)
+    assert xcms_cache.folder_content_hash(folder) == folder_hash
+
+    # the paths are the sample names
+    os.rename(files[1], files[1].replace('a_2', 'a_3'))
+    assert xcms_cache.folder_content_hash(folder) != folder_hash
+
+
+def test_least_recently_used_tables_are_evicted_by_size(tmp_path):
+    cache = xcms_cache.PeakTableCache(str(tmp_path))
+    keys = ['k1', 'k2', 'k3']
+    for i, key in enumerate(keys):
+        os.utime(cache.put(key, table(500, seed=i)), (1000 + i, 1000 + i))
+    size = max(entry_size for _, entry_size, _ in cache.entries())
+
+    # k1 is used again, k2 becomes the least recently used
+    assert cache.get('k1') is not None
+    cache.max_bytes = 3 * size
+    cache.put('k4', table(500, seed=4))
+
+    assert cache.get('k2') is None
+    assert all(cache.get(key) is not None for key in ['k1', 'k3', 'k4'])
+    assert cache.size() <= cache.max_bytes
+
+    # the newest table is kept even if it alone is over the limit
+    cache.max_bytes = 1
+    cache.put('k5', table(500, seed=5))
+    assert [os.path.basename(path) for _, _, path in cache.entries()] == ['k5.arrow']
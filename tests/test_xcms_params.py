@@ -0,0 +1,21 @@
+import os
+import re
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import qc_pipeline
+import xcms_params
+
+
+def test_species_scripts_take_their_parameters_from_xcms_params():
+    for species in qc_pipeline.SPECIES.values():
+        with open(species['script']) as script:
+            code = re.sub(r'#.*', '', script.read())
+
+        assert 'source(args[1], local = TRUE)' in code
+        # no named argument of the script is a literal number or string
+        literals = re.findall(r'[(,]\s*(\w+)\s*=\s*([\d."\'][^,)]*)', code)
+        assert literals == [], species['script']
+        for step in xcms_params.PARAMS[species['short_name']]:
+            assert 'xcms_params$%s' % step in code
@@ -0,0 +1,112 @@
+import os
+import re
+import sys
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import qc_pipeline
+import xcms_params
+import xcms_tuning
+
+PARAMS = xcms_params.PARAMS['mikania']
+
+
+def read_r_params(path):
+    '''
+    parameters of a file written by write_r_params, read back with the regexes of script_differences.
+    '''
+    with open(path) as r_file:
+        text = r_file.read()
+
+    return {step: {name: xcms_tuning.parse_values(value.strip('"'))[0]
+                   for name, value in xcms_tuning.SCRIPT_VALUE.findall(values)}
+            for step, values in re.findall(r'(\w+) = list\((.*?)\)', text, re.S)}
+
+
+def test_parse_values():
+    assert xcms_tuning.parse_values('3, 6,10') == [3, 6, 10]
+    assert xcms_tuning.parse_values('0.05,1e-3') == [0.05, 0.001]
+    assert xcms_tuning.parse_values('TRUE,FALSE') == [True, False]
+    assert xcms_tuning.parse_values('obiwarp,2') == ['obiwarp', 2]
+
+
+def test_parameter_grid_is_every_combination_grouped_by_xcmsset():
+    settings = xcms_tuning.parameter_grid(PARAMS, {'group': {'bw': [15, 30]}, 'xcmsSet': {'snthresh': [3, 6]}})
+
+    assert [changes for changes, _ in settings] == [
+        {'xcmsSet.snthresh': 3, 'group.bw': 15}, {'xcmsSet.snthresh': 3, 'group.bw': 30},
+        {'xcmsSet.snthresh': 6, 'group.bw': 15}, {'xcmsSet.snthresh': 6, 'group.bw': 30},
+    ]
+    for changes, params in settings:
+        assert params['xcmsSet']['snthresh'] == changes['xcmsSet.snthresh']
+        assert params['group']['bw'] == changes['group.bw']
+        assert params['retcor'] == PARAMS['retcor']
+    assert PARAMS['group']['bw'] == 22
+
+
+def test_parameter_grid_rejects_unknown_parameters():
+    with pytest.raises(KeyError):
+        xcms_tuning.parameter_grid(PARAMS, {'xcmsSet': {'snthresold': [3]}})
+
+
+def test_parameter_grid_derives_sigma_from_fwhm():
+    settings = xcms_tuning.parameter_grid(PARAMS, {'xcmsSet': {'fwhm': [20, 40]}})
+
+    for fwhm, (changes, params) in zip([20, 40], settings):
+        assert params['xcmsSet']['sigma'] == pytest.approx(fwhm / 2.3548)
+        assert changes['xcmsSet.sigma'] == params['xcmsSet']['sigma']
+
+    # a sigma of the grid is kept
+    settings = xcms_tuning.parameter_grid(PARAMS, {'xcmsSet': {'fwhm': [20], 'sigma': [5.0]}})
+    assert settings[0][1]['xcmsSet']['sigma'] == 5.0
+
+
+def test_script_differences(tmp_path):
+    script = tmp_path / 'xcms_test.R'
+    script.write_text('xset <- xcmsSet(files,\n'
+                      '    method = "matchedFilter",\n'
+                      '    fwhm = 28,\n'
+                      '    snthresh = 6,\n'
+                      '    index = FALSE))\n'
+                      'xset2 <- group(xset,\n'
+                      '    bw = 22.0,\n'
+                      '    minfrac = 0.3))\n')
+
+    differences = xcms_tuning.script_differences(str(script), PARAMS)
+
+    assert differences.to_dict('records') == [{'step': 'xcmsSet', 'name': 'snthresh', 'script': '6', 'params': '3'}]
+
+
+def test_write_r_params_round_trip(tmp_path):
+    params_file = str(tmp_path / 'params.R')
+    _, params = xcms_tuning.parameter_grid(PARAMS, {'xcmsSet': {'fwhm': [20]}, 'group': {'minfrac': [0.5]}})[0]
+
+    xcms_params.write_r_params(params, params_file)
+
+    assert read_r_params(params_file) == params
+
+
+def test_score_table_counts_the_reference_features_the_model_sees():
+    species = qc_pipeline.get_species('mikania')
+    model = qc_pipeline.load_species_model(species)
+    ref_data = qc_pipeline.load_reference(species, model=model)
+    ref = ref_data.drop_duplicates('features').head(10)
+
+    input_data = pd.DataFrame({'mz': ref['mz'].to_numpy(), 'mzmin': ref['mz'].to_numpy(), 'mzmax': ref['mz'].to_numpy(),
+                               'rt': ref['rt'].to_numpy() * 60, 'rtmin': ref['rt'].to_numpy() * 60 - 1,
+                               'rtmax': ref['rt'].to_numpy() * 60 + 1, 'npeaks': 3})
+    for sample in ['s1', 's2', 's3']:
+        input_data[sample] = 1000.0
+    # a feature with a zero intensity in every sample is not recovered
+    input_data.loc[0, ['s1', 's2', 's3']] = 0.0
+
+    scores = xcms_tuning.score_table(input_data, ref_data, model, labels=pd.Series({'s1': 1, 's2': 0, 's3': 1}))
+
+    assert scores['features'] == 10
+    assert scores['recovered'] == 9
+    assert scores['recovery'] == pytest.approx(9 / ref_data['features'].nunique())
+    assert 0 <= scores['separation'] <= 1
+    assert scores['score'] == pytest.approx((scores['recovery'] + scores['separation']) / 2)
@@ -0,0 +1,252 @@
+'''
+
+Lightweight timing and memory tracing of the pipeline stages.
+
+A Trace collects spans: the wall time, CPU time and resident memory of a stage. The pipeline code
+marks its stages with span(name); they are recorded in the trace made current with activate(trace)
+and cost nothing when there is none. The R scripts print one line per xcms/CAMERA step,
+
+    TRACE<tab>step<tab>wall seconds<tab>CPU seconds<tab>MB used by R
+
+which log_filter turns into spans of the same trace while the R output is read.
+
+The trace of a run can be shown as a table (Trace.table) and exported as JSON (Trace.to_json), to
+compare releases:
+
+    trace = Trace('batch')
+    with activate(trace):
+        ...
+    trace.to_json()
+
+'''
+
+import contextlib
+import contextvars
+import datetime
+import functools
+import json
+import os
+import platform
+import sys
+import threading
+import time
+
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+TRACE_PREFIX = 'TRACE\t'
+
+_current = contextvars.ContextVar('trace', default=None)
+
+
+def rss_mb():
+    '''
+    resident memory of the process in MB (peak resident memory where the current one is not available).
+    '''
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError, AttributeError):
+        pass
+
+    if resource is None:
+        return float('nan')
+
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 2**20 if sys.platform == 'darwin' else maxrss / 2**10
+
+
+def children_cpu():
+    '''
+    CPU seconds of the finished child processes (the R scripts), 0 where it can not be measured.
+    '''
+    if resource is None:
+        return 0.0
+
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class Trace:
+    '''
+
+    Spans of one run (a preprocessing job, a prediction or a qc_batch run).
+
+
+    Parameters
+    ----------
+    name : str, default ''
+        Name of the run, kept in the JSON export.
+
+    '''
+
+    def __init__(self, name=''):
+        self.name = name
+        self.created = datetime.datetime.now().isoformat(timespec='seconds')
+        self.spans = []
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def add(self, name, wall, cpu=None, rss=None, source='R', start=None, **attributes):
+        '''
+        adds a span measured elsewhere (e.g. by the R scripts).
+        '''
+        span = {
+            'name': name,
+            'source': source,
+            'start': round(max(time.perf_counter() - self._start - wall, 0) if start is None else start, 4),
+            'wall': round(wall, 4),
+            'cpu': None if cpu is None else round(cpu, 4),
+            'rss_mb': None if rss is None else round(rss, 1),
+        }
+        span.update(attributes)
+
+        with self._lock:
+            self.spans.append(span)
+
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        '''
+        records the wall time, CPU time (of this thread and of the child processes) and memory of the block.
+        '''
+        start = time.perf_counter()
+        cpu = time.thread_time()
+        child_cpu = children_cpu()
+        rss = rss_mb()
+
+        try:
+            yield
+        finally:
+            rss_after = rss_mb()
+            self.add(name, time.perf_counter() - start, cpu=time.thread_time() - cpu + children_cpu() - child_cpu,
+                     rss=rss_after, source='python', start=start - self._start,
+                     rss_delta_mb=round(rss_after - rss, 1), **attributes)
+
+    def record_line(self, line):
+        '''
+        adds the span of a TRACE line of the R output. Returns whether the line was one.
+        '''
+        if not line.startswith(TRACE_PREFIX):
+            return False
+
+        try:
+            _, step, wall, cpu, memory = line.rstrip('\n').split('\t')[:5]
+            self.add(step, float(wall), cpu=float(cpu), rss=float(memory), source='R')
+        except ValueError:
+            return False
+
+        return True
+
+    def table(self):
+        '''
+        the spans as a DataFrame, in the order they ended.
+        '''
+        return pd.DataFrame(self.spans, columns=None if self.spans else ['name', 'source', 'start', 'wall', 'cpu', 'rss_mb'])
+
+    def summary(self):
+        '''
+        total wall and CPU time and largest memory of each stage (a stage can have several spans, e.g. one per file).
+        '''
+        table = self.table()
+        if len(table) == 0:
+            return table
+
+        return (table.groupby(['source', 'name'], sort=False)
+                .agg(spans=('wall', 'size'), wall=('wall', 'sum'), cpu=('cpu', 'sum'), rss_mb=('rss_mb', 'max'))
+                .reset_index())
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'created': self.created,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'spans': list(self.spans),
+        }
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.to_dict(), **kwargs)
+
+    @classmethod
+    def from_dict(cls, data):
+        trace = cls(data.get('name', ''))
+        trace.created = data.get('created', trace.created)
+        trace.spans = list(data.get('spans', []))
+        return trace
+
+    def extend(self, other):
+        '''
+        appends the spans of another trace (e.g. the preprocessing job of a prediction).
+        '''
+        with self._lock:
+            self.spans.extend(other.spans)
+
+
+def current():
+    '''
+    the trace made current by activate, or None.
+    '''
+    return _current.get()
+
+
+@contextlib.contextmanager
+def activate(trace):
+    '''
+    makes trace the current trace of the block (in this thread).
+    '''
+    token = _current.set(trace)
+    try:
+        yield trace
+    finally:
+        _current.reset(token)
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    '''
+    span of the current trace, nothing if there is none.
+    '''
+    trace = current()
+    if trace is None:
+        yield
+        return
+
+    with trace.span(name, **attributes):
+        yield
+
+
+def traced(name):
+    '''
+    decorator recording every call of the function as a span of the current trace.
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def log_filter(log=None, trace=None):
+    '''
+
+    Log callback for the R output (see xcms_parallel.run_rscript) that records the TRACE lines in
+    trace (the current one if None) and passes the other lines on to log. The trace is bound when
+    the filter is made, so the callback can be used from other threads.
+
+    '''
+    trace = trace or current()
+
+    def filtered(line):
+        if trace is not None and trace.record_line(line):
+            return
+        if log is not None:
+            log(line)
+
+    return filtered
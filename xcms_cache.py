@@ -0,0 +1,163 @@
+'''
+
+Content addressed cache of the xcms/CAMERA peak tables.
+
+The key of an entry is a hash of the mzXML files of the upload (their paths inside the upload, which
+become the sample classes and names, and the sha256 of their content) together with the exact R
+parameters used to process them. Uploading the same data again, or running it again with the same settings,
+returns the stored peak table without running R. Changing any parameter gives another key.
+
+Entries are evicted in least recently used order once the cache grows past max_bytes.
+
+'''
+
+import hashlib
+import os
+import zipfile
+
+import ingest
+import peak_table
+import xcms_parallel
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_CACHE_DIR = os.path.join(BASE_DIR, 'cache', 'tables')
+DEFAULT_MAX_BYTES = 2 * 2**30
+
+
+def content_hash(entries):
+    '''
+    hash of (relative path, sha256 of the content) pairs, in path order, with / as separator.
+    '''
+    h = hashlib.sha256(b'mzxml')
+    for name, digest in sorted(entries):
+        h.update(('%s\0%s\n' % (name, digest)).encode())
+
+    return h.hexdigest()
+
+
+def zip_content_hash(zip_file, chunk_size=2**20):
+    '''
+
+    Hash of the mzXML members of a zip (path or file object) that are extracted (see
+    ingest.is_mzxml, the macOS resource forks are left out): their paths and the sha256 of their
+    uncompressed content. The members are read once, without being written to disk, and the hash
+    is the folder_content_hash of the folder they are extracted to.
+
+    '''
+    entries = []
+    with zipfile.ZipFile(zip_file, 'r') as zip_ref:
+        for info in zip_ref.infolist():
+            if not ingest.is_mzxml(info):
+                continue
+
+            h = hashlib.sha256()
+            with zip_ref.open(info) as member:
+                for chunk in iter(lambda: member.read(chunk_size), b''):
+                    h.update(chunk)
+            entries.append((info.filename.replace('\\', '/'), h.hexdigest()))
+
+    return content_hash(entries)
+
+
+def folder_content_hash(folder):
+    '''
+    Hash of the mzXML files under folder: their relative paths and the sha256 of their content.
+    '''
+    return content_hash([(os.path.relpath(path, folder).replace(os.sep, '/'), xcms_parallel.file_hash(path))
+                         for path in xcms_parallel.find_mzxml(folder)['file']])
+
+
+def cache_key(content_hash, params_text):
+    '''
+    key of an entry: the upload hash combined with the text of the R parameters (or of the whole R script).
+    '''
+    return hashlib.sha256(('%s\0%s' % (content_hash, params_text)).encode()).hexdigest()[:40]
+
+
+class PeakTableCache:
+    '''
+
+    Folder of peak tables (one Arrow file per key, see peak_table) with a size limit. Entries stored
+    as csv by earlier versions are still read.
+
+
+    Parameters
+    ----------
+    root : str, default cache/tables
+        Folder of the cache. Created if it does not exist.
+
+    max_bytes : int, default 2 GB
+        Size above which the least recently used tables are removed.
+
+    '''
+
+    def __init__(self, root=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, key, extension=peak_table.ARROW_EXTENSION):
+        return os.path.join(self.root, key + extension)
+
+    def get(self, key):
+        '''
+        returns the file path and the peak table stored under key, or None if there is none.
+        '''
+        for extension in peak_table.EXTENSIONS:
+            table_file = self.path(key, extension)
+
+            try:
+                input_data = peak_table.read_table(table_file)
+            except FileNotFoundError:
+                continue
+
+            # the modification time is the "last used" time of the LRU eviction
+            os.utime(table_file)
+
+            return table_file, input_data
+
+        return None
+
+    def put(self, key, input_data):
+        '''
+        stores the peak table under key and evicts old entries if needed. Returns the file path.
+        '''
+        # written to a temporary file first, so a reader never sees half a table
+        table_file = peak_table.write_arrow(input_data, self.path(key))
+
+        self.evict()
+
+        return table_file
+
+    def entries(self):
+        '''
+        (last used, size, path) of every entry, oldest first.
+        '''
+        entries = []
+        for name in os.listdir(self.root):
+            if name.endswith(tuple(peak_table.EXTENSIONS)):
+                stat = os.stat(os.path.join(self.root, name))
+                entries.append((stat.st_mtime, stat.st_size, os.path.join(self.root, name)))
+
+        return sorted(entries)
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        '''
+        removes the least recently used tables until the cache fits in max_bytes.
+        '''
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+
+        # the newest entry is always kept, even if it alone is larger than max_bytes
+        for _, size, path in entries[:-1]:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -0,0 +1,227 @@
+'''
+
+Parallel version of the xcms preprocessing. Instead of one Rscript running xcmsSet on every file
+serially, peak detection (xcms_peaks.R) runs as one R process per mzXML file on a pool of workers.
+Each result is cached by the file content and the xcmsSet parameters, so a file is never processed
+twice with the same settings. Then xcms_align.R runs the shared retcor/group/fillPeaks/CAMERA steps
+once on all files and writes the peak table, which is read with qc_pipeline.read_peak_table.
+
+'''
+
+import hashlib
+import os
+import subprocess
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+import r_worker
+import xcms_params
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+PEAKS_SCRIPT = os.path.join(BASE_DIR, 'xcms_peaks.R')
+ALIGN_SCRIPT = os.path.join(BASE_DIR, 'xcms_align.R')
+COMMON_SCRIPT = os.path.join(BASE_DIR, 'xcms_common.R')
+
+DEFAULT_CACHE_DIR = os.path.join(BASE_DIR, 'cache', 'peaks')
+
+
+def find_mzxml(folder):
+    '''
+
+    Lists the mzXML files under folder, sorted. Returns a DataFrame with the file path, the sample
+    class (the folder the file is in, as xcms does) and the sample name (the file name without extension).
+
+    '''
+    files = []
+    for root, _, names in os.walk(folder):
+        for name in names:
+            if name.lower().endswith('.mzxml'):
+                files.append(os.path.abspath(os.path.join(root, name)))
+
+    files.sort()
+
+    return pd.DataFrame({
+        'file': files,
+        'class': [os.path.basename(os.path.dirname(path)) for path in files],
+        'name': [os.path.splitext(os.path.basename(path))[0] for path in files],
+    })
+
+
+def file_hash(path, chunk_size=2**20):
+    '''
+    sha256 of the file content, read in chunks.
+    '''
+    h = hashlib.sha256()
+    with open(path, 'rb') as data:
+        for chunk in iter(lambda: data.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def run_rscript(args, cwd=None, log=None):
+    '''
+
+    Runs Rscript with args and returns the finished subprocess.CompletedProcess, with the stdout.
+    If log is given, stdout and stderr are read line by line while R runs and each line is passed
+    to log (as str), so the progress of a long run can be followed. A script is run by a warm R
+    worker instead if a pool was started (see r_worker.start_pool).
+
+    '''
+    pool = r_worker.active_pool()
+    if pool is not None and args and str(args[0]).endswith('.R'):
+        return pool.run(args[0], args[1:], cwd=cwd, log=log)
+
+    if log is None:
+        return subprocess.run(['Rscript'] + list(args), stdout=subprocess.PIPE, cwd=cwd)
+
+    process = subprocess.Popen(['Rscript'] + list(args), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=cwd)
+    lines = []
+    for line in process.stdout:
+        lines.append(line)
+        log(line.decode(errors='replace').rstrip('\n'))
+    process.wait()
+
+    return subprocess.CompletedProcess(process.args, process.returncode, stdout=b''.join(lines))
+
+
+def peaks_cache_prefix(path, params, cache_dir=DEFAULT_CACHE_DIR):
+    '''
+    cache location (without extension) of the xcmsSet result of a file with the given parameters.
+    '''
+    key = '%s_%s' % (file_hash(path)[:32], xcms_params.params_hash(params, ['xcmsSet']))
+    return os.path.join(cache_dir, key)
+
+
+def detect_file_peaks(path, params, params_file, cache_dir=DEFAULT_CACHE_DIR, log=None):
+    '''
+
+    Runs xcms_peaks.R on one file, unless its result is already in the cache. Returns the prefix of
+    the .rds and .csv written by the script. log is called with the lines of the R output.
+
+    '''
+    prefix = peaks_cache_prefix(path, params, cache_dir)
+
+    if os.path.exists(prefix + '.rds') and os.path.exists(prefix + '.csv'):
+        return prefix
+
+    # the script writes to a temporary prefix first, so an interrupted run is never taken as cached
+    tmp_prefix = '%s.tmp%d_%d' % (prefix, os.getpid(), threading.get_ident())
+    lines = []
+    process = run_rscript([PEAKS_SCRIPT, params_file, path, tmp_prefix], log=lines.append)
+
+    if process.returncode != 0:
+        raise RuntimeError('xcmsSet failed on %s:\n%s' % (path, '\n'.join(lines)))
+
+    if log is not None:
+        for line in lines:
+            log(line)
+
+    for extension in ('.csv', '.rds'):
+        os.replace(tmp_prefix + extension, prefix + extension)
+
+    return prefix
+
+
+def detect_peaks(samples, params, n_jobs=None, cache_dir=DEFAULT_CACHE_DIR, log=None):
+    '''
+
+    Runs the peak detection of every file in samples (as returned by find_mzxml) on n_jobs parallel
+    R processes. Returns a copy of samples with the prefix of the cached result of each file and
+    the hash of its content.
+
+
+    Parameters
+    ----------
+    samples : pandas DataFrame, default None
+        Files to process, with a file column.
+
+    params : dict, default None
+        Parameters of the species, e.g. xcms_params.PARAMS['mikania'].
+
+    n_jobs : int, default None
+        Number of R processes running at the same time. Number of CPUs if None.
+
+    cache_dir : str, default cache/peaks
+        Folder where the per file results are kept.
+
+    log : callable, default None
+        Called with a line of text as each file is done.
+
+    '''
+    os.makedirs(cache_dir, exist_ok=True)
+    n_jobs = n_jobs or os.cpu_count() or 1
+
+    params_file = os.path.join(cache_dir, 'params_%s.R' % xcms_params.params_hash(params, ['xcmsSet']))
+    if not os.path.exists(params_file):
+        xcms_params.write_r_params(params, params_file)
+
+    def detect(path):
+        return detect_file_peaks(path, params, params_file, cache_dir, log=log)
+
+    # the R processes do the work (and hashlib releases the GIL), the threads only wait for them
+    done = []
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        for path, prefix in zip(samples['file'], pool.map(detect, samples['file'])):
+            done.append(prefix)
+            if log is not None:
+                log('xcmsSet %d/%d: %s' % (len(done), len(samples), os.path.basename(path)))
+
+    samples = samples.copy()
+    samples['prefix'] = done
+    samples['hash'] = [os.path.basename(prefix).split('_')[0] for prefix in done]
+
+    return samples
+
+
+def align_peaks(samples, params, output_csv, warps=None, log=None):
+    '''
+
+    Runs xcms_align.R (retcor, group, fillPeaks and CAMERA) on the per file results of detect_peaks
+    and writes the peak table to output_csv. If warps (file -> warp, see rt_align.warp_files) are
+    given, the retention times are aligned with them instead of retcor.
+
+    '''
+    with tempfile.TemporaryDirectory() as tmp:
+        params_file = os.path.join(tmp, 'params.R')
+        samples_file = os.path.join(tmp, 'samples.tsv')
+
+        xcms_params.write_r_params(params, params_file)
+        table = pd.DataFrame({
+            'rds': samples['prefix'] + '.rds',
+            'file': samples['file'],
+            'class': samples['class'],
+            'name': samples['name'],
+        })
+        table.to_csv(samples_file, sep='\t', index=False)
+
+        args = [ALIGN_SCRIPT, params_file, samples_file, os.path.abspath(output_csv)]
+        if warps is not None:
+            warps_file = os.path.join(tmp, 'warps.tsv')
+            pd.concat([pd.DataFrame({'file': path, 'raw': warps[path][0], 'corrected': warps[path][1]})
+                       for path in samples['file']], ignore_index=True).to_csv(warps_file, sep='\t', index=False)
+            args.append(warps_file)
+
+        return run_rscript(args, log=log)
+
+
+def run_xcms_parallel(params, output_folder, n_jobs=None, cache_dir=DEFAULT_CACHE_DIR, warps=None, log=None):
+    '''
+
+    Parallel counterpart of qc_pipeline.run_xcms: processes every mzXML file under output_folder and
+    writes the peak table as data.csv in it. Returns the subprocess.CompletedProcess of the last step.
+    warps replace retcor, see align_peaks. log is called with the progress and R output lines (see
+    run_rscript).
+
+    '''
+    samples = find_mzxml(output_folder)
+
+    if len(samples) == 0:
+        raise FileNotFoundError('No mzXML file found in %s.' % output_folder)
+
+    samples = detect_peaks(samples, params, n_jobs=n_jobs, cache_dir=cache_dir, log=log)
+
+    return align_peaks(samples, params, os.path.join(output_folder, 'data.csv'), warps=warps, log=log)
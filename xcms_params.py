@@ -0,0 +1,145 @@
+import hashlib
+
+# ----------- xcms / CAMERA parameters ----------- #
+
+# the only copy of the parameters, one block per step of the preprocessing. They are written out as
+# an R list (see r_parameter_block) and read by the species scripts (xcms_may.R, xcms_mik.R) and by
+# the xcms_peaks.R and xcms_align.R scripts, which run the per file and the shared parts of the
+# preprocessing. The comments give the values of the IPO run the parameters were tuned from.
+
+PARAMS = {
+    'maytenus': {
+        'xcmsSet': {
+            'method': 'matchedFilter',
+            'fwhm': 18,  # 29.4
+            'snthresh': 3,  # 16.1595968
+            'step': 1,
+            'steps': 12,
+            'sigma': 12.48,
+            'max': 3,  # 5
+            'mzdiff': 1,  # -8.2
+            'index': False,
+        },
+        'retcor': {
+            'method': 'obiwarp',
+            'plottype': 'none',
+            'distFunc': 'cor_opt',
+            'profStep': 1,
+            'response': 1,
+            'gapInit': 0.2,
+            'gapExtend': 2.4,
+            'factorDiag': 2,
+            'factorGap': 1,
+            'localAlignment': 0,
+        },
+        'group': {
+            'method': 'density',
+            'bw': 29.2,
+            'mzwid': 1,  # 0.035
+            'minfrac': 0.05,  # 0.7
+            # 50 in IPO, 1 so every group is kept; the features are filtered later on
+            'minsamp': 1,
+            'max': 100,
+        },
+        'camera': {
+            'perfwhm': 0.6,
+            'mzabs': 0.01,
+            'cor_eic_th': 0.1,
+            'polarity': 'negative',
+        },
+    },
+    'mikania': {
+        'xcmsSet': {
+            'method': 'matchedFilter',
+            'fwhm': 28,  # 7.5
+            'snthresh': 3,
+            # width of the m/z slices, and number of neighbouring slices merged before the filtration
+            'step': 1,
+            'steps': 6,
+            'sigma': 3.18498386274843,
+            'max': 3,  # 5
+            'mzdiff': 1,
+            'index': False,
+        },
+        'retcor': {
+            'method': 'obiwarp',
+            'plottype': 'none',
+            'distFunc': 'cor_opt',
+            'profStep': 1,
+            'response': 1,
+            'gapInit': 0,
+            'gapExtend': 2.7,
+            'factorDiag': 2,
+            'factorGap': 1,
+            'localAlignment': 0,
+        },
+        'group': {
+            'method': 'density',
+            'bw': 22,
+            'mzwid': 1,
+            'minfrac': 0.3,
+            'minsamp': 1,
+            'max': 50,
+        },
+        'camera': {
+            'perfwhm': 0.6,
+            'mzabs': 0.01,
+            'cor_eic_th': 0.75,
+            'polarity': 'negative',
+        },
+    },
+}
+
+
+def r_value(value):
+    '''
+    writes a python value (str, bool, int or float) as an R literal.
+    '''
+    if isinstance(value, bool):
+        return 'TRUE' if value else 'FALSE'
+    if isinstance(value, str):
+        return '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"')
+    return repr(value)
+
+
+def r_parameter_block(params, sections=None):
+    '''
+
+    Writes the parameters as the R code of a list named xcms_params, with one sub list per step
+    (xcmsSet, retcor, group and camera). The text is deterministic, so it can also be hashed to know
+    if the parameters changed.
+
+
+    Parameters
+    ----------
+    params : dict, default None
+        Parameters of one species, e.g. PARAMS['mikania'].
+
+    sections : list, default None
+        Steps to write. All of them if None.
+
+    '''
+    sections = list(params) if sections is None else sections
+
+    lines = ['xcms_params <- list(']
+    for i, section in enumerate(sections):
+        values = ',\n'.join('        %s = %s' % (name, r_value(value)) for name, value in params[section].items())
+        lines.append('    %s = list(\n%s)%s' % (section, values, ',' if i < len(sections) - 1 else ''))
+    lines.append(')')
+
+    return '\n'.join(lines) + '\n'
+
+
+def write_r_params(params, path):
+    '''
+    writes the R parameter file read by xcms_peaks.R and xcms_align.R.
+    '''
+    with open(path, 'w') as r_file:
+        r_file.write(r_parameter_block(params))
+
+
+def params_hash(params, sections=None):
+    '''
+    short hash of the R parameter block, used as part of the cache keys.
+    '''
+    return hashlib.sha256(r_parameter_block(params, sections).encode()).hexdigest()[:16]
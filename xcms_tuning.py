@@ -0,0 +1,403 @@
+'''
+
+Grid search of the xcms parameters of a species.
+
+The parameters of xcms_params were tuned by hand from an IPO run (see the comments of PARAMS). This
+module runs the peak detection and grouping for every setting of a grid on a set of tuning runs (a
+folder with one subfolder per sample, as uploaded in the app), scores the peak tables and writes the
+best setting as an R parameter file, as read by the species scripts, xcms_peaks.R and xcms_align.R.
+
+The peak detection only depends on the xcmsSet block: it runs once per file and xcmsSet setting,
+fanned out on a local process pool, and is cached by file hash and parameters, so the settings that
+only change the group (or retcor) block reuse it and a grid can be extended without running again
+what was already run. Each setting is scored with the model of the species:
+
+    recovery     fraction of the reference features with a non zero intensity in the model input
+                 (after data_prep) of at least one sample
+    separation   ROC AUC of the predicted probabilities if the samples are labelled (--labels),
+                 otherwise the mean confidence of the predictions, |2 p - 1|
+    score        mean of the two
+
+Examples:
+
+    python xcms_tuning.py tuning_runs/ --species mikania --set xcmsSet.snthresh=3,6,10 --set group.bw=15,22,30
+    python xcms_tuning.py tuning_runs/ --species maytenus --grid grid.json --labels labels.csv --output params.R
+    python xcms_tuning.py tuning_runs/ --species mikania --compare ipo_script.R --set group.bw=15,22,30
+
+grid.json has the same layout as xcms_params.PARAMS, with lists of values, e.g.
+{"xcmsSet": {"snthresh": [3, 6]}, "group": {"minfrac": [0.05, 0.3]}}; labels.csv has the columns
+sample and label (1 for the class of predict_proba(...)[:, 1]). With --backend r, the peak detection
+runs xcms_peaks.R per file (cached in the folder of xcms_parallel) and each setting runs xcms_align.R.
+
+'''
+
+import argparse
+import copy
+import itertools
+import json
+import os
+import re
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from sklearn.metrics import roc_auc_score
+
+import feature_eng
+import peakpick
+import qc_pipeline
+import xcms_parallel
+import xcms_params
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_CACHE_DIR = os.path.join(BASE_DIR, 'cache', 'tuning')
+
+SCORE_COLUMNS = ['features', 'recovered', 'recovery', 'separation', 'score']
+
+# fwhm / sigma of a gaussian (2 sqrt(2 ln 2)), the sigma xcms (and peakpick.find_peaks) derive from fwhm
+FWHM_TO_SIGMA = 2.3548
+
+
+# ----------- Grid ----------- #
+
+def parse_values(text):
+    '''
+    values of a --set option ('20,28,36'), as int, float, bool or str.
+    '''
+    values = []
+    for value in text.split(','):
+        value = value.strip()
+        if value in ('TRUE', 'FALSE'):
+            values.append(value == 'TRUE')
+            continue
+        for kind in (int, float):
+            try:
+                values.append(kind(value))
+                break
+            except ValueError:
+                pass
+        else:
+            values.append(value)
+
+    return values
+
+
+def parameter_grid(base, grid):
+    '''
+
+    Settings of a grid: a copy of the base parameters (xcms_params.PARAMS[species]) for every
+    combination of the values of grid ({step: {name: [values]}}). Returns a list of (changes,
+    params) pairs, changes being the {'step.name': value} of the setting. The settings are ordered by
+    their xcmsSet values, so the ones sharing a peak detection are next to each other.
+
+    The base sigma of matchedFilter goes with its fwhm: a grid that changes xcmsSet.fwhm and not
+    xcmsSet.sigma sets sigma to fwhm / 2.3548 (as xcms does when sigma is not given), and the
+    derived value is part of the changes.
+
+    '''
+    names = [(step, name) for step in sorted(grid, key=lambda step: step != 'xcmsSet') for name in grid[step]]
+    for step, name in names:
+        if name not in base.get(step, {}):
+            raise KeyError('Unknown xcms parameter %s.%s' % (step, name))
+
+    derive_sigma = 'fwhm' in grid.get('xcmsSet', {}) and 'sigma' not in grid['xcmsSet'] and 'sigma' in base['xcmsSet']
+
+    settings = []
+    for values in itertools.product(*[grid[step][name] for step, name in names]):
+        params = copy.deepcopy(base)
+        for (step, name), value in zip(names, values):
+            params[step][name] = value
+        changes = {'%s.%s' % (step, name): value for (step, name), value in zip(names, values)}
+        if derive_sigma:
+            params['xcmsSet']['sigma'] = changes['xcmsSet.sigma'] = params['xcmsSet']['fwhm'] / FWHM_TO_SIGMA
+        settings.append((changes, params))
+
+    return settings
+
+
+SCRIPT_CALL = re.compile(r'(xcmsSet|retcor|group)\s*\((.*?)\)\)', re.S)
+SCRIPT_VALUE = re.compile(r'^\s*(\w+)\s*=\s*("[^"]*"|[\w.+-]+)', re.M)
+
+
+def script_differences(script, params):
+    '''
+
+    Parameters of an R script with literal xcmsSet, retcor and group calls (e.g. the one written by an
+    IPO run, or xcms.R) whose value differs from params (xcms_params.PARAMS[species]), as a DataFrame
+    with the step, name, script and params values. Only those three calls are read.
+
+    '''
+    with open(script) as script_file:
+        text = script_file.read()
+
+    rows = []
+    for step, arguments in SCRIPT_CALL.findall(text):
+        for name, value in SCRIPT_VALUE.findall(arguments):
+            if name not in params.get(step, {}):
+                continue
+            expected = xcms_params.r_value(params[step][name])
+            if value != expected and parse_values(value.strip('"')) != [params[step][name]]:
+                rows.append({'step': step, 'name': name, 'script': value, 'params': expected})
+
+    return pd.DataFrame(rows, columns=['step', 'name', 'script', 'params'])
+
+
+# ----------- Peak detection ----------- #
+
+def file_peaks(path, params, cache_dir=DEFAULT_CACHE_DIR):
+    '''
+
+    peakpick.find_peaks of a file with the xcmsSet block of params, read from the cache or detected
+    (and cached as a feather file keyed like xcms_parallel.peaks_cache_prefix). Runs in the worker
+    processes of detect_python.
+
+    '''
+    path_cached = xcms_parallel.peaks_cache_prefix(path, params, cache_dir) + '.feather'
+    if os.path.exists(path_cached):
+        return pd.read_feather(path_cached)
+
+    peaks = peakpick.find_peaks(path, **params['xcmsSet']).reset_index(drop=True)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_file = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    os.close(fd)
+    peaks.to_feather(tmp_file)
+    os.replace(tmp_file, path_cached)
+
+    return peaks
+
+
+def detect_python(samples, settings, n_jobs=None, cache_dir=DEFAULT_CACHE_DIR, log=None):
+    '''
+
+    Peaks of every file for every distinct xcmsSet block of the settings, detected on n_jobs
+    processes. Returns a dict xcmsSet hash -> peaks of all files (with their position in samples
+    in a sample column).
+
+    '''
+    blocks = {xcms_params.params_hash(params, ['xcmsSet']): params for _, params in settings}
+    tasks = [(block, i, path) for block in blocks for i, path in enumerate(samples['file'])]
+
+    peaks = {block: [None] * len(samples) for block in blocks}
+    with ProcessPoolExecutor(max_workers=n_jobs or os.cpu_count()) as pool:
+        results = pool.map(file_peaks, [path for _, _, path in tasks], [blocks[block] for block, _, _ in tasks],
+                           [cache_dir] * len(tasks))
+        for done, ((block, i, path), file_result) in enumerate(zip(tasks, results), 1):
+            peaks[block][i] = file_result.assign(sample=i)
+            if log is not None:
+                log('peaks %d/%d: %s' % (done, len(tasks), os.path.basename(path)))
+
+    return {block: pd.concat(file_results, ignore_index=True) for block, file_results in peaks.items()}
+
+
+def peak_table_python(peaks, samples, params):
+    '''
+    peak table of a setting with the python backend: the grouping of the cached peaks (see peakpick.peaklist).
+    '''
+    return peakpick.group_density(peaks, samples['name'], samples['class'], **params['group'])
+
+
+def peak_table_r(samples, params, cache_dir=xcms_parallel.DEFAULT_CACHE_DIR):
+    '''
+
+    peak table of a setting with the R backend: the per file xcmsSet results (cached by
+    xcms_parallel) aligned, grouped and annotated by xcms_align.R.
+
+    '''
+    samples = xcms_parallel.detect_peaks(samples, params, n_jobs=1, cache_dir=cache_dir)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        process = xcms_parallel.align_peaks(samples, params, os.path.join(tmp, 'data.csv'))
+        if process.returncode != 0:
+            raise RuntimeError('xcms_align.R failed (exit code %d)' % process.returncode)
+        return qc_pipeline.read_peak_table(tmp)[1]
+
+
+# ----------- Scores ----------- #
+
+def score_table(input_data, ref_data, model, labels=None):
+    '''
+
+    Scores of a peak table (see the module docstring) as a dict with the number of features, the
+    number and fraction of reference features recovered, the separation and the score.
+
+
+    Parameters
+    ----------
+    input_data : pandas DataFrame, default None
+        Peak table, as read_peak_table returns it.
+
+    ref_data : pandas DataFrame, default None
+        Reference of the species, as qc_pipeline.load_reference returns it.
+
+    model : sklearn Pipeline, default None
+        Model of the species.
+
+    labels : pandas Series, default None
+        Label (0 or 1) of the samples, by name. The separation is the ROC AUC of the samples with a
+        label if both labels are present, otherwise the mean confidence of the predictions.
+
+    '''
+    input_data_rounded = feature_eng.rounder(input_data.drop(qc_pipeline.ANNOTATION_COLUMNS, axis=1, errors='ignore'))
+    input_data_feat = feature_eng.feature_correspondance(ref_data, input_data_rounded)
+    _, input_data_clean = feature_eng.data_cleaning(ref_data, input_data_feat)
+
+    input_data_model = feature_eng.data_prep(ref_data, input_data_clean).set_index('index').T
+
+    # a reference feature is recovered if the model sees it: data_prep drops the rows with a missing
+    # intensity and fills the features it does not find with zero
+    recovered = (input_data_model.to_numpy() != 0).any(axis=0).sum()
+    proba = pd.Series(model.predict_proba(input_data_model)[:, 1], index=input_data_model.index)
+
+    labelled = labels.reindex(proba.index).dropna() if labels is not None else pd.Series(dtype=float)
+    if labelled.nunique() == 2:
+        separation = roc_auc_score(labelled.astype(int), proba[labelled.index])
+    else:
+        separation = float(np.abs(2 * proba - 1).mean())
+
+    recovery = recovered / max(input_data_model.shape[1], 1)
+
+    return {
+        'features': len(input_data),
+        'recovered': int(recovered),
+        'recovery': recovery,
+        'separation': separation,
+        'score': (recovery + separation) / 2,
+    }
+
+
+def tune(folder, species, grid, labels=None, backend='python', n_jobs=None, cache_dir=None, log=None):
+    '''
+
+    Runs and scores every setting of the grid on the mzXML files under folder. Returns a DataFrame
+    with one row per setting (its changes and SCORE_COLUMNS), best first, and the parameters of the
+    settings in the same order.
+
+
+    Parameters
+    ----------
+    folder : str, default None
+        Folder with the tuning runs, one subfolder per sample.
+
+    species : dict, default None
+        Species configuration, as returned by qc_pipeline.get_species.
+
+    grid : dict, default None
+        Values to try, {step: {name: [values]}}, see parameter_grid.
+
+    labels : pandas Series, default None
+        Labels of the samples, see score_table.
+
+    backend : str, default 'python'
+        'python' for peakpick, 'r' for xcms_peaks.R and xcms_align.R.
+
+    n_jobs : int, default None
+        Number of processes (peak detection) and threads (settings). CPU count if None.
+
+    cache_dir : str, default None
+        Folder of the cached peaks, cache/tuning (python) or the one of xcms_parallel (r) if None.
+
+    log : callable, default None
+        Called with a line of text as the peak detection and the settings are done.
+
+    '''
+    samples = xcms_parallel.find_mzxml(folder)
+    if len(samples) == 0:
+        raise FileNotFoundError('No mzXML file found in %s.' % folder)
+
+    settings = parameter_grid(xcms_params.PARAMS[species['short_name']], grid)
+    model = qc_pipeline.load_species_model(species)
+    ref_data = qc_pipeline.load_reference(species, model=model)
+
+    if backend == 'python':
+        peaks = detect_python(samples, settings, n_jobs=n_jobs, cache_dir=cache_dir or DEFAULT_CACHE_DIR, log=log)
+
+        def peak_table(params):
+            return peak_table_python(peaks[xcms_params.params_hash(params, ['xcmsSet'])], samples, params)
+    else:
+        # the peak detection of each xcmsSet setting is done once, on n_jobs R processes
+        cache_dir = cache_dir or xcms_parallel.DEFAULT_CACHE_DIR
+        blocks = {xcms_params.params_hash(params, ['xcmsSet']): params for _, params in settings}
+        for params in blocks.values():
+            xcms_parallel.detect_peaks(samples, params, n_jobs=n_jobs, cache_dir=cache_dir, log=log)
+
+        def peak_table(params):
+            return peak_table_r(samples, params, cache_dir=cache_dir)
+
+    def run(setting):
+        changes, params = setting
+        return dict(changes, **score_table(peak_table(params), ref_data, model, labels=labels))
+
+    rows = []
+    with ThreadPoolExecutor(max_workers=n_jobs or os.cpu_count()) as pool:
+        for row in pool.map(run, settings):
+            rows.append(row)
+            if log is not None:
+                log('setting %d/%d: %s' % (len(rows), len(settings), ' '.join('%s=%s' % item for item in row.items())))
+
+    results = pd.DataFrame(rows)
+    order = results['score'].sort_values(ascending=False, kind='stable').index
+
+    return results.loc[order].reset_index(drop=True), [settings[i][1] for i in order]
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('folder', help='folder with the tuning runs, one subfolder of mzXML files per sample')
+    parser.add_argument('--species', required=True, help='species whose parameters and model are used')
+    parser.add_argument('--grid', help='JSON file with the values to try, {step: {name: [values]}}')
+    parser.add_argument('--set', action='append', default=[], metavar='STEP.NAME=V1,V2',
+                        help='values of one parameter to try, e.g. xcmsSet.fwhm=20,28,36 (repeatable)')
+    parser.add_argument('--labels', help='csv with the sample and label columns, for the ROC AUC separation')
+    parser.add_argument('--backend', choices=['python', 'r'], default='python', help='peak detection and grouping')
+    parser.add_argument('--jobs', type=int, help='parallel processes (default: CPU count)')
+    parser.add_argument('--cache-dir', help='folder of the cached peaks')
+    parser.add_argument('--results', default='tuning.csv', help='csv with the scores of every setting')
+    parser.add_argument('--output', default='params.R', help='R parameter file written with the best setting')
+    parser.add_argument('--compare', metavar='SCRIPT',
+                        help='R script with literal xcms calls (e.g. from IPO) whose differences with the species parameters are listed')
+    args = parser.parse_args(argv)
+
+    grid = {}
+    if args.grid:
+        with open(args.grid) as grid_file:
+            grid = json.load(grid_file)
+    for option in args.set:
+        name, _, values = option.partition('=')
+        step, _, name = name.partition('.')
+        if not name or not values:
+            parser.error('--set expects STEP.NAME=V1,V2, not %r' % option)
+        grid.setdefault(step, {})[name] = parse_values(values)
+    if not grid:
+        parser.error('nothing to tune: give --grid or --set')
+
+    species = qc_pipeline.get_species(args.species)
+
+    if args.compare:
+        differences = script_differences(args.compare, xcms_params.PARAMS[species['short_name']])
+        if len(differences):
+            print('%s differs from xcms_params:' % os.path.basename(args.compare))
+            print(differences.to_string(index=False))
+
+    labels = None
+    if args.labels:
+        labels = pd.read_csv(args.labels).set_index('sample')['label']
+
+    results, params = tune(args.folder, species, grid, labels=labels, backend=args.backend, n_jobs=args.jobs,
+                           cache_dir=args.cache_dir, log=print)
+
+    results.to_csv(args.results, index=False)
+    xcms_params.write_r_params(params[0], args.output)
+
+    print(results.to_string(index=False))
+    print('best setting written to %s, scores to %s' % (args.output, args.results))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())